@@ -1,4 +1,7 @@
 import argparse
+import functools
+import hashlib
+import os
 import re
 import logging
 import matplotlib.pyplot as plt
@@ -7,15 +10,23 @@ import numpy as np
 import pandas as pd
 import seaborn as sns
 from scipy.spatial.distance import cdist
-from sklearn.cluster import KMeans
-from sklearn.decomposition import PCA
-from sklearn.manifold import TSNE
-from sklearn.mixture import GaussianMixture
-from typing import Optional, Union, Tuple, List
+import torch
+from typing import TYPE_CHECKING, Callable, Optional, Union, Tuple, List
+from cryodrgn import config as cryodrgn_config
+from cryodrgn import utils
 from cryodrgn.commands import eval_vol
+from cryodrgn.models import HetOnlyVAE
+
+if TYPE_CHECKING:
+    from sklearn.decomposition import PCA
 
 logger = logging.getLogger(__name__)
 
+# Number of points processed at a time by the minibatch and out-of-core routines below
+CHUNK_SIZE = 100000
+# Maximum size of the query x data distance matrix computed at a time
+NEAREST_POINT_MAX_DISTS = 2**24
+
 
 def parse_loss(f: str) -> np.ndarray:
     """Parse loss from run.log"""
@@ -35,8 +46,16 @@ def parse_loss(f: str) -> np.ndarray:
 # Dimensionality reduction
 
 
-def run_pca(z: np.ndarray) -> Tuple[np.ndarray, PCA]:
-    pca = PCA(z.shape[1])
+def run_pca(z: np.ndarray, minibatch: bool = False) -> Tuple[np.ndarray, "PCA"]:
+    """
+    PCA of z, fit in chunks of CHUNK_SIZE points with IncrementalPCA if minibatch=True
+    """
+    from sklearn.decomposition import PCA, IncrementalPCA
+
+    if minibatch:
+        pca = IncrementalPCA(z.shape[1], batch_size=CHUNK_SIZE)
+    else:
+        pca = PCA(z.shape[1])
     pca.fit(z)
     logger.info("Explained variance ratio:")
     logger.info(pca.explained_variance_ratio_)
@@ -45,7 +64,7 @@ def run_pca(z: np.ndarray) -> Tuple[np.ndarray, PCA]:
 
 
 def get_pc_traj(
-    pca: PCA,
+    pca: "PCA",
     zdim: int,
     numpoints: int,
     dim: int,
@@ -88,30 +107,97 @@ def run_tsne(
         logger.warning(
             "WARNING: {} datapoints > {}. This may take awhile.".format(len(z), 10000)
         )
+    from sklearn.manifold import TSNE
+
     z_embedded = TSNE(n_components=n_components, perplexity=perplexity).fit_transform(z)
     return z_embedded
 
 
-def run_umap(z: np.ndarray, **kwargs) -> np.ndarray:
+def run_umap(z: np.ndarray, fit_size: Optional[int] = None, **kwargs) -> np.ndarray:
+    """
+    UMAP embedding of z
+
+    Inputs:
+        z (Ndata x zdim np.array): Latent encodings
+        fit_size (int or None): If given, fit UMAP on a random subset of this many points
+            and embed the remaining points with UMAP.transform
+        **kwargs: Additional keyword arguments passed to umap.UMAP
+
+    Returns:
+        np.array (Ndata x n_components) of embeddings
+    """
     import umap  # CAN GET STUCK IN INFINITE IMPORT LOOP
 
     reducer = umap.UMAP(**kwargs)
-    z_embedded = reducer.fit_transform(z)
+    if fit_size is None or fit_size >= len(z):
+        return reducer.fit_transform(z)
+
+    fit_ind = np.sort(np.random.default_rng(0).choice(len(z), fit_size, replace=False))
+    reducer.fit(z[fit_ind])
+    z_embedded = np.empty((len(z), reducer.embedding_.shape[1]), dtype=np.float32)
+    z_embedded[fit_ind] = reducer.embedding_
+    rest = np.setdiff1d(np.arange(len(z)), fit_ind)
+    for i in range(0, len(rest), CHUNK_SIZE):
+        logger.info(f"Embedding points {i}-{i + CHUNK_SIZE} of {len(rest)}")
+        z_embedded[rest[i : i + CHUNK_SIZE]] = reducer.transform(
+            z[rest[i : i + CHUNK_SIZE]]
+        )
     return z_embedded
 
 
+def load_or_compute(
+    cache_dir: Optional[str], name: str, func: Callable, z: np.ndarray, **kwargs
+):
+    """
+    Return func(z, **kwargs), reusing the result saved to cache_dir by an earlier call
+    with the same z values and keyword arguments, if there is one
+
+    Results are saved as [cache_dir]/[name].[hash].pkl, where the hash is taken over the
+    dtype, shape and contents of z and the keyword arguments. Nothing is cached if
+    cache_dir is None.
+    """
+    if cache_dir is None:
+        return func(z, **kwargs)
+    h = hashlib.sha1(f"{z.dtype.str} {z.shape}".encode())
+    h.update(np.ascontiguousarray(z).data)
+    h.update(repr(sorted(kwargs.items())).encode())
+    path = os.path.join(cache_dir, f"{name}.{h.hexdigest()[:16]}.pkl")
+    if os.path.exists(path):
+        logger.info(f"Loading cached {name} results from {path}")
+        return utils.load_pkl(path)
+
+    ret = func(z, **kwargs)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}"
+    utils.save_pkl(ret, tmp)
+    os.replace(tmp, path)
+    return ret
+
+
 # Clustering
 
 
 def cluster_kmeans(
-    z: np.ndarray, K: int, on_data: bool = True, reorder: bool = True
+    z: np.ndarray,
+    K: int,
+    on_data: bool = True,
+    reorder: bool = True,
+    minibatch: bool = False,
 ) -> Tuple[np.ndarray, np.ndarray]:
     """
     Cluster z by K means clustering
     Returns cluster labels, cluster centers
     If reorder=True, reorders clusters according to agglomerative clustering of cluster centers
+    If minibatch=True, uses minibatch K means, which scales to much larger datasets
     """
-    kmeans = KMeans(n_clusters=K, random_state=0, max_iter=10)
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+
+    if minibatch:
+        kmeans = MiniBatchKMeans(
+            n_clusters=K, random_state=0, batch_size=max(1024, 4 * K), n_init=3
+        )
+    else:
+        kmeans = KMeans(n_clusters=K, random_state=0, max_iter=10)
     labels = kmeans.fit_predict(z)
     centers = kmeans.cluster_centers_
 
@@ -125,8 +211,7 @@ def cluster_kmeans(
         centers = centers[reordered]
         if centers_ind is not None:
             centers_ind = centers_ind[reordered]
-        tmp = {k: i for i, k in enumerate(reordered)}
-        labels = np.array([tmp[k] for k in labels])
+        labels = np.argsort(reordered)[labels]
     return labels, centers
 
 
@@ -151,6 +236,8 @@ def cluster_gmm(
         np.array (Ndata,) of cluster labels
         np.array (K x zdim) of cluster centers
     """
+    from sklearn.mixture import GaussianMixture
+
     clf = GaussianMixture(
         n_components=K, covariance_type="full", random_state=random_state, **kwargs
     )
@@ -168,7 +255,17 @@ def get_nearest_point(
     Find closest point in @data to @query
     Return datapoint, index
     """
-    ind = cdist(query, data).argmin(axis=1)
+    # search @data in chunks to bound the size of the distance matrix
+    chunk = max(1, NEAREST_POINT_MAX_DISTS // max(1, len(query)))
+    ind = np.zeros(len(query), dtype=np.int64)
+    min_dist = np.full(len(query), np.inf)
+    for i in range(0, len(data), chunk):
+        dist = cdist(query, data[i : i + chunk])
+        j = dist.argmin(axis=1)
+        dist = dist[np.arange(len(query)), j]
+        closer = dist < min_dist
+        ind[closer] = i + j[closer]
+        min_dist[closer] = dist[closer]
     return data[ind], ind
 
 
@@ -538,6 +635,22 @@ def plot_projections(imgs, labels=None):
     return fig, axes
 
 
+@functools.lru_cache(maxsize=1)
+def _load_volume_model(weights, config, device=None):
+    """Load the model used by gen_volumes, keeping it resident between calls"""
+    args = eval_vol.add_args(argparse.ArgumentParser()).parse_args(
+        [weights, "--config", config, "-o", "."]
+    )
+    cfg = cryodrgn_config.overwrite_config(config, args)
+    if device is not None:
+        device = torch.device(f"cuda:{device}")
+    else:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model, lattice = HetOnlyVAE.load(cfg, weights, device=device)
+    model.eval()
+    return model, lattice, cfg
+
+
 def gen_volumes(
     weights,
     config,
@@ -550,7 +663,7 @@ def gen_volumes(
     invert=None,
     vol_start_index=0,
 ):
-    """Call cryodrgn eval_vol to generate volumes at specified z values
+    """Generate volumes at specified z values, as cryodrgn eval_vol does
     Input:
         weights (str): Path to model weights .pkl
         config (str): Path to config.pkl
@@ -563,22 +676,29 @@ def gen_volumes(
         invert (bool): Invert contrast of output volumes
         vol_start_index (int): Start index for generated volumes
     """
-    args = [weights, "--config", config, "--zfile", zfile, "-o", outdir]
-    if Apix is not None:
-        args += ["--Apix", f"{Apix}"]
-    if flip:
-        args += ["--flip"]
-    if downsample is not None:
-        args += ["-d", f"{downsample}"]
-    if invert:
-        args += ["--invert"]
-    if device is not None:
-        args += ["--device", f"{device}"]
-    if vol_start_index is not None:
-        args += ["--vol-start-index", f"{vol_start_index}"]
-
-    args = eval_vol.add_args(argparse.ArgumentParser()).parse_args(args)
-    return eval_vol.main(args)
+    model, lattice, cfg = _load_volume_model(weights, config, device)
+    if downsample:
+        assert downsample % 2 == 0, "Boxsize must be even"
+        assert downsample <= lattice.D - 1, "Must be smaller than original box size"
+    z = np.loadtxt(zfile).reshape(-1, cfg["model_args"]["zdim"])
+    vol_start_index = vol_start_index or 0
+    os.makedirs(outdir, exist_ok=True)
+    out_mrcs = [
+        f"{outdir}/vol_{i:03d}.mrc"
+        for i in range(vol_start_index, vol_start_index + len(z))
+    ]
+    logger.info(f"Generating {len(z)} volumes")
+    eval_vol.generate_volumes(
+        model,
+        lattice,
+        cfg["dataset_args"]["norm"],
+        z,
+        out_mrcs,
+        Apix=Apix if Apix is not None else 1.0,
+        flip=flip,
+        invert=invert,
+        downsample=downsample,
+    )
 
 
 def load_dataframe(
@@ -12,15 +12,14 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.parallel import DataParallel
-from torch.utils.data import DataLoader
 from typing import Union
 import cryodrgn
-from cryodrgn import ctf, dataset, lie_tools, utils
+from cryodrgn import ctf, dataset, distributed, lie_tools, utils
 from cryodrgn.beta_schedule import LinearSchedule, get_beta_schedule
 from cryodrgn.lattice import Lattice
 from cryodrgn.losses import EquivarianceLoss
 from cryodrgn.models import HetOnlyVAE, unparallelize
-from cryodrgn.pose_search import PoseSearch
+from cryodrgn.pose_search import PoseSearch, PoseStore
 
 logger = logging.getLogger(__name__)
 
@@ -50,6 +49,12 @@ def add_args(parser):
         default=1,
         help="Checkpointing interval in N_EPOCHS (default: %(default)s)",
     )
+    parser.add_argument(
+        "--checkpoint-eval-z",
+        action="store_true",
+        help="Re-encode all images at each checkpoint instead of saving the z "
+        "computed while training on them during the epoch",
+    )
     parser.add_argument(
         "--log-interval",
         type=int,
@@ -114,6 +119,12 @@ def add_args(parser):
         default=16,
         help="Maximum number of CPU cores for FFT parallelization (default: %(default)s)",
     )
+    group.add_argument(
+        "--num-workers",
+        type=int,
+        default=0,
+        help="Number of worker processes preparing minibatches in the background (default: %(default)s)",
+    )
 
     group = parser.add_argument_group("Tilt series")
     group.add_argument("--tilt", help="Particle stack file (.mrcs)")
@@ -217,6 +228,14 @@ def add_args(parser):
         action="store_true",
         help="Parallelize training across all detected GPUs",
     )
+    group.add_argument(
+        "--num-processes",
+        type=int,
+        default=1,
+        help="Train with this many processes on this node, each on its share of the "
+        "images with a batch size of -b (default: %(default)s). To train across nodes, "
+        "launch with torchrun instead",
+    )
 
     group = parser.add_argument_group("Pose Search parameters")
     group.add_argument(
@@ -260,6 +279,13 @@ def add_args(parser):
         default=8,
         help="Number of poses to keep at each refinement interation during branch and bound",
     )
+    group.add_argument(
+        "--adaptive-margin",
+        type=float,
+        help="If set, drop poses whose loss is more than this many standard deviations "
+        "above the best pose of the image at each refinement iteration, keeping at most "
+        "--nkeptposes",
+    )
     group.add_argument(
         "--base-healpy",
         type=int,
@@ -407,6 +433,8 @@ def pretrain(model, lattice, optim, minibatch, tilt, zdim):
         gen_loss = F.mse_loss(gen_slice(rot), y)
 
     gen_loss.backward()
+    if distributed.is_initialized():
+        distributed.all_reduce_grads(model)
     optim.step()
     return gen_loss.item()
 
@@ -423,22 +451,15 @@ def train(
     equivariance=None,
     enc_only=False,
     poses=None,
-    ctf_params=None,
+    ctf_i=None,
 ):
     y, yt = minibatch
     use_tilt = yt is not None
-    use_ctf = ctf_params is not None
     B = y.size(0)
     D = lattice.D
 
-    ctf_i = None
-    if use_ctf:
-        freqs = lattice.freqs2d.unsqueeze(0).expand(
-            B, *lattice.freqs2d.shape
-        ) / ctf_params[:, 0].view(B, 1, 1)
-        ctf_i = ctf.compute_ctf(freqs, *torch.split(ctf_params[:, 1:], 1, 1)).view(
-            B, D, D
-        )
+    if ctf_i is not None:
+        ctf_i = ctf_i.view(B, D, D)
 
     # TODO: Center image?
     # We do this in pose-supervised train_vae
@@ -467,7 +488,7 @@ def train(
     else:  # pose search
         model.eval()
         with torch.no_grad():
-            rot, trans, _base_pose = ps.opt_theta_trans(
+            rot, trans, _ = ps.opt_theta_trans(
                 y,
                 z=z,
                 images_tilt=None if enc_only else yt,
@@ -517,16 +538,17 @@ def train(
         loss += lamb * eq_loss
 
     loss.backward()
+    if distributed.is_initialized():
+        distributed.all_reduce_grads(model)
 
     optim.step()
-    save_pose = [rot.detach().cpu().numpy()]
-    save_pose.append(trans.detach().cpu().numpy())
     return (
         gen_loss.item(),
         kld.item(),
         loss.item(),
         eq_loss.item() if eq_loss else None,
-        save_pose,
+        (rot.detach(), trans.detach()),
+        (z_mu.detach(), z_logvar.detach()),
     )
 
 
@@ -538,28 +560,25 @@ def eval_z(
     device,
     trans=None,
     use_tilt=False,
-    ctf_params=None,
+    ctf_cache=None,
 ):
     assert not model.training
     z_mu_all = []
     z_logvar_all = []
-    data_generator = DataLoader(data, batch_size=batch_size, shuffle=False)
+    ind_all = []
+    data_generator = dataset.make_dataloader(
+        data, batch_size, distributed=distributed.is_initialized()
+    )
     for minibatch in data_generator:
         ind = minibatch[-1]
+        ind_all.append(ind)
         y = minibatch[0].to(device)
         yt = None
         if use_tilt:
             yt = minibatch[1].to(device)
         B = len(ind)
         D = lattice.D
-        c = None
-        if ctf_params is not None:
-            freqs = lattice.freqs2d.unsqueeze(0).expand(
-                B, *lattice.freqs2d.shape
-            ) / ctf_params[ind, 0].view(B, 1, 1)
-            c = ctf.compute_ctf(freqs, *torch.split(ctf_params[ind, 1:], 1, 1)).view(
-                B, D, D
-            )
+        c = ctf_cache[ind].view(B, D, D) if ctf_cache is not None else None
         # if trans is not None:
         #    y = lattice.translate_ht(y.view(B,-1), trans[ind].unsqueeze(1)).view(B,D,D)
         #    if yt is not None: yt = lattice.translate_ht(yt.view(B,-1), trans[ind].unsqueeze(1)).view(B,D,D)
@@ -573,9 +592,26 @@ def eval_z(
         z_logvar_all.append(z_logvar.detach().cpu().numpy())
     z_mu_all = np.vstack(z_mu_all)
     z_logvar_all = np.vstack(z_logvar_all)
+    if distributed.is_initialized():
+        # each process encoded a share of the images
+        z_mu_all, z_logvar_all = (
+            x.numpy()
+            for x in distributed.gather_rows(
+                torch.cat(ind_all),
+                data.N,
+                torch.from_numpy(z_mu_all),
+                torch.from_numpy(z_logvar_all),
+            )
+        )
     return z_mu_all, z_logvar_all
 
 
+def _write_z(z, out_z):
+    with open(out_z, "wb") as f:
+        for x in z:
+            pickle.dump(x, f)
+
+
 def save_checkpoint(
     model,
     lattice,
@@ -589,32 +625,37 @@ def save_checkpoint(
     out_weights,
     out_z,
     out_poses,
+    writer=None,
 ):
-    """Save model weights, latent encoding z, and decoder volumes"""
+    """
+    Save model weights, latent encoding z, and poses, in the background if given a
+    utils.CheckpointWriter (after waiting for its previous checkpoint to finish)
+    """
+    if writer is None:
+        writer = utils.CheckpointWriter(background=False)
+    writer.wait()
     # save model weights
-    torch.save(
+    writer.write(
+        out_weights,
+        torch.save,
         {
             "epoch": epoch,
             "model_state_dict": model.state_dict(),
             "optimizer_state_dict": optim.state_dict(),
             "search_pose": search_pose,
         },
-        out_weights,
     )
     # save z
-    with open(out_z, "wb") as f:
-        pickle.dump(z_mu, f)
-        pickle.dump(z_logvar, f)
-    with open(out_poses, "wb") as f:
-        rot, trans = search_pose
-        # When saving translations, save in box units (fractional)
-        if isinstance(model, DataParallel):
-            _model = model.module
-            assert isinstance(_model, HetOnlyVAE)
-            D = _model.lattice.D
-        else:
-            D = model.lattice.D
-        pickle.dump((rot, trans / D), f)
+    writer.write(out_z, _write_z, (z_mu, z_logvar))
+    rot, trans = search_pose
+    # When saving translations, save in box units (fractional)
+    if isinstance(model, DataParallel):
+        _model = model.module
+        assert isinstance(_model, HetOnlyVAE)
+        D = _model.lattice.D
+    else:
+        D = model.lattice.D
+    writer.write(out_poses, utils.save_pkl, (rot, trans / D))
 
 
 def save_config(args, dataset, lattice, model, out_config):
@@ -656,20 +697,6 @@ def save_config(args, dataset, lattice, model, out_config):
         pickle.dump(meta, f)
 
 
-def sort_poses(poses):
-    ind = [x[0] for x in poses]
-    ind = np.concatenate(ind)
-    rot = [x[1][0] for x in poses]
-    rot = np.concatenate(rot)
-    rot = rot[np.argsort(ind)]
-    if len(poses[0][1]) == 2:
-        trans = [x[1][1] for x in poses]
-        trans = np.concatenate(trans)
-        trans = trans[np.argsort(ind)]
-        return (rot, trans)
-    return (rot,)
-
-
 def get_latest(args):
     logger.info("Detecting latest checkpoint...")
     weights = [f"{args.outdir}/weights.{i}.pkl" for i in range(args.num_epochs)]
@@ -684,14 +711,23 @@ def get_latest(args):
 
 
 def main(args):
+    if args.num_processes > 1 and not distributed.is_launched():
+        distributed.spawn(main, args, args.num_processes)
+        return
+    is_distributed = distributed.is_launched()
+    if is_distributed:
+        distributed.init(torch.device("cuda" if torch.cuda.is_available() else "cpu"))
+    is_main = distributed.is_main_process()
+    world_size = distributed.get_world_size()
+
     if args.verbose:
         logger.setLevel(logging.DEBUG)
 
     t1 = dt.now()
-    if args.outdir is not None and not os.path.exists(args.outdir):
-        os.makedirs(args.outdir)
-
-    logger.addHandler(logging.FileHandler(f"{args.outdir}/run.log"))
+    if is_main:
+        if args.outdir is not None and not os.path.exists(args.outdir):
+            os.makedirs(args.outdir)
+        logger.addHandler(logging.FileHandler(f"{args.outdir}/run.log"))
 
     if args.load == "latest":
         args = get_latest(args)
@@ -700,7 +736,7 @@ def main(args):
 
     # set the random seed
     np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
+    torch.manual_seed(args.seed + distributed.get_rank())
 
     # set the device
     use_cuda = torch.cuda.is_available()
@@ -803,11 +839,13 @@ def main(args):
         if args.ind is not None:
             ctf_params = ctf_params[ind]
         assert ctf_params.shape == (Nimg, 8), ctf_params.shape
-        ctf_params = torch.tensor(ctf_params, device=device)
     else:
         ctf_params = None
 
     lattice = Lattice(D, extent=0.5, device=device)
+    ctf_cache = (
+        ctf.CTFCache(lattice.freqs2d, ctf_params) if ctf_params is not None else None
+    )
     if args.enc_mask is None:
         args.enc_mask = D // 2
     if args.enc_mask > 0:
@@ -832,7 +870,9 @@ def main(args):
     )
 
     # parallelize
-    if args.multigpu and torch.cuda.device_count() > 1:
+    if is_distributed:
+        assert not args.multigpu, "Use one process per GPU instead of --multigpu"
+    elif args.multigpu and torch.cuda.device_count() > 1:
         logger.info(f"Using {torch.cuda.device_count()} GPUs!")
         args.batch_size *= torch.cuda.device_count()
         logger.info(f"Increasing batch size to {args.batch_size}")
@@ -856,7 +896,7 @@ def main(args):
     if args.load == "latest":
         args = get_latest(args)
 
-    sorted_poses = []
+    pose_store = PoseStore(Nimg, device=device)
     if args.load:
         args.pretrain = 0
         logger.info("Loading checkpoint from {}".format(args.load))
@@ -877,9 +917,12 @@ def main(args):
                 D = _model.lattice.D
             else:
                 D = model.lattice.D
-            sorted_poses = (rot, trans * D)
+            pose_store.load(rot, trans * D)
     else:
         start_epoch = 0
+    if is_distributed:
+        # start all processes from the same weights
+        distributed.broadcast_parameters(model)
 
     if args.pose_model_update_freq:
         assert not args.multigpu, "TODO"
@@ -890,8 +933,9 @@ def main(args):
         pose_model = model
 
     # save configuration
-    out_config = "{}/config.pkl".format(args.outdir)
-    save_config(args, data, lattice, model, out_config)
+    if is_main:
+        out_config = "{}/config.pkl".format(args.outdir)
+        save_config(args, data, lattice, model, out_config)
 
     ps = PoseSearch(
         pose_model,
@@ -904,19 +948,26 @@ def main(args):
         niter=args.niter,
         nkeptposes=args.nkeptposes,
         base_healpy=args.base_healpy,
+        adaptive_margin=args.adaptive_margin,
         t_xshift=args.t_xshift,
         t_yshift=args.t_yshift,
         device=device,
     )
 
-    data_iterator = DataLoader(data, batch_size=args.batch_size, shuffle=True)
+    data_iterator = dataset.make_dataloader(
+        data,
+        args.batch_size,
+        shuffle=True,
+        num_workers=args.num_workers,
+        distributed=is_distributed,
+    )
 
     # pretrain decoder with random poses
     global_it = 0
     logger.info("Using random poses for {} iterations".format(args.pretrain))
     while global_it < args.pretrain:
         for batch in data_iterator:
-            global_it += len(batch[0])
+            global_it += len(batch[0]) * world_size
             batch = (
                 (batch[0].to(device), None)
                 if tilt is None
@@ -940,6 +991,10 @@ def main(args):
         pose_model.load_state_dict(model.state_dict())
 
     epoch = None
+    # latent encodings of each image from the last time it was trained on
+    z_mu_all = torch.zeros((Nimg, args.zdim), device=device)
+    z_logvar_all = torch.zeros((Nimg, args.zdim), device=device)
+    writer = utils.CheckpointWriter()
     for epoch in range(start_epoch, num_epochs):
         t2 = dt.now()
         kld_accum = 0
@@ -947,7 +1002,10 @@ def main(args):
         loss_accum = 0
         eq_loss_accum = 0
         batch_it = 0
-        poses = []
+        epoch_ind = []
+        search_poses = epoch % args.ps_freq == 0
+        if is_distributed:
+            data_iterator.sampler.sampler.set_epoch(epoch)
 
         L_model = lattice.D // 2
         if args.l_ramp_epochs > 0:
@@ -962,6 +1020,8 @@ def main(args):
         if args.reset_model_every and (epoch - 1) % args.reset_model_every == 0:
             logger.info(">> Resetting model")
             model = make_model(args, lattice, enc_mask, in_dim)
+            if is_distributed:
+                distributed.broadcast_parameters(model)
 
         if args.reset_optim_every and (epoch - 1) % args.reset_optim_every == 0:
             logger.info(">> Resetting optim")
@@ -969,17 +1029,16 @@ def main(args):
                 model.parameters(), lr=args.lr, weight_decay=args.wd
             )
 
-        if epoch % args.ps_freq != 0:
+        if not search_poses:
             logger.info("Using previous iteration poses")
         for batch in data_iterator:
             ind = batch[-1]
-            ind_np = ind.cpu().numpy()
             batch = (
                 (batch[0].to(device), None)
                 if tilt is None
                 else (batch[0].to(device), batch[1].to(device))
             )
-            batch_it += len(batch[0])
+            batch_it += len(batch[0]) * world_size
             global_it = Nimg * epoch + batch_it
 
             lamb = None
@@ -991,18 +1050,15 @@ def main(args):
                 equivariance_tuple = None
 
             # train the model
-            if epoch % args.ps_freq != 0:
-                p = [torch.tensor(x[ind_np], device=device) for x in sorted_poses]  # type: ignore
-            else:
-                p = None
+            p = None if search_poses else pose_store.get(ind)
 
             cc += len(batch[0])
             if args.pose_model_update_freq and cc > args.pose_model_update_freq:
                 pose_model.load_state_dict(model.state_dict())
                 cc = 0
 
-            ctf_i = ctf_params[ind] if ctf_params is not None else None
-            gen_loss, kld, loss, eq_loss, pose = train(
+            ctf_i = ctf_cache[ind] if ctf_cache is not None else None
+            gen_loss, kld, loss, eq_loss, pose, z = train(
                 model,
                 lattice,
                 ps,
@@ -1014,10 +1070,14 @@ def main(args):
                 equivariance_tuple,
                 enc_only=args.enc_only,
                 poses=p,
-                ctf_params=ctf_i,
+                ctf_i=ctf_i,
             )
+            if search_poses:
+                pose_store.update(ind, *pose)
+            z_mu_all.index_copy_(0, ind.to(device), z[0])
+            z_logvar_all.index_copy_(0, ind.to(device), z[1])
+            epoch_ind.append(ind)
             # logging
-            poses.append((ind.cpu().numpy(), pose))
             kld_accum += kld * len(ind)
             gen_loss_accum += gen_loss * len(ind)
             if args.equivariance:
@@ -1036,6 +1096,15 @@ def main(args):
                     f"kld={kld:.4f}, beta={beta:.4f}, {eq_log}loss={loss:.4f}"
                 )
 
+        if is_distributed:
+            (
+                gen_loss_accum,
+                kld_accum,
+                loss_accum,
+                eq_loss_accum,
+            ) = distributed.all_reduce_sum(
+                [gen_loss_accum, kld_accum, loss_accum, eq_loss_accum]
+            )
         eq_log = (
             "equivariance = {:.4f}, ".format(eq_loss_accum / Nimg)
             if args.equivariance
@@ -1051,8 +1120,20 @@ def main(args):
                 dt.now() - t2,
             )
         )
-
-        sorted_poses = sort_poses(poses) if poses else None
+        if ps.stats["images"]:
+            logger.info(ps.summarize_stats())
+            ps.reset_stats()
+
+        if is_distributed:
+            # each process trained on (and searched the poses of) a share of the images
+            epoch_ind = torch.cat(epoch_ind).to(device)
+            if search_poses:
+                pose_store.rot, pose_store.trans = distributed.gather_rows(
+                    epoch_ind,
+                    Nimg,
+                    pose_store.rot[epoch_ind],
+                    pose_store.trans[epoch_ind],
+                )
 
         # save checkpoint
         if args.checkpoint and epoch % args.checkpoint == 0:
@@ -1060,30 +1141,39 @@ def main(args):
             out_weights = "{}/weights.{}.pkl".format(args.outdir, epoch)
             out_poses = "{}/pose.{}.pkl".format(args.outdir, epoch)
             out_z = "{}/z.{}.pkl".format(args.outdir, epoch)
-            model.eval()
-            with torch.no_grad():
-                z_mu, z_logvar = eval_z(
-                    model,
-                    lattice,
-                    data,
-                    args.batch_size,
-                    device,
-                    use_tilt=tilt is not None,
-                    ctf_params=ctf_params,
-                )
+            if args.checkpoint_eval_z:
+                model.eval()
+                with torch.no_grad():
+                    z_mu, z_logvar = eval_z(
+                        model,
+                        lattice,
+                        data,
+                        args.batch_size,
+                        device,
+                        use_tilt=tilt is not None,
+                        ctf_cache=ctf_cache,
+                    )
+            else:
+                if is_distributed:
+                    z_mu_all, z_logvar_all = distributed.gather_rows(
+                        epoch_ind, Nimg, z_mu_all[epoch_ind], z_logvar_all[epoch_ind]
+                    )
+                z_mu, z_logvar = z_mu_all.cpu().numpy(), z_logvar_all.cpu().numpy()
+            if is_main:
                 save_checkpoint(
                     model,
                     lattice,
                     optim,
                     epoch,
                     data.norm,
-                    sorted_poses,
+                    pose_store.numpy(),
                     z_mu,
                     z_logvar,
                     out_mrc,
                     out_weights,
                     out_z,
                     out_poses,
+                    writer,
                 )
 
     if epoch is not None:
@@ -1102,27 +1192,31 @@ def main(args):
                 args.batch_size,
                 device,
                 use_tilt=tilt is not None,
-                ctf_params=ctf_params,
+                ctf_cache=ctf_cache,
             )
+        if is_main:
             save_checkpoint(
                 model,
                 lattice,
                 optim,
                 epoch,
                 data.norm,
-                sorted_poses,
+                pose_store.numpy(),
                 z_mu,
                 z_logvar,
                 out_mrc,
                 out_weights,
                 out_z,
                 out_poses,
+                writer,
             )
+        writer.wait()
 
         td = dt.now() - t1
         logger.info(
             "Finished in {} ({} per epoch)".format(td, td / (num_epochs - start_epoch))
         )
+    distributed.cleanup()
 
 
 if __name__ == "__main__":
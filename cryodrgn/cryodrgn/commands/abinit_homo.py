@@ -13,7 +13,6 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.data import DataLoader
 
 from cryodrgn import ctf, dataset, lie_tools, models, mrc, utils
 from cryodrgn.lattice import Lattice
@@ -196,6 +195,13 @@ def add_args(parser):
         default=8,
         help="Number of poses to keep at each refinement interation during branch and bound",
     )
+    group.add_argument(
+        "--adaptive-margin",
+        type=float,
+        help="If set, drop poses whose loss is more than this many standard deviations "
+        "above the best pose of the image at each refinement iteration, keeping at most "
+        "--nkeptposes",
+    )
     group.add_argument(
         "--base-healpy",
         type=int,
@@ -269,24 +275,40 @@ def add_args(parser):
 
 
 def save_checkpoint(
-    model, lattice, pose, optim, epoch, norm, out_mrc, out_weights, out_poses
+    model,
+    lattice,
+    pose,
+    optim,
+    epoch,
+    norm,
+    out_mrc,
+    out_weights,
+    out_poses,
+    writer=None,
 ):
+    """
+    Save the reconstructed volume, model weights, and poses, in the background if
+    given a utils.CheckpointWriter (after waiting for its previous checkpoint to finish)
+    """
+    if writer is None:
+        writer = utils.CheckpointWriter(background=False)
+    writer.wait()
     model.eval()
     vol = model.eval_volume(lattice.coords, lattice.D, lattice.extent, norm)
-    mrc.write(out_mrc, vol.astype(np.float32))
-    torch.save(
+    writer.write(out_mrc, lambda x, path: mrc.write(path, x), vol.astype(np.float32))
+    writer.write(
+        out_weights,
+        torch.save,
         {
             "norm": norm,
             "epoch": epoch,
             "model_state_dict": model.state_dict(),
             "optimizer_state_dict": optim.state_dict(),
         },
-        out_weights,
     )
-    with open(out_poses, "wb") as f:
-        rot, trans = pose
-        # When saving translations, save in box units (fractional)
-        pickle.dump((rot, trans / model.D), f)
+    rot, trans = pose
+    # When saving translations, save in box units (fractional)
+    writer.write(out_poses, utils.save_pkl, (rot, trans / model.D))
 
 
 def pretrain(model, lattice, optim, batch, tilt=None):
@@ -348,20 +370,14 @@ def train(
     no_trans=False,
     poses=None,
     base_pose=None,
-    ctf_params=None,
+    ctf_i=None,
 ):
     y, yt = batch
     B = y.size(0)
     D = lattice.D
 
-    ctf_i = None
-    if ctf_params is not None:
-        freqs = lattice.freqs2d.unsqueeze(0).expand(
-            B, *lattice.freqs2d.shape
-        ) / ctf_params[:, 0].view(B, 1, 1)
-        ctf_i = ctf.compute_ctf(freqs, *torch.split(ctf_params[:, 1:], 1, 1)).view(
-            B, D, D
-        )
+    if ctf_i is not None:
+        ctf_i = ctf_i.view(B, D, D)
 
     # pose inference
     if poses is not None:
@@ -507,12 +523,14 @@ def main(args):
         if args.ind is not None:
             ctf_params = ctf_params[args.ind]
         assert ctf_params.shape == (Nimg, 8)
-        ctf_params = torch.tensor(ctf_params, device=device)
     else:
         ctf_params = None
 
     # instantiate model
     lattice = Lattice(D, extent=0.5, device=device)
+    ctf_cache = (
+        ctf.CTFCache(lattice.freqs2d, ctf_params) if ctf_params is not None else None
+    )
     model = make_model(args, D)
     model.to(device)
 
@@ -537,6 +555,7 @@ def main(args):
             niter=args.niter,
             nkeptposes=args.nkeptposes,
             base_healpy=args.base_healpy,
+            adaptive_margin=args.adaptive_margin,
             t_xshift=args.t_xshift,
             t_yshift=args.t_yshift,
             device=device,
@@ -571,7 +590,7 @@ def main(args):
     else:
         start_epoch = 0
 
-    data_iterator = DataLoader(data, batch_size=args.batch_size, shuffle=True)
+    data_iterator = dataset.make_dataloader(data, args.batch_size, shuffle=True)
 
     # pretrain decoder with random poses
     global_it = 0
@@ -605,6 +624,7 @@ def main(args):
         pose_model.load_state_dict(model.state_dict())
 
     epoch = None
+    writer = utils.CheckpointWriter()
     for epoch in range(start_epoch, args.num_epochs):
         t2 = dt.now()
         batch_it = 0
@@ -653,7 +673,7 @@ def main(args):
                 pose_model.load_state_dict(model.state_dict())
                 cc = 0
 
-            c = ctf_params[ind] if ctf_params is not None else None
+            c = ctf_cache[ind] if ctf_cache is not None else None
             loss_item, pose, base_pose = train(
                 model,
                 lattice,
@@ -664,7 +684,7 @@ def main(args):
                 args.no_trans,
                 poses=p,
                 base_pose=bp,
-                ctf_params=c,
+                ctf_i=c,
             )
             poses.append((ind.cpu().numpy(), pose))
             base_poses.append((ind_np, base_pose))
@@ -681,6 +701,9 @@ def main(args):
                 epoch + 1, loss_accum / Nimg, dt.now() - t2
             )
         )
+        if ps.stats["images"]:
+            logger.info(ps.summarize_stats())
+            ps.reset_stats()
 
         # sort pose
         sorted_poses = sort_poses(poses) if poses else None
@@ -700,6 +723,7 @@ def main(args):
                 out_mrc,
                 out_weights,
                 out_poses,
+                writer,
             )
 
     if epoch is not None:
@@ -717,7 +741,9 @@ def main(args):
             out_mrc,
             out_weights,
             out_poses,
+            writer,
         )
+        writer.wait()
 
         td = dt.now() - t1
         logger.info(
@@ -36,6 +36,23 @@ def add_args(parser):
         "--skip-vol", action="store_true", help="Skip generation of volumes"
     )
     parser.add_argument("--skip-umap", action="store_true", help="Skip running UMAP")
+    parser.add_argument(
+        "--minibatch",
+        action="store_true",
+        help="Use incremental PCA and minibatch k-means clustering for large datasets",
+    )
+    parser.add_argument(
+        "--umap-fit-size",
+        type=int,
+        help="Fit UMAP on a random subset of this many particles and embed the rest "
+        "with the fitted model (default: fit on all particles)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Recompute PCA, k-means and UMAP instead of reusing results cached in "
+        "[outdir]/cache by an earlier run on the same z values",
+    )
 
     group = parser.add_argument_group("Extra arguments for volume generation")
     group.add_argument(
@@ -99,12 +116,24 @@ def analyze_z1(z, outdir, vg):
     vg.gen_volumes(outdir, ztraj)
 
 
-def analyze_zN(z, outdir, vg, skip_umap=False, num_pcs=2, num_ksamples=20):
+def analyze_zN(
+    z,
+    outdir,
+    vg,
+    skip_umap=False,
+    num_pcs=2,
+    num_ksamples=20,
+    minibatch=False,
+    umap_fit_size=None,
+    cache_dir=None,
+):
     zdim = z.shape[1]
 
     # Principal component analysis
     logger.info("Performing principal component analysis...")
-    pc, pca = analysis.run_pca(z)
+    pc, pca = analysis.load_or_compute(
+        cache_dir, "pca", analysis.run_pca, z, minibatch=minibatch
+    )
     logger.info("Generating volumes...")
     for i in range(num_pcs):
         start, end = np.percentile(pc[:, i], (5, 95))
@@ -114,7 +143,9 @@ def analyze_zN(z, outdir, vg, skip_umap=False, num_pcs=2, num_ksamples=20):
     # kmeans clustering
     logger.info("K-means clustering...")
     K = num_ksamples
-    kmeans_labels, centers = analysis.cluster_kmeans(z, K)
+    kmeans_labels, centers = analysis.load_or_compute(
+        cache_dir, f"kmeans{K}", analysis.cluster_kmeans, z, K=K, minibatch=minibatch
+    )
     centers, centers_ind = analysis.get_nearest_point(z, centers)
     if not os.path.exists(f"{outdir}/kmeans{K}"):
         os.mkdir(f"{outdir}/kmeans{K}")
@@ -128,7 +159,9 @@ def analyze_zN(z, outdir, vg, skip_umap=False, num_pcs=2, num_ksamples=20):
     umap_emb = None
     if zdim > 2 and not skip_umap:
         logger.info("Running UMAP...")
-        umap_emb = analysis.run_umap(z)
+        umap_emb = analysis.load_or_compute(
+            cache_dir, "umap", analysis.run_umap, z, fit_size=umap_fit_size
+        )
         utils.save_pkl(umap_emb, f"{outdir}/umap.pkl")
 
     # Make some plots
@@ -259,6 +292,9 @@ def main(args):
             skip_umap=args.skip_umap,
             num_pcs=args.pc,
             num_ksamples=args.ksample,
+            minibatch=args.minibatch,
+            umap_fit_size=args.umap_fit_size,
+            cache_dir=None if args.no_cache else f"{outdir}/cache",
         )
 
     # copy over template if file doesn't exist
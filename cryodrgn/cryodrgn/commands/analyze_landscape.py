@@ -4,6 +4,7 @@ Pipeline to analyze cryoDRGN volume distribution
 
 import argparse
 import os
+import tempfile
 from collections import Counter
 from datetime import datetime as dt
 import logging
@@ -14,11 +15,16 @@ import seaborn as sns
 from matplotlib.colors import ListedColormap
 from scipy.ndimage.morphology import binary_dilation
 from sklearn.cluster import AgglomerativeClustering
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
+from sklearn.utils import gen_batches
 from cryodrgn import analysis, mrc, utils
 
 logger = logging.getLogger(__name__)
 
+# Masked volume matrices larger than this are kept in a memory-mapped temporary file,
+# and their PCA is fit incrementally on batches of rows of at most this size
+VOL_MATRIX_MAX_BYTES = 2**31
+
 
 def add_args(parser):
     parser.add_argument(
@@ -95,6 +101,17 @@ def add_args(parser):
     )
 
     group = parser.add_argument_group("Extra arguments for clustering")
+    group.add_argument(
+        "--minibatch",
+        action="store_true",
+        help="Sketch the distribution with minibatch k-means for large datasets",
+    )
+    group.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Recompute the k-means sketch instead of reusing the one cached in "
+        "[outdir]/cache by an earlier run on the same z values",
+    )
     group.add_argument(
         "--linkage",
         default="average",
@@ -121,10 +138,19 @@ def add_args(parser):
     return parser
 
 
-def generate_volumes(z, outdir, vg, K):
+def generate_volumes(z, outdir, vg, K, minibatch=False, cache_dir=None):
     # kmeans clustering
     logger.info("Sketching distribution...")
-    kmeans_labels, centers = analysis.cluster_kmeans(z, K, on_data=True, reorder=True)
+    kmeans_labels, centers = analysis.load_or_compute(
+        cache_dir,
+        f"kmeans{K}",
+        analysis.cluster_kmeans,
+        z,
+        K=K,
+        on_data=True,
+        reorder=True,
+        minibatch=minibatch,
+    )
     centers, centers_ind = analysis.get_nearest_point(z, centers)
     if not os.path.exists(f"{outdir}/kmeans{K}"):
         os.mkdir(f"{outdir}/kmeans{K}")
@@ -154,34 +180,105 @@ class VolumeGenerator:
         analysis.gen_volumes(self.weights, self.config, zfile, outdir, **self.vol_args)
 
 
+def get_vol_paths(outdir, K, vol_start_index=0):
+    return [f"{outdir}/kmeans{K}/vol_{vol_start_index+i:03d}.mrc" for i in range(K)]
+
+
+def volume_stats(vol_paths, q=99.99):
+    """
+    Stream volumes once to compute their statistics
+
+    Returns:
+        np.array of the q-th percentile of each volume, or None if q is None
+        np.array of the mean volume
+        np.array of the voxelwise maximum over all volumes
+    """
+    percentiles = []
+    for i, path in enumerate(vol_paths):
+        vol = mrc.parse_mrc(path)[0]
+        assert isinstance(vol, np.ndarray)
+        if q is not None:
+            percentiles.append(np.percentile(vol, q))
+        if i == 0:
+            volsum = vol.copy()
+            volmax = vol.copy()
+        else:
+            volsum += vol
+            np.maximum(volmax, vol, out=volmax)
+    volsum /= len(vol_paths)
+    return (np.array(percentiles) if q is not None else None), volsum, volmax
+
+
+def load_masked_volumes(vol_paths, mask):
+    """
+    Stream volumes into a (# volumes x # voxels in mask) matrix of their masked voxels,
+    with negative values set to zero. The matrix is kept in a memory-mapped temporary
+    file if it would take more than VOL_MATRIX_MAX_BYTES.
+    """
+    shape = (len(vol_paths), int(mask.sum()))
+    if shape[0] * shape[1] * 4 <= VOL_MATRIX_MAX_BYTES:
+        vols = np.empty(shape, dtype=np.float32)
+    else:
+        logger.info(f"Storing {shape[0]} masked volumes in a temporary file")
+        vols = np.memmap(
+            tempfile.TemporaryFile(), dtype=np.float32, mode="w+", shape=shape
+        )
+    for i, path in enumerate(vol_paths):
+        vol = mrc.parse_mrc(path)[0][mask]
+        vol[vol < 0] = 0
+        vols[i] = vol
+    return vols
+
+
+def run_volume_pca(vols, dim):
+    """
+    PCA of the rows of a masked volume matrix from load_masked_volumes. Matrices kept
+    in a temporary file are fit with IncrementalPCA, one batch of rows at a time.
+    """
+    if not isinstance(vols, np.memmap):
+        pca = PCA(dim)
+        pca.fit(vols)
+        return pca.transform(vols), pca
+
+    batch_size = max(dim, VOL_MATRIX_MAX_BYTES // vols[0].nbytes)
+    pca = IncrementalPCA(dim)
+    for batch in gen_batches(len(vols), batch_size, min_batch_size=dim):
+        pca.partial_fit(np.array(vols[batch]))
+    pc = np.concatenate(
+        [pca.transform(vols[batch]) for batch in gen_batches(len(vols), batch_size)]
+    )
+    return pc, pca
+
+
+def weighted_volume_stats(vol_paths, weights):
+    """Weighted mean and standard deviation of volumes, streamed one at a time"""
+    for i, (path, w) in enumerate(zip(vol_paths, weights)):
+        vol = mrc.parse_mrc(path)[0].astype(np.float64)
+        if i == 0:
+            wsum = np.zeros_like(vol)
+            wsum2 = np.zeros_like(vol)
+        wsum += w * vol
+        wsum2 += w * vol**2
+    mean = wsum / np.sum(weights)
+    var = wsum2 / np.sum(weights) - mean**2
+    return mean, np.maximum(var, 0) ** 0.5
+
+
 def make_mask(outdir, K, dilate, thresh, in_mrc=None, Apix=1, vol_start_index=0):
     if in_mrc is None:
+        vol_paths = get_vol_paths(outdir, K, vol_start_index)
+        percentiles, volm, volmax = volume_stats(vol_paths)
+        if not os.path.exists(f"{outdir}/kmeans{K}/vol_mean.mrc"):
+            mrc.write(f"{outdir}/kmeans{K}/vol_mean.mrc", volm, Apix=Apix)
         if thresh is None:
-            thresh = []
-            for i in range(K):
-                vol = mrc.parse_mrc(
-                    f"{outdir}/kmeans{K}/vol_{vol_start_index+i:03d}.mrc"
-                )[0]
-                assert isinstance(vol, np.ndarray)
-                thresh.append(np.percentile(vol, 99.99) / 2)
-            thresh = np.mean(thresh)
+            thresh = np.mean(percentiles / 2)
         logger.info(f"Threshold: {thresh}")
         logger.info(f"Dilating mask by: {dilate}")
 
-        def binary_mask(vol):
-            x = (vol >= thresh).astype(bool)
-            x = binary_dilation(x, iterations=dilate)
-            return x
-
-        # combine all masks by taking their union
-        vol = mrc.parse_mrc(f"{outdir}/kmeans{K}/vol_{vol_start_index:03d}.mrc")[0]
-        mask = ~binary_mask(vol)
-        for i in range(1, K):
-            vol = mrc.parse_mrc(f"{outdir}/kmeans{K}/vol_{vol_start_index+i:03d}.mrc")[
-                0
-            ]
-            mask *= ~binary_mask(vol)
-        mask = ~mask
+        # the union of the volumes' thresholded masks is the thresholded voxelwise
+        # maximum, and dilating their union is the same as taking the union of their
+        # dilations, so we only need to dilate once
+        mask = binary_dilation(volmax >= thresh, iterations=dilate)
     else:
         # Load provided mrc and convert to a boolean mask
         mask, _ = mrc.parse_mrc(in_mrc)
@@ -234,15 +331,11 @@ def analyze_volumes(
     vol_start_index=0,
 ):
     cmap = choose_cmap(M)
+    vol_paths = get_vol_paths(outdir, K, vol_start_index)
 
     # load mean volume, compute it if it does not exist
     if not os.path.exists(f"{outdir}/kmeans{K}/vol_mean.mrc"):
-        volm = np.array(
-            [
-                mrc.parse_mrc(f"{outdir}/kmeans{K}/vol_{vol_start_index+i:03d}.mrc")[0]
-                for i in range(K)
-            ]
-        ).mean(axis=0)
+        volm = volume_stats(vol_paths, q=None)[1]
         mrc.write(f"{outdir}/kmeans{K}/vol_mean.mrc", volm, Apix=Apix)
     else:
         volm = mrc.parse_mrc(f"{outdir}/kmeans{K}/vol_mean.mrc")[0]
@@ -255,30 +348,20 @@ def analyze_volumes(
     mask = mask.astype(bool)
     logger.info(f"{mask.sum()} voxels in mask")
 
-    # load volumes
-    vols = np.array(
-        [
-            mrc.parse_mrc(f"{outdir}/kmeans{K}/vol_{vol_start_index+i:03d}.mrc")[0][
-                mask
-            ]
-            for i in range(K)
-        ]
-    )
-    vols[vols < 0] = 0
-
     # load umap
     umap = utils.load_pkl(f"{outdir}/umap.pkl")
     ind = np.loadtxt(f"{outdir}/kmeans{K}/centers_ind.txt").astype(int)
 
     if vol_ind is not None:
         logger.info(f"Filtering to {len(vol_ind)} volumes")
-        vols = vols[vol_ind]
         ind = ind[vol_ind]
+        vol_paths = [vol_paths[i] for i in np.arange(K)[vol_ind]]
+
+    # load volumes
+    vols = load_masked_volumes(vol_paths, mask)
 
     # compute PCA
-    pca = PCA(dim)
-    pca.fit(vols)
-    pc = pca.transform(vols)
+    pc, pca = run_volume_pca(vols, dim)
     utils.save_pkl(pc, f"{outdir}/vol_pca_{K}.pkl")
     utils.save_pkl(pca, f"{outdir}/vol_pca_obj.pkl")
     logger.info("Explained variance ratio:")
@@ -326,16 +409,9 @@ def analyze_volumes(
         logger.info(f"State {i}: {len(vol_i)} volumes")
         if vol_ind is not None:
             vol_i = np.arange(K)[vol_ind][vol_i]
-        vol_i_all = np.array(
-            [
-                mrc.parse_mrc(f"{outdir}/kmeans{K}/vol_{vol_start_index+i:03d}.mrc")[0]
-                for i in vol_i
-            ]
-        )
-        nparticles = np.array([kmeans_counts[i] for i in vol_i])
-        vol_i_mean = np.average(vol_i_all, axis=0, weights=nparticles)
-        vol_i_std = (
-            np.average((vol_i_all - vol_i_mean) ** 2, axis=0, weights=nparticles) ** 0.5
+        vol_i_mean, vol_i_std = weighted_volume_stats(
+            [f"{outdir}/kmeans{K}/vol_{vol_start_index+i:03d}.mrc" for i in vol_i],
+            [kmeans_counts[i] for i in vol_i],
         )
         mrc.write(
             f"{subdir}/state_{i}_mean.mrc", vol_i_mean.astype(np.float32), Apix=Apix
@@ -475,7 +551,8 @@ def main(args):
         args.vol_ind = utils.load_pkl(args.vol_ind)
 
     if not args.skip_vol:
-        generate_volumes(z, outdir, vg, K)
+        cache_dir = None if args.no_cache else f"{outdir}/cache"
+        generate_volumes(z, outdir, vg, K, args.minibatch, cache_dir)
     else:
         logger.info("Skipping volume generation")
 
@@ -58,6 +58,18 @@ def add_args(parser):
         action="store_true",
         help="Skip preprocessing steps if input data is from cryodrgn preprocess_mrcs",
     )
+    group.add_argument(
+        "-b",
+        "--batch-size",
+        type=int,
+        default=32,
+        help="Number of images to backproject at a time (default: %(default)s)",
+    )
+    group.add_argument(
+        "--half-maps",
+        action="store_true",
+        help="Also write half-maps from the even and odd images to <o>_half1.mrc and <o>_half2.mrc",
+    )
 
     group = parser.add_argument_group("Tilt series options")
     group.add_argument("--tilt", help="Tilt series .mrcs image stack")
@@ -70,30 +82,46 @@ def add_args(parser):
     return parser
 
 
+# the 8 corners of a voxel, as (x, y, z) offsets from its floor
+_CORNERS = torch.tensor(
+    [[i, j, k] for i in (0, 1) for j in (0, 1) for k in (0, 1)], dtype=torch.bool
+)
+
+
 def add_slice(V, counts, ff_coord, ff, D):
+    """
+    Backproject Fourier components into the 8 voxels around their coordinates
+
+    Inputs:
+        V, counts (D x D x D tensor): volume and weights to accumulate into
+        ff_coord (... x 3 tensor): lattice coordinates of the components
+        ff (... tensor): values of the components
+    """
     d2 = int(D / 2)
-    ff_coord = ff_coord.transpose(0, 1)
-    xf, yf, zf = ff_coord.floor().long()
-    xc, yc, zc = ff_coord.ceil().long()
-
-    def add_for_corner(xi, yi, zi):
-        dist = torch.stack([xi, yi, zi]).float() - ff_coord
-        w = 1 - dist.pow(2).sum(0).pow(0.5)
-        w[w < 0] = 0
-        V[(zi + d2, yi + d2, xi + d2)] += w * ff
-        counts[(zi + d2, yi + d2, xi + d2)] += w
-
-    add_for_corner(xf, yf, zf)
-    add_for_corner(xc, yf, zf)
-    add_for_corner(xf, yc, zf)
-    add_for_corner(xf, yf, zc)
-    add_for_corner(xc, yc, zf)
-    add_for_corner(xf, yc, zc)
-    add_for_corner(xc, yf, zc)
-    add_for_corner(xc, yc, zc)
+    ff_coord = ff_coord.reshape(-1, 3)
+    ff = ff.reshape(-1)
+    xyz = torch.where(
+        _CORNERS.to(ff_coord.device)[:, None, :],
+        ff_coord.ceil().long(),
+        ff_coord.floor().long(),
+    )  # 8 x N x 3
+    dist = xyz.float() - ff_coord
+    w = (1 - dist.pow(2).sum(-1).pow(0.5)).clamp(min=0).view(-1)
+    xi, yi, zi = (xyz + d2).view(-1, 3).t()
+    ind = (zi * D + yi) * D + xi
+    # index_add_ accumulates repeated indices, unlike V[ind] += ...
+    V.view(-1).index_add_(0, ind, w * ff.repeat(8))
+    counts.view(-1).index_add_(0, ind, w)
     return V, counts
 
 
+def write_volume(out_mrc, V, counts, Apix):
+    counts = counts.clone()
+    counts[counts == 0] = 1
+    V = fft.ihtn_center((V / counts)[0:-1, 0:-1, 0:-1].cpu().numpy())
+    mrc.write(out_mrc, V.astype("float32"), Apix=Apix)
+
+
 def main(args):
     assert args.o.endswith(".mrc")
 
@@ -155,62 +183,81 @@ def main(args):
         ctf_params = None
     Apix = float(ctf_params[0, 0]) if ctf_params is not None else 1.0
 
-    V = torch.zeros((D, D, D), device=device)
-    counts = torch.zeros((D, D, D), device=device)
+    # accumulate even and odd images separately for half-maps
+    nhalf = 2 if args.half_maps else 1
+    V = torch.zeros((nhalf, D, D, D), device=device)
+    counts = torch.zeros((nhalf, D, D, D), device=device)
 
     mask = lattice.get_circular_mask(D // 2)
+    # images from the same micrograph share one CTF
+    ctf_cache = (
+        ctf.CTFCache(lattice.freqs2d[mask], ctf_params)
+        if ctf_params is not None
+        else None
+    )
 
     if args.first:
         args.first = min(args.first, Nimg)
-        iterator = range(args.first)
+        Nbp = args.first
     else:
-        iterator = range(Nimg)
+        Nbp = Nimg
 
-    for ii in iterator:
-        if ii % 100 == 0:
-            logger.info("image {}".format(ii))
-        r, t = posetracker.get_pose(ii)
-        ff = data.get(ii)
+    t2 = time.time()
+    for ii in range(0, Nbp, args.batch_size):
+        ind = torch.arange(ii, min(ii + args.batch_size, Nbp), device=device)
+        B = len(ind)
+        if ii // 1000 != (ii + B - 1) // 1000 or ii == 0:
+            logger.info(
+                "image {} ({:.1f} images/s)".format(
+                    ii, ii / max(time.time() - t2, 1e-6)
+                )
+            )
+        r, t = posetracker.get_pose(ind)
+        ff = data.get(ind.cpu().numpy())
         if tilt is not None:
             assert isinstance(ff, tuple) and len(ff) == 2
             ff, ff_tilt = ff  # EW
         else:
             ff_tilt = None
         ff = torch.tensor(ff, device=device)
-        ff = ff.view(-1)[mask]
+        ff = ff.view(B, -1)[:, mask]
         c = None
-        if ctf_params is not None:
-            freqs = lattice.freqs2d / ctf_params[ii, 0]
-            c = ctf.compute_ctf(freqs, *ctf_params[ii, 1:]).view(-1)[mask]
+        if ctf_cache is not None:
+            c = ctf_cache[ind]
             ff *= c.sign()
         if t is not None:
-            ff = lattice.translate_ht(ff.view(1, -1), t.view(1, 1, 2), mask).view(-1)
-        ff_coord = lattice.coords[mask] @ r
-        add_slice(V, counts, ff_coord, ff, D)
+            ff = lattice.translate_ht(ff, t.view(B, 1, 2), mask).view(B, -1)
+        ff_coord = lattice.coords[mask] @ r  # B x N x 3
 
         # tilt series
         if ff_tilt is not None:
             ff_tilt = torch.tensor(ff_tilt, device=device)
-            ff_tilt = ff_tilt.view(-1)[mask]
+            ff_tilt = ff_tilt.view(B, -1)[:, mask]
             if c is not None:
                 ff_tilt *= c.sign()
             if t is not None:
-                ff_tilt = lattice.translate_ht(
-                    ff_tilt.view(1, -1), t.view(1, 1, 2), mask
-                ).view(-1)
-            ff_coord = lattice.coords[mask] @ tilt @ r
-            add_slice(V, counts, ff_coord, ff_tilt, D)
+                ff_tilt = lattice.translate_ht(ff_tilt, t.view(B, 1, 2), mask).view(
+                    B, -1
+                )
+            ff = torch.cat((ff, ff_tilt), dim=1)
+            ff_coord = torch.cat((ff_coord, lattice.coords[mask] @ tilt @ r), dim=1)
+
+        for h in range(nhalf):
+            sel = ind % nhalf == h
+            add_slice(V[h], counts[h], ff_coord[sel], ff[sel], D)
 
     td = time.time() - t1
     logger.info(
-        "Backprojected {} images in {}s ({}s per image)".format(
-            len(iterator), td, td / Nimg
+        "Backprojected {} images in {:.1f}s ({:.1f} images/s)".format(
+            Nbp, td, Nbp / (time.time() - t2)
         )
     )
-    counts[counts == 0] = 1
-    V /= counts
-    V = fft.ihtn_center(V[0:-1, 0:-1, 0:-1].cpu().numpy())
-    mrc.write(args.o, V.astype("float32"), Apix=Apix)
+    write_volume(args.o, V.sum(0), counts.sum(0), Apix)
+    if args.half_maps:
+        for h in range(2):
+            write_volume(
+                f"{os.path.splitext(args.o)[0]}_half{h + 1}.mrc", V[h], counts[h], Apix
+            )
 
 
 if __name__ == "__main__":
@@ -76,7 +76,7 @@ def main(args):
     old = dataset.load_particles(args.mrcs, lazy=lazy, datadir=args.datadir)
 
     if lazy:
-        oldD = old[0].get().shape[0]
+        oldD = old.shape[0]
     else:
         assert isinstance(old, np.ndarray)
         oldD = old.shape[-1]
@@ -89,26 +89,9 @@ def main(args):
     start = int(oldD / 2 - D / 2)
     stop = int(oldD / 2 + D / 2)
 
-    def _combine_imgs(imgs):
-        ret = []
-        for img in imgs:
-            img.shape = (1, *img.shape)  # (D,D) -> (1,D,D)
-        cur = imgs[0]
-        for img in imgs[1:]:
-            if img.fname == cur.fname and img.offset == cur.offset + 4 * np.product(
-                cur.shape
-            ):
-                cur.shape = (cur.shape[0] + 1, *cur.shape[1:])
-            else:
-                ret.append(cur)
-                cur = img
-        ret.append(cur)
-        return ret
-
     def downsample_images(imgs):
         if lazy:
-            imgs = _combine_imgs(imgs)
-            imgs = np.concatenate([i.get() for i in imgs])
+            imgs = imgs.images()
         with Pool(min(args.max_threads, mp.cpu_count())) as p:
             oldft = np.asarray(p.map(fft.ht2_center, imgs))
             newft = oldft[:, start:stop, start:stop]
@@ -9,7 +9,6 @@ from datetime import datetime as dt
 import logging
 import numpy as np
 import torch
-from torch.utils.data import DataLoader
 from cryodrgn import config, ctf, dataset, utils
 from cryodrgn.commands.train_vae import loss_function, preprocess_input, run_batch
 from cryodrgn.models import HetOnlyVAE
@@ -94,6 +93,12 @@ def add_args(parser):
         action="store_true",
         help="Lazy loading if full dataset is too large to fit in memory",
     )
+    group.add_argument(
+        "--num-workers",
+        type=int,
+        default=0,
+        help="Number of worker processes preparing minibatches in the background (default: %(default)s)",
+    )
     group.add_argument(
         "--datadir",
         type=os.path.abspath,
@@ -176,13 +181,11 @@ def add_args(parser):
     return parser
 
 
-def eval_batch(
-    model, lattice, y, yt, rot, trans, beta, tilt=None, ctf_params=None, yr=None
-):
+def eval_batch(model, lattice, y, yt, rot, trans, beta, tilt=None, ctf_i=None, yr=None):
     if trans is not None:
         y, yt = preprocess_input(y, yt, lattice, trans)
     z_mu, z_logvar, z, y_recon, y_recon_tilt, mask = run_batch(
-        model, lattice, y, yt, rot, tilt, ctf_params, yr
+        model, lattice, y, yt, rot, tilt, ctf_i, yr
     )
     loss, gen_loss, kld = loss_function(
         z_mu, z_logvar, y, yt, y_recon, mask, beta, y_recon_tilt, beta_control=None
@@ -292,20 +295,24 @@ def main(args):
         ctf_params = ctf.load_ctf_for_training(D - 1, args.ctf)
         if args.ind is not None:
             ctf_params = ctf_params[ind]
-        ctf_params = torch.tensor(ctf_params, device=device)
     else:
         ctf_params = None
 
     # instantiate model
     model, lattice = HetOnlyVAE.load(cfg, args.weights, device=device)
     model.eval()
+    ctf_cache = (
+        ctf.CTFCache(lattice.freqs2d, ctf_params) if ctf_params is not None else None
+    )
     z_mu_all = []
     z_logvar_all = []
     gen_loss_accum = 0
     kld_accum = 0
     loss_accum = 0
     batch_it = 0
-    data_generator = DataLoader(data, batch_size=args.batch_size, shuffle=False)
+    data_generator = dataset.make_dataloader(
+        data, args.batch_size, num_workers=args.num_workers
+    )
     for minibatch in data_generator:
         ind = minibatch[-1].to(device)
         y = minibatch[0].to(device)
@@ -319,10 +326,10 @@ def main(args):
             yr = torch.from_numpy(data.particles_real[ind]).to(device)  # type: ignore  # PYR02
 
         rot, tran = posetracker.get_pose(ind)
-        ctf_param = ctf_params[ind] if ctf_params is not None else None
+        ctf_i = ctf_cache[ind] if ctf_cache is not None else None
 
         z_mu, z_logvar, loss, gen_loss, kld = eval_batch(
-            model, lattice, y, yt, rot, tran, beta, tilt, ctf_params=ctf_param, yr=yr
+            model, lattice, y, yt, rot, tran, beta, tilt, ctf_i=ctf_i, yr=yr
         )
 
         z_mu_all.append(z_mu)
@@ -4,12 +4,14 @@ Evaluate the decoder at specified values of z
 import argparse
 import os
 import pprint
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
 import logging
 import numpy as np
 import torch
 from cryodrgn import config, mrc, utils
-from cryodrgn.models import HetOnlyVAE
+from cryodrgn.models import FTPositionalDecoder, FTSliceDecoder, HetOnlyVAE
 
 logger = logging.getLogger(__name__)
 
@@ -64,6 +66,12 @@ def add_args(parser):
         type=int,
         help="Downsample volumes to this box size (pixels)",
     )
+    group.add_argument(
+        "--preview-radius",
+        type=int,
+        help="Only evaluate Fourier components within this radius (pixels) for quick "
+        "low-resolution previews (default: up to Nyquist)",
+    )
     group.add_argument(
         "--vol-start-index",
         type=int,
@@ -136,6 +144,57 @@ def check_inputs(args):
     ), "Must specify either -z OR --z-start/--z-end OR --zfile"
 
 
+def generate_volumes(
+    model,
+    lattice,
+    norm,
+    z,
+    out_mrcs,
+    Apix=1.0,
+    flip=False,
+    invert=False,
+    downsample=None,
+    radius=None,
+):
+    """
+    Evaluate the decoder at each row of z and write the volumes to out_mrcs
+
+    Volumes are decoded in batches of latents with eval_volumes, and written to disk
+    in a background thread while the next ones are generated. If given, Fourier
+    components beyond `radius` pixels are not evaluated.
+    """
+    assert len(z) == len(out_mrcs)
+    D = lattice.D
+    if downsample:
+        coords = lattice.get_downsample_coords(downsample + 1)
+        extent = lattice.extent * (downsample / (D - 1))
+        D = downsample + 1
+    else:
+        coords = lattice.coords
+        extent = lattice.extent
+
+    kwargs = {}
+    if radius is not None:
+        kwargs["radius"] = extent * radius / (D // 2)
+    vols = model.decoder.eval_volumes(coords, D, extent, norm, z, **kwargs)
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        pending = deque()
+        for zz, vol, out_mrc in zip(z, vols, out_mrcs):
+            logger.info(zz)
+            if flip:
+                vol = vol[::-1]
+            if invert:
+                vol *= -1
+            pending.append(
+                writer.submit(mrc.write, out_mrc, vol.astype(np.float32), Apix=Apix)
+            )
+            # bound the number of volumes held in memory waiting to be written
+            while len(pending) > 2:
+                pending.popleft().result()
+        for f in pending:
+            f.result()
+
+
 def main(args):
     if args.verbose:
         logger.setLevel(logging.DEBUG)
@@ -168,6 +227,10 @@ def main(args):
 
     model, lattice = HetOnlyVAE.load(cfg, args.weights, device=device)
     model.eval()
+    if args.preview_radius is not None:
+        assert isinstance(
+            model.decoder, (FTPositionalDecoder, FTSliceDecoder)
+        ), "--preview-radius requires a model trained with --domain fourier"
 
     # Multiple z
     if args.z_start or args.zfile:
@@ -187,52 +250,29 @@ def main(args):
         if not os.path.exists(args.o):
             os.makedirs(args.o)
 
-        logger.info(f"Generating {len(z)} volumes")
-        for i, zz in enumerate(z, start=args.vol_start_index):
-            logger.info(zz)
-            if args.downsample:
-                extent = lattice.extent * (args.downsample / (D - 1))
-                decoder = model.decoder
-                vol = decoder.eval_volume(
-                    lattice.get_downsample_coords(args.downsample + 1),
-                    args.downsample + 1,
-                    extent,
-                    norm,
-                    zz,
-                )
-            else:
-                vol = model.decoder.eval_volume(
-                    lattice.coords, lattice.D, lattice.extent, norm, zz
-                )
-            out_mrc = "{}/{}{:03d}.mrc".format(args.o, args.prefix, i)
-            if args.flip:
-                vol = vol[::-1]
-            if args.invert:
-                vol *= -1
-            mrc.write(out_mrc, vol.astype(np.float32), Apix=args.Apix)
+        out_mrcs = [
+            "{}/{}{:03d}.mrc".format(args.o, args.prefix, i)
+            for i in range(args.vol_start_index, args.vol_start_index + len(z))
+        ]
 
     # Single z
     else:
-        z = np.array(args.z)
-        logger.info(z)
-        if args.downsample:
-            extent = lattice.extent * (args.downsample / (D - 1))
-            vol = model.decoder.eval_volume(
-                lattice.get_downsample_coords(args.downsample + 1),
-                args.downsample + 1,
-                extent,
-                norm,
-                z,
-            )
-        else:
-            vol = model.decoder.eval_volume(
-                lattice.coords, lattice.D, lattice.extent, norm, z
-            )
-        if args.flip:
-            vol = vol[::-1]
-        if args.invert:
-            vol *= -1
-        mrc.write(args.o, vol.astype(np.float32), Apix=args.Apix)
+        z = np.array(args.z).reshape(1, -1)
+        out_mrcs = [args.o]
+
+    logger.info(f"Generating {len(z)} volumes")
+    generate_volumes(
+        model,
+        lattice,
+        norm,
+        z,
+        out_mrcs,
+        Apix=args.Apix,
+        flip=args.flip,
+        invert=args.invert,
+        downsample=args.downsample,
+        radius=args.preview_radius,
+    )
 
     td = dt.now() - t1
     logger.info("Finished in {}".format(td))
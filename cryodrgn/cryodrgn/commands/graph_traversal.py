@@ -4,10 +4,10 @@ Find shortest path along nearest neighbor graph
 import argparse
 import os
 import pickle
-from heapq import heappop, heappush
-
 import numpy as np
+import scipy.sparse
 import torch
+from scipy.sparse import csgraph
 
 
 def add_args(parser):
@@ -19,6 +19,12 @@ def add_args(parser):
     parser.add_argument("--avg-neighbors", type=float, default=5)
     parser.add_argument("--batch-size", type=int, default=1000)
     parser.add_argument("--max-images", type=int, default=None)
+    parser.add_argument(
+        "--approx-neighbors",
+        action="store_true",
+        help="Find nearest neighbors approximately with NN-descent (requires pynndescent), "
+        "which scales to millions of particles",
+    )
     parser.add_argument(
         "-o",
         metavar="PATH.TXT",
@@ -37,119 +43,134 @@ def add_args(parser):
 
 
 class Graph(object):
-    def __init__(self, edges):  # edges is a list of tuples (src, dest, distance)
-        # everything after here is derived from (weights, actions, probs)
-        # for computational efficiency
-
-        # FIXME: nodes and goal nodes should be the same
-        self.nodes = set([x[0] for x in edges] + [x[1] for x in edges])
-        self.edges = {x: set() for x in self.nodes}
-        self.edge_length = {}
-        for s, d, L in edges:
-            assert type(s) == int and type(d) == int and type(L) == float
-            self.edges[s].add(d)
-            self.edge_length[(s, d)] = L
+    def __init__(self, neighbors, ndist, max_dist=None):
+        """
+        Directed nearest neighbor graph, stored as a sparse CSR adjacency matrix
+
+        Inputs:
+            neighbors (N x k np.array): indices of the k nearest neighbors of each point
+            ndist (N x k np.array): distances to each of these neighbors
+            max_dist (float): only keep edges shorter than this distance
+        """
+        N, k = neighbors.shape
+        src = np.repeat(np.arange(N), k)
+        dest = neighbors.ravel()
+        dist = ndist.ravel().astype(np.float64)
+        keep = src != dest
+        if max_dist is not None:
+            keep &= dist < max_dist
+        # explicit zeros are kept as zero-length edges by csgraph
+        self.adj = scipy.sparse.csr_matrix(
+            (dist[keep], (src[keep], dest[keep])), shape=(N, N)
+        )
 
     def find_path(self, src, dest):
-        visited = set()
-        unvisited = []
-        distances = {}
-        predecessors = {}
-
-        distances[src] = 0
-        heappush(unvisited, (0, src))
-
-        while unvisited:
-            # visit the neighbors
-            dist, v = heappop(unvisited)
-            if v in visited or v not in self.edges:
+        return self.find_paths([(src, dest)])[0]
+
+    def find_paths(self, pairs):
+        """
+        Shortest paths between each (src, dest) pair, solving Dijkstra's algorithm once
+        per unique source
+
+        Returns:
+            list of (path, total distance), or (None, None) where there is no path
+        """
+        sources, src_i = np.unique([src for src, _ in pairs], return_inverse=True)
+        dists, preds = csgraph.dijkstra(
+            self.adj, directed=True, indices=sources, return_predecessors=True
+        )
+        ret = []
+        for i, (_, dest) in zip(src_i, pairs):
+            if np.isinf(dists[i, dest]):
+                ret.append((None, None))
                 continue
-            visited.add(v)
-            if v == dest:
-                # We build the shortest path and display it
-                path = []
-                pred = v
-                while pred is not None:
-                    path.append(pred)
-                    pred = predecessors.get(pred, None)
-                return path[::-1], dist
-
-            neighbors = list(self.edges[v])
-
-            for idx, neighbor in enumerate(neighbors):
-                if neighbor not in visited:
-                    new_distance = dist + self.edge_length[(v, neighbor)]
-                    if new_distance < distances.get(neighbor, float("inf")):
-                        distances[neighbor] = new_distance
-                        heappush(unvisited, (new_distance, neighbor))
-                        predecessors[neighbor] = v
-
-        # couldn't find a path
-        return None, None
+            path = [dest]
+            while preds[i, path[-1]] >= 0:
+                path.append(int(preds[i, path[-1]]))
+            ret.append((path[::-1], float(dists[i, dest])))
+        return ret
 
 
-def main(args):
-    data_np = pickle.load(open(args.data, "rb"))
-    data = torch.from_numpy(data_np)
-
-    if args.max_images is not None:
-        data = data[: args.max_images]
-
-    use_cuda = torch.cuda.is_available()
-    print(f"Use cuda {use_cuda}")
-    device = torch.device("cuda" if use_cuda else "cpu")
-    data = data.to(device)
-
-    N, D = data.shape
-    for i in args.anchors:
-        assert i < N
-    assert len(args.anchors) >= 2
+def get_nearest_neighbors(data, max_neighbors, batch_size=1000):
+    """
+    Exact k nearest neighbors (including each point itself) by batched distances
 
+    Returns:
+        ndist (N x k torch.Tensor): distances to the neighbors, in increasing order
+        neighbors (N x k torch.Tensor): neighbor indices
+    """
     n2 = (data * data).sum(-1, keepdim=True)
-    B = args.batch_size
-    ndist = torch.empty(data.shape[0], args.max_neighbors, device=device)
+    B = batch_size
+    ndist = torch.empty(data.shape[0], max_neighbors, device=data.device)
     neighbors = torch.empty(
-        data.shape[0], args.max_neighbors, dtype=torch.long, device=device
+        data.shape[0], max_neighbors, dtype=torch.long, device=data.device
     )
     for i in range(0, data.shape[0], B):
         # (a-b)^2 = a^2 + b^2 - 2ab
         print(f"Working on images {i}-{i+B}")
         batch_dist = n2[i : i + B] + n2.t() - 2 * torch.mm(data[i : i + B], data.t())
         ndist[i : i + B], neighbors[i : i + B] = batch_dist.topk(
-            args.max_neighbors, dim=-1, largest=False
+            max_neighbors, dim=-1, largest=False
         )
 
     assert ndist.min() >= -1e-3, ndist.min()
 
     # convert d^2 to d
     ndist = ndist.clamp(min=0).pow(0.5)
+    return ndist, neighbors
+
+
+def get_approx_nearest_neighbors(data, max_neighbors):
+    """Approximate k nearest neighbors (including each point itself) by NN-descent"""
+    try:
+        import pynndescent
+    except ImportError:
+        raise RuntimeError(
+            "You need to `pip install pynndescent` to run with --approx-neighbors."
+        )
+    index = pynndescent.NNDescent(data, n_neighbors=max_neighbors)
+    neighbors, ndist = index.neighbor_graph
+    return torch.from_numpy(ndist), torch.from_numpy(neighbors.astype(np.int64))
+
+
+def main(args):
+    data_np = pickle.load(open(args.data, "rb"))
+    data = torch.from_numpy(data_np)
+
+    if args.max_images is not None:
+        data = data[: args.max_images]
+        data_np = data_np[: args.max_images]
+
+    N, D = data.shape
+    for i in args.anchors:
+        assert i < N
+    assert len(args.anchors) >= 2
+
+    if args.approx_neighbors:
+        ndist, neighbors = get_approx_nearest_neighbors(data_np, args.max_neighbors)
+    else:
+        use_cuda = torch.cuda.is_available()
+        print(f"Use cuda {use_cuda}")
+        device = torch.device("cuda" if use_cuda else "cpu")
+        data = data.to(device)
+        ndist, neighbors = get_nearest_neighbors(
+            data, args.max_neighbors, args.batch_size
+        )
+
     if args.avg_neighbors:
-        total_neighbors = int(N * args.avg_neighbors)
+        total_neighbors = min(int(N * args.avg_neighbors), ndist.numel())
         max_dist = ndist.view(-1).topk(total_neighbors, largest=False)[0][-1]
+        max_dist = float(max_dist)
     else:
         max_dist = None
     print(
         f"Max dist between neighbors: {max_dist}  (to enforce average of {args.avg_neighbors} neighbors)"
     )
 
-    if max_dist is not None:
-        max_dist = max_dist.to("cpu")
-    neighbors = neighbors.to("cpu")
-    ndist = ndist.to("cpu")
-    edges = []
-    for i in range(neighbors.shape[0]):
-        for j in range(neighbors.shape[1]):
-            if max_dist is None or ndist[i, j] < max_dist:
-                edges.append((int(i), int(neighbors[i, j]), float(ndist[i, j])))
-
-    graph = Graph(edges)
+    graph = Graph(neighbors.cpu().numpy(), ndist.cpu().numpy(), max_dist)
+    pairs = list(zip(args.anchors[:-1], args.anchors[1:]))
     full_path = []
-    for i in range(len(args.anchors) - 1):
-        src, dest = args.anchors[i], args.anchors[i + 1]
-        path, total_distance = graph.find_path(src, dest)
-        dd = data[path].cpu().numpy()
-        dists = ((dd[1:, :] - dd[0:-1, :]) ** 2).sum(axis=1) ** 0.5
-
+    for path, total_distance in graph.find_paths(pairs):
         if path is not None:
             if full_path and full_path[-1] == path[0]:
                 full_path.extend(path[1:])
@@ -158,6 +179,8 @@ def main(args):
 
         print()
         if path is not None:
+            dd = data_np[path]
+            dists = ((dd[1:, :] - dd[0:-1, :]) ** 2).sum(axis=1) ** 0.5
             print("Path:")
             for id in path:
                 print(id)
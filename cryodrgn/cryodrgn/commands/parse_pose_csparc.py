@@ -50,17 +50,17 @@ def main(args):
 
     # parse rotations
     logger.info(f"Extracting rotations from {RKEY}")
-    rot = np.array([x[RKEY] for x in data])
+    rot = np.array(data[RKEY])
     rot = torch.tensor(rot)
     rot = lie_tools.expmap(rot)
     rot = rot.numpy()
     logger.info("Transposing rotation matrix")
-    rot = np.array([x.T for x in rot])
+    rot = np.ascontiguousarray(rot.transpose(0, 2, 1))
     logger.info(rot.shape)
 
     # parse translations
     logger.info(f"Extracting translations from {TKEY}")
-    trans = np.array([x[TKEY] for x in data])
+    trans = np.array(data[TKEY])
     if args.hetrefine:
         logger.info("Scaling shifts by 2x")
         trans *= 2
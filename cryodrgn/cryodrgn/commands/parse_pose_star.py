@@ -53,8 +53,7 @@ def main(args):
     logger.info("Euler angles (Rot, Tilt, Psi):")
     logger.info(euler[0])
     logger.info("Converting to rotation matrix:")
-    rot = np.asarray([utils.R_from_relion(*x) for x in euler])
-
+    rot = utils.R_from_relion(euler[:, 0], euler[:, 1], euler[:, 2])
     logger.info(rot[0])
 
     # parse translations
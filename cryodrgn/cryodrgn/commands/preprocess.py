@@ -12,8 +12,7 @@ except ImportError:
 import math
 import multiprocessing as mp
 import os
-from multiprocessing import Pool
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
 import logging
 from cryodrgn import dataset, fft, mrc, utils
 
@@ -61,6 +60,12 @@ def add_args(parser):
         help="Turn off real space windowing of dataset",
     )
 
+    group.add_argument(
+        "--float16",
+        action="store_true",
+        help="Store the preprocessed images in half precision (halves disk usage)",
+    )
+
     group = parser.add_argument_group("Extra arguments for volume generation")
     group.add_argument(
         "-b",
@@ -124,11 +129,11 @@ def main(args):
     if args.ind is not None:
         logger.info(f"Filtering image dataset with {args.ind}")
         ind = utils.load_pkl(args.ind).astype(int)
-        images = [images[i] for i in ind] if lazy else images[ind]
+        images = images[ind]
 
     if lazy:
-        assert isinstance(images, List)
-        original_D = images[0].get().shape[0]
+        assert isinstance(images, mrc.MMapImageStack)
+        original_D = images.shape[0]
     else:
         assert isinstance(images, np.ndarray)
         original_D = images.shape[-1]
@@ -149,90 +154,93 @@ def main(args):
     else:
         D = original_D
 
-    def _combine_imgs(imgs):
-        ret = []
-        for img in imgs:
-            img.shape = (1, *img.shape)  # (D,D) -> (1,D,D)
-        cur = imgs[0]
-        for img in imgs[1:]:
-            if img.fname == cur.fname and img.offset == cur.offset + 4 * np.product(
-                cur.shape
-            ):
-                cur.shape = (cur.shape[0] + 1, *cur.shape[1:])
-            else:
-                ret.append(cur)
-                cur = img
-        ret.append(cur)
-        return ret
-
     def preprocess_numpy(imgs):
-        if lazy:
-            imgs = _combine_imgs(imgs)
-            imgs = np.concatenate([i.get() for i in imgs])
-        with Pool(min(args.max_threads, mp.cpu_count())) as p:
-            # todo: refactor as a routine in dataset.py
-
-            # note: applying the window before downsampling is slightly
-            # different than in the original workflow
-            if window:
-                imgs *= dataset.window_mask(
-                    original_D, args.window_r, 0.99, use_cupy=False
-                )
-            ret = np.asarray(p.map(fft.ht2_center, imgs))
-            if invert_data:
-                ret *= -1
-            if downsample:
-                ret = ret[:, start:stop, start:stop]
-            ret = fft.symmetrize_ht(ret)
+        imgs = imgs.images() if lazy else imgs.copy()
+        # note: applying the window before downsampling is slightly
+        # different than in the original workflow
+        if window:
+            imgs *= dataset.window_mask(original_D, args.window_r, 0.99, use_cupy=False)
+        # batched FFTs over sub-batches in threads; no pickling of images to workers
+        nthreads = max(1, min(args.max_threads, mp.cpu_count(), len(imgs)))
+        with ThreadPoolExecutor(nthreads) as executor:
+            ret = np.concatenate(
+                list(executor.map(fft.ht2_center, np.array_split(imgs, nthreads)))
+            )
+        if invert_data:
+            ret *= -1
+        if downsample:
+            ret = ret[:, start:stop, start:stop]
         return ret
 
     def preprocess_cupy(imgs):
-        imgs = cp.asarray(imgs)
         if lazy:
-            imgs = _combine_imgs(imgs)
-            imgs = cp.concatenate([cp.asarray(i.get()) for i in imgs])
+            imgs = imgs.images()
+        imgs = cp.asarray(imgs, dtype=cp.float32)
         if window:
             imgs *= dataset.window_mask(original_D, args.window_r, 0.99, use_cupy=True)
-
-        ret = cp.asarray([fft.ht2_center(img) for img in imgs])
+        ret = fft.ht2_center(imgs)
         if invert_data:
             ret *= -1
         if downsample:
             ret = ret[:, start:stop, start:stop]
-        ret = fft.symmetrize_ht(ret)
-        return ret
+        return cp.asnumpy(ret)  # type: ignore
 
-    def preprocess_in_batches(imgs, b, use_cupy=False):
-        ret = np.empty((len(imgs), D + 1, D + 1), dtype=np.float32)
+    def preprocess_in_batches(imgs, out, b, use_cupy=False):
+        # symmetrize directly into the (N, D+1, D+1) memory-mapped output
         Nbatches = math.ceil(len(imgs) / b)
         for ii in range(Nbatches):
             logger.info(f"Processing batch of {b} images ({ii+1} of {Nbatches})")
-            if use_cupy:
-                ret[ii * b : (ii + 1) * b, :, :] = cp.asnumpy(  # type: ignore
-                    preprocess_cupy(imgs[ii * b : (ii + 1) * b])
-                )
-            else:
-                ret[ii * b : (ii + 1) * b, :, :] = preprocess_numpy(
-                    imgs[ii * b : (ii + 1) * b]
+            batch = imgs[ii * b : (ii + 1) * b]
+            ht = preprocess_cupy(batch) if use_cupy else preprocess_numpy(batch)
+            if out.dtype == np.float16 and np.abs(ht).max() > np.finfo(np.float16).max:
+                raise RuntimeError(
+                    "Hartley transformed images overflow float16, rerun without --float16"
                 )
-        return ret
-
+            sym_ht = out[ii * b : (ii + 1) * b]
+            sym_ht[:, 0:-1, 0:-1] = ht
+            fft.symmetrize_ht(sym_ht, preallocated=True)
+            stats.update(sym_ht)
+
+    dtype = np.float16 if args.float16 else np.float32
+    # normalization statistics are accumulated in the same pass and cached in the index
+    stats = dataset.RunningStats()
     nchunks = math.ceil(len(images) / args.chunk)
     out_mrcs = [f".{i}.ft".join(os.path.splitext(args.o)) for i in range(nchunks)]
     chunk_names = [os.path.basename(x) for x in out_mrcs]
+    chunk_sizes = []
     for i in range(nchunks):
         logger.info(f"Processing chunk {i+1} of {nchunks}")
         chunk = images[i * args.chunk : (i + 1) * args.chunk]
-        new = preprocess_in_batches(chunk, args.b, use_cupy=args.use_cupy)
-        logger.info(f"New shape: {new.shape}")
-        logger.info(f"Saving {out_mrcs[i]}")
-        mrc.write(out_mrcs[i], new, is_vol=False)
+        logger.info(f"Writing {out_mrcs[i]}")
+        out = mrc.allocate_stack(out_mrcs[i], (len(chunk), D + 1, D + 1), dtype)
+        preprocess_in_batches(chunk, out, args.b, use_cupy=args.use_cupy)
+        out.flush()
+        logger.info(f"New shape: {out.shape}")
+        chunk_sizes.append(len(chunk))
+        del out
 
     out_txt = f"{os.path.splitext(args.o)[0]}.ft.txt"
     logger.info(f"Saving summary txt file {out_txt}")
     with open(out_txt, "w") as f:
         f.write("\n".join(chunk_names))
 
+    out_meta = dataset.preprocessed_meta_path(out_txt)
+    logger.info(f"Saving index {out_meta}")
+    meta = dict(
+        particles=args.mrcs,
+        ind=args.ind,
+        chunks=chunk_names,
+        chunk_sizes=chunk_sizes,
+        D=D + 1,
+        dtype=np.dtype(dtype).name,
+        invert_data=invert_data,
+        window=window,
+        window_r=args.window_r,
+        norm=[0, stats.std],
+    )
+    logger.info("Normalization: {} +/- {}".format(*meta["norm"]))
+    utils.save_pkl(meta, out_meta)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
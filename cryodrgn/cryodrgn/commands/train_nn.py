@@ -12,7 +12,6 @@ import torch
 import torch.nn as nn
 from torch.nn.parallel import DataParallel
 import torch.nn.functional as F
-from torch.utils.data import DataLoader
 
 try:
     import apex.amp as amp  # type: ignore
@@ -97,6 +96,25 @@ def add_args(parser):
         action="store_true",
         help="Lazy loading if full dataset is too large to fit in memory",
     )
+    group.add_argument(
+        "--ctf-cache-gb",
+        type=float,
+        default=ctf.CTF_CACHE_MAX_BYTES / 2**30,
+        help="Largest table of precomputed CTFs kept on the training device in GB; "
+        "larger tables are kept in a temporary file (default: %(default)s)",
+    )
+    group.add_argument(
+        "--ctf-cache-dtype",
+        choices=("float32", "float16"),
+        default="float32",
+        help="Storage precision of the precomputed CTFs (default: %(default)s)",
+    )
+    group.add_argument(
+        "--num-workers",
+        type=int,
+        default=0,
+        help="Number of worker processes preparing minibatches in the background (default: %(default)s)",
+    )
     group.add_argument(
         "--datadir",
         type=os.path.abspath,
@@ -231,19 +249,37 @@ def add_args(parser):
 
 
 def save_checkpoint(
-    model: Decoder, lattice, optim, epoch, norm, Apix, out_mrc, out_weights
+    model: Decoder,
+    lattice,
+    optim,
+    epoch,
+    norm,
+    Apix,
+    out_mrc,
+    out_weights,
+    writer=None,
 ):
+    """
+    Save the reconstructed volume and model weights, in the background if given a
+    utils.CheckpointWriter (after waiting for its previous checkpoint to finish)
+    """
+    if writer is None:
+        writer = utils.CheckpointWriter(background=False)
+    writer.wait()
     model.eval()
     vol = model.eval_volume(lattice.coords, lattice.D, lattice.extent, norm)
-    mrc.write(out_mrc, vol.astype(np.float32), Apix=Apix)
-    torch.save(
+    writer.write(
+        out_mrc, lambda x, path: mrc.write(path, x, Apix=Apix), vol.astype(np.float32)
+    )
+    writer.write(
+        out_weights,
+        torch.save,
         {
             "norm": norm,
             "epoch": epoch,
             "model_state_dict": model.state_dict(),
             "optimizer_state_dict": optim.state_dict(),
         },
-        out_weights,
     )
 
 
@@ -254,7 +290,7 @@ def train(
     y,
     rot,
     trans=None,
-    ctf_params=None,
+    ctf_i=None,
     use_amp=False,
     scaler=None,
 ):
@@ -268,12 +304,8 @@ def train(
         # reconstruct circle of pixels instead of whole image
         mask = lattice.get_circular_mask(D // 2)
         yhat = model(lattice.coords[mask] @ rot).view(B, -1)
-        if ctf_params is not None:
-            freqs = lattice.freqs2d[mask]
-            freqs = freqs.unsqueeze(0).expand(B, *freqs.shape) / ctf_params[:, 0].view(
-                B, 1, 1
-            )
-            yhat *= ctf.compute_ctf(freqs, *torch.split(ctf_params[:, 1:], 1, 1))
+        if ctf_i is not None:
+            yhat *= ctf_i
         y = y.view(B, -1)[:, mask]
         if trans is not None:
             y = lattice.translate_ht(y, trans.unsqueeze(1), mask).view(B, -1)
@@ -467,6 +499,17 @@ def main(args):
     else:
         ctf_params = None
     Apix = ctf_params[0, 0] if ctf_params is not None else 1
+    # CTFs are computed once per particle (or per micrograph) and reused every epoch
+    ctf_cache = (
+        ctf.CTFCache(
+            lattice.freqs2d[lattice.get_circular_mask(D // 2)],
+            ctf_params,
+            dtype=getattr(torch, args.ctf_cache_dtype),
+            max_bytes=int(args.ctf_cache_gb * 2**30),
+        )
+        if ctf_params is not None
+        else None
+    )
 
     # save configuration
     out_config = f"{args.outdir}/config.pkl"
@@ -501,8 +544,11 @@ def main(args):
         )
 
     # train
-    data_generator = DataLoader(data, batch_size=args.batch_size, shuffle=True)
+    data_generator = dataset.make_dataloader(
+        data, args.batch_size, shuffle=True, num_workers=args.num_workers
+    )
     epoch = None
+    writer = utils.CheckpointWriter()
     for epoch in range(start_epoch, args.num_epochs):
         t2 = dt.now()
         loss_accum = 0
@@ -513,7 +559,7 @@ def main(args):
             if pose_optimizer is not None:
                 pose_optimizer.zero_grad()
             r, t = posetracker.get_pose(ind)
-            c = ctf_params[ind] if ctf_params is not None else None
+            c = ctf_cache[ind] if ctf_cache is not None else None
             loss_item = train(
                 model,
                 lattice,
@@ -543,7 +589,15 @@ def main(args):
             out_mrc = "{}/reconstruct.{}.mrc".format(args.outdir, epoch)
             out_weights = "{}/weights.{}.pkl".format(args.outdir, epoch)
             save_checkpoint(
-                model, lattice, optim, epoch, data.norm, Apix, out_mrc, out_weights
+                model,
+                lattice,
+                optim,
+                epoch,
+                data.norm,
+                Apix,
+                out_mrc,
+                out_weights,
+                writer,
             )
             if args.do_pose_sgd and epoch >= args.pretrain:
                 out_pose = "{}/pose.{}.pkl".format(args.outdir, epoch)
@@ -552,7 +606,10 @@ def main(args):
     # save model weights and evaluate the model on 3D lattice
     out_mrc = "{}/reconstruct.mrc".format(args.outdir)
     out_weights = "{}/weights.pkl".format(args.outdir)
-    save_checkpoint(model, lattice, optim, epoch, data.norm, Apix, out_mrc, out_weights)
+    save_checkpoint(
+        model, lattice, optim, epoch, data.norm, Apix, out_mrc, out_weights, writer
+    )
+    writer.wait()
     if args.do_pose_sgd and epoch >= args.pretrain:
         out_pose = "{}/pose.pkl".format(args.outdir)
         posetracker.save(out_pose)
@@ -12,7 +12,6 @@ import torch
 import torch.nn as nn
 from torch.nn.parallel import DataParallel
 import torch.nn.functional as F
-from torch.utils.data import DataLoader
 
 try:
     import apex.amp as amp  # type: ignore  # PYR01
@@ -20,7 +19,7 @@ except ImportError:
     pass
 
 import cryodrgn
-from cryodrgn import ctf, dataset, utils
+from cryodrgn import ctf, dataset, distributed, utils
 from cryodrgn.beta_schedule import get_beta_schedule
 from cryodrgn.lattice import Lattice
 from cryodrgn.models import HetOnlyVAE, unparallelize
@@ -60,6 +59,12 @@ def add_args(parser):
         default=1,
         help="Checkpointing interval in N_EPOCHS (default: %(default)s)",
     )
+    parser.add_argument(
+        "--checkpoint-eval-z",
+        action="store_true",
+        help="Re-encode all images at each checkpoint instead of saving the z "
+        "computed while training on them during the epoch",
+    )
     parser.add_argument(
         "--log-interval",
         type=int,
@@ -108,11 +113,30 @@ def add_args(parser):
         action="store_true",
         help="Lazy loading if full dataset is too large to fit in memory (Should copy dataset to SSD)",
     )
+    group.add_argument(
+        "--ctf-cache-gb",
+        type=float,
+        default=ctf.CTF_CACHE_MAX_BYTES / 2**30,
+        help="Largest table of precomputed CTFs kept on the training device in GB; "
+        "larger tables are kept in a temporary file (default: %(default)s)",
+    )
+    group.add_argument(
+        "--ctf-cache-dtype",
+        choices=("float32", "float16"),
+        default="float32",
+        help="Storage precision of the precomputed CTFs (default: %(default)s)",
+    )
     group.add_argument(
         "--preprocessed",
         action="store_true",
         help="Skip preprocessing steps if input data is from cryodrgn preprocess_mrcs",
     )
+    group.add_argument(
+        "--precenter",
+        action="store_true",
+        help="Translate the images by their poses once when loading them instead of "
+        "in every batch (requires in-memory data and fixed poses)",
+    )
     group.add_argument(
         "--num-workers-per-gpu",
         type=int,
@@ -190,6 +214,14 @@ def add_args(parser):
         action="store_true",
         help="Parallelize training across all detected GPUs",
     )
+    group.add_argument(
+        "--num-processes",
+        type=int,
+        default=1,
+        help="Train with this many processes on this node, each on its share of the "
+        "images with a batch size of -b (default: %(default)s). To train across nodes, "
+        "launch with torchrun instead",
+    )
 
     group = parser.add_argument_group("Pose SGD")
     group.add_argument(
@@ -312,7 +344,7 @@ def train_batch(
     beta,
     beta_control=None,
     tilt=None,
-    ctf_params=None,
+    ctf_i=None,
     yr=None,
     use_amp=False,
     scaler=None,
@@ -325,14 +357,14 @@ def train_batch(
     if scaler is not None:
         with torch.cuda.amp.autocast_mode.autocast():
             z_mu, z_logvar, z, y_recon, y_recon_tilt, mask = run_batch(
-                model, lattice, y, yt, rot, tilt, ctf_params, yr
+                model, lattice, y, yt, rot, tilt, ctf_i, yr
             )
             loss, gen_loss, kld = loss_function(
                 z_mu, z_logvar, y, yt, y_recon, mask, beta, y_recon_tilt, beta_control
             )
     else:
         z_mu, z_logvar, z, y_recon, y_recon_tilt, mask = run_batch(
-            model, lattice, y, yt, rot, tilt, ctf_params, yr
+            model, lattice, y, yt, rot, tilt, ctf_i, yr
         )
         loss, gen_loss, kld = loss_function(
             z_mu, z_logvar, y, yt, y_recon, mask, beta, y_recon_tilt, beta_control
@@ -340,16 +372,22 @@ def train_batch(
     if use_amp:
         if scaler is not None:  # torch mixed precision
             scaler.scale(loss).backward()
+            if distributed.is_initialized():
+                distributed.all_reduce_grads(model)
             scaler.step(optim)
             scaler.update()
         else:  # apex.amp mixed precision
             with amp.scale_loss(loss, optim) as scaled_loss:
                 scaled_loss.backward()
+            if distributed.is_initialized():
+                distributed.all_reduce_grads(model)
             optim.step()
     else:
         loss.backward()
+        if distributed.is_initialized():
+            distributed.all_reduce_grads(model)
         optim.step()
-    return loss.item(), gen_loss.item(), kld.item()
+    return loss.item(), gen_loss.item(), kld.item(), z_mu.detach(), z_logvar.detach()
 
 
 def preprocess_input(y, yt, lattice, trans):
@@ -362,17 +400,29 @@ def preprocess_input(y, yt, lattice, trans):
     return y, yt
 
 
-def run_batch(model, lattice, y, yt, rot, tilt=None, ctf_params=None, yr=None):
+def precenter_images(data, lattice, trans, batch_size=1000):
+    """
+    Translate the images of an in-memory dataset by their (fixed) translations in
+    place, so that they no longer need to be centered in every batch of every epoch
+    """
+    stacks = [data.particles]
+    if hasattr(data, "particles_tilt"):
+        stacks.append(data.particles_tilt)
+    D = lattice.D
+    for i in range(0, data.N, batch_size):
+        t = trans[i : i + batch_size].unsqueeze(1)
+        for x in stacks:
+            y = torch.from_numpy(x[i : i + batch_size]).to(trans.device)
+            y = lattice.translate_ht(y.view(len(y), -1), t).view(-1, D, D)
+            x[i : i + batch_size] = y.cpu().numpy()
+
+
+def run_batch(model, lattice, y, yt, rot, tilt=None, ctf_i=None, yr=None):
+    """ctf_i: CTFs of the images in the batch (B x D^2), e.g. from a ctf.CTFCache"""
     use_tilt = yt is not None
-    use_ctf = ctf_params is not None
     B = y.size(0)
     D = lattice.D
-    c = None
-    if use_ctf:
-        freqs = lattice.freqs2d.unsqueeze(0).expand(
-            B, *lattice.freqs2d.shape
-        ) / ctf_params[:, 0].view(B, 1, 1)
-        c = ctf.compute_ctf(freqs, *torch.split(ctf_params[:, 1:], 1, 1)).view(B, D, D)
+    c = ctf_i.view(B, D, D) if ctf_i is not None else None
 
     # encode
     if yr is not None:
@@ -434,27 +484,24 @@ def eval_z(
     device,
     trans=None,
     use_tilt=False,
-    ctf_params=None,
+    ctf_cache=None,
     use_real=False,
 ):
     assert not model.training
     z_mu_all = []
     z_logvar_all = []
-    data_generator = DataLoader(data, batch_size=batch_size, shuffle=False)
+    ind_all = []
+    data_generator = dataset.make_dataloader(
+        data, batch_size, distributed=distributed.is_initialized()
+    )
     for minibatch in data_generator:
         ind = minibatch[-1]
+        ind_all.append(ind)
         y = minibatch[0].to(device)
         yt = minibatch[1].to(device) if use_tilt else None
         B = len(ind)
         D = lattice.D
-        c = None
-        if ctf_params is not None:
-            freqs = lattice.freqs2d.unsqueeze(0).expand(
-                B, *lattice.freqs2d.shape
-            ) / ctf_params[ind, 0].view(B, 1, 1)
-            c = ctf.compute_ctf(freqs, *torch.split(ctf_params[ind, 1:], 1, 1)).view(
-                B, D, D
-            )
+        c = ctf_cache[ind].view(B, D, D) if ctf_cache is not None else None
         if trans is not None:
             y = lattice.translate_ht(y.view(B, -1), trans[ind].unsqueeze(1)).view(
                 B, D, D
@@ -477,24 +524,48 @@ def eval_z(
         z_logvar_all.append(z_logvar.detach().cpu().numpy())
     z_mu_all = np.vstack(z_mu_all)
     z_logvar_all = np.vstack(z_logvar_all)
+    if distributed.is_initialized():
+        # each process encoded a share of the images
+        z_mu_all, z_logvar_all = (
+            x.numpy()
+            for x in distributed.gather_rows(
+                torch.cat(ind_all),
+                data.N,
+                torch.from_numpy(z_mu_all),
+                torch.from_numpy(z_logvar_all),
+            )
+        )
     return z_mu_all, z_logvar_all
 
 
-def save_checkpoint(model, optim, epoch, z_mu, z_logvar, out_weights, out_z):
-    """Save model weights, latent encoding z, and decoder volumes"""
+def _write_z(z, out_z):
+    with open(out_z, "wb") as f:
+        for x in z:
+            pickle.dump(x, f)
+
+
+def save_checkpoint(
+    model, optim, epoch, z_mu, z_logvar, out_weights, out_z, writer=None
+):
+    """
+    Save model weights and latent encoding z, in the background if given a
+    utils.CheckpointWriter (after waiting for its previous checkpoint to finish)
+    """
+    if writer is None:
+        writer = utils.CheckpointWriter(background=False)
+    writer.wait()
     # save model weights
-    torch.save(
+    writer.write(
+        out_weights,
+        torch.save,
         {
             "epoch": epoch,
             "model_state_dict": unparallelize(model).state_dict(),
             "optimizer_state_dict": optim.state_dict(),
         },
-        out_weights,
     )
     # save z
-    with open(out_z, "wb") as f:
-        pickle.dump(z_mu, f)
-        pickle.dump(z_logvar, f)
+    writer.write(out_z, _write_z, (z_mu, z_logvar))
 
 
 def save_config(args, dataset, lattice, model, out_config):
@@ -554,14 +625,23 @@ def get_latest(args):
 
 
 def main(args):
+    if args.num_processes > 1 and not distributed.is_launched():
+        distributed.spawn(main, args, args.num_processes)
+        return
+    is_distributed = distributed.is_launched()
+    if is_distributed:
+        distributed.init(torch.device("cuda" if torch.cuda.is_available() else "cpu"))
+    is_main = distributed.is_main_process()
+    world_size = distributed.get_world_size()
+
     if args.verbose:
         logger.setLevel(logging.DEBUG)
 
     t1 = dt.now()
-    if args.outdir is not None and not os.path.exists(args.outdir):
-        os.makedirs(args.outdir)
-
-    logger.addHandler(logging.FileHandler(f"{args.outdir}/run.log"))
+    if is_main:
+        if args.outdir is not None and not os.path.exists(args.outdir):
+            os.makedirs(args.outdir)
+        logger.addHandler(logging.FileHandler(f"{args.outdir}/run.log"))
 
     if args.load == "latest":
         args = get_latest(args)
@@ -570,7 +650,7 @@ def main(args):
 
     # set the random seed
     np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
+    torch.manual_seed(args.seed + distributed.get_rank())
 
     # set the device
     use_cuda = torch.cuda.is_available()
@@ -665,6 +745,7 @@ def main(args):
         assert (
             args.domain == "hartley"
         ), "Need to use --domain hartley if doing pose SGD"
+        assert not is_distributed, "Pose SGD is not supported with multiple processes"
     do_pose_sgd = args.do_pose_sgd
     posetracker = PoseTracker.load(
         args.poses, Nimg, D, "s2s2" if do_pose_sgd else None, ind, device=device
@@ -686,12 +767,31 @@ def main(args):
         if args.ind is not None:
             ctf_params = ctf_params[ind]
         assert ctf_params.shape == (Nimg, 8)
-        ctf_params = torch.tensor(ctf_params, device=device)  # Nx8
     else:
         ctf_params = None
 
     # instantiate model
     lattice = Lattice(D, extent=0.5, device=device)
+    trans = posetracker.trans
+    if args.precenter and trans is not None:
+        assert not do_pose_sgd, "--precenter requires fixed poses (no --do-pose-sgd)"
+        assert isinstance(
+            data.particles, np.ndarray
+        ), "--precenter requires the dataset to be loaded in memory (no --lazy)"
+        logger.info("Centering images by their translations")
+        precenter_images(data, lattice, trans, args.batch_size)
+        trans = None
+    # CTFs are computed once per particle (or per micrograph) and reused every epoch
+    ctf_cache = (
+        ctf.CTFCache(
+            lattice.freqs2d,
+            ctf_params,
+            dtype=getattr(torch, args.ctf_cache_dtype),
+            max_bytes=int(args.ctf_cache_gb * 2**30),
+        )
+        if ctf_params is not None
+        else None
+    )
     if args.enc_mask is None:
         args.enc_mask = D // 2
     if args.enc_mask > 0:
@@ -741,8 +841,9 @@ def main(args):
     )
 
     # save configuration
-    out_config = "{}/config.pkl".format(args.outdir)
-    save_config(args, data, lattice, model, out_config)
+    if is_main:
+        out_config = "{}/config.pkl".format(args.outdir)
+        save_config(args, data, lattice, model, out_config)
 
     optim = torch.optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.wd)
 
@@ -787,7 +888,11 @@ def main(args):
 
     # parallelize
     num_workers_per_gpu = args.num_workers_per_gpu
-    if args.multigpu and torch.cuda.device_count() > 1:
+    if is_distributed:
+        assert not args.multigpu, "Use one process per GPU instead of --multigpu"
+        # start all processes from the same weights
+        distributed.broadcast_parameters(model)
+    elif args.multigpu and torch.cuda.device_count() > 1:
         logger.info(f"Using {torch.cuda.device_count()} GPUs!")
         args.batch_size *= torch.cuda.device_count()
         cpu_count = os.cpu_count() or 1
@@ -801,23 +906,34 @@ def main(args):
         )
 
     # training loop
-    data_generator = DataLoader(
-        data, batch_size=args.batch_size, shuffle=True, num_workers=num_workers_per_gpu
+    data_generator = dataset.make_dataloader(
+        data,
+        args.batch_size,
+        shuffle=True,
+        num_workers=num_workers_per_gpu,
+        distributed=is_distributed,
     )
     num_epochs = args.num_epochs
     epoch = None
+    # latent encodings of each image from the last time it was trained on
+    z_mu_all = torch.zeros((Nimg, args.zdim), device=device)
+    z_logvar_all = torch.zeros((Nimg, args.zdim), device=device)
+    writer = utils.CheckpointWriter()
     for epoch in range(start_epoch, num_epochs):
         t2 = dt.now()
         gen_loss_accum = 0
         loss_accum = 0
         kld_accum = 0
         batch_it = 0
+        epoch_ind = []
+        if is_distributed:
+            data_generator.sampler.sampler.set_epoch(epoch)
         for minibatch in data_generator:  # minibatch: [y, ind]
             ind = minibatch[-1].to(device)
             y = minibatch[0].to(device)
             yt = minibatch[1].to(device) if tilt is not None else None
             B = len(ind)
-            batch_it += B
+            batch_it += B * world_size
             global_it = Nimg * epoch + batch_it
 
             beta = beta_schedule(global_it)
@@ -829,8 +945,10 @@ def main(args):
             if pose_optimizer is not None:
                 pose_optimizer.zero_grad()
             rot, tran = posetracker.get_pose(ind)
-            ctf_param = ctf_params[ind] if ctf_params is not None else None
-            loss, gen_loss, kld = train_batch(
+            if trans is None:  # no translations, or the images are already centered
+                tran = None
+            ctf_i = ctf_cache[ind] if ctf_cache is not None else None
+            loss, gen_loss, kld, z_mu, z_logvar = train_batch(
                 model,
                 lattice,
                 y,
@@ -841,13 +959,16 @@ def main(args):
                 beta,
                 args.beta_control,
                 tilt,
-                ctf_params=ctf_param,
+                ctf_i=ctf_i,
                 yr=yr,
                 use_amp=args.amp,
                 scaler=scaler,
             )
             if pose_optimizer is not None and epoch >= args.pretrain:
                 pose_optimizer.step()
+            z_mu_all.index_copy_(0, ind, z_mu.float())
+            z_logvar_all.index_copy_(0, ind, z_logvar.float())
+            epoch_ind.append(ind)
 
             # logging
             gen_loss_accum += gen_loss * B
@@ -861,6 +982,10 @@ def main(args):
                         epoch + 1, num_epochs, batch_it, Nimg, gen_loss, kld, beta, loss
                     )
                 )
+        if is_distributed:
+            gen_loss_accum, kld_accum, loss_accum = distributed.all_reduce_sum(
+                [gen_loss_accum, kld_accum, loss_accum]
+            )
         logger.info(
             "# =====> Epoch: {} Average gen loss = {:.6}, KLD = {:.6f}, total loss = {:.6f}; Finished in {}".format(
                 epoch + 1,
@@ -874,20 +999,32 @@ def main(args):
         if args.checkpoint and epoch % args.checkpoint == 0:
             out_weights = "{}/weights.{}.pkl".format(args.outdir, epoch)
             out_z = "{}/z.{}.pkl".format(args.outdir, epoch)
-            model.eval()
-            with torch.no_grad():
-                z_mu, z_logvar = eval_z(
-                    model,
-                    lattice,
-                    data,
-                    args.batch_size,
-                    device,
-                    posetracker.trans,
-                    tilt is not None,
-                    ctf_params,
-                    args.use_real,
+            if args.checkpoint_eval_z:
+                model.eval()
+                with torch.no_grad():
+                    z_mu, z_logvar = eval_z(
+                        model,
+                        lattice,
+                        data,
+                        args.batch_size,
+                        device,
+                        trans,
+                        tilt is not None,
+                        ctf_cache,
+                        args.use_real,
+                    )
+            else:
+                if is_distributed:
+                    # each process trained on a share of the images this epoch
+                    epoch_ind = torch.cat(epoch_ind)
+                    z_mu_all, z_logvar_all = distributed.gather_rows(
+                        epoch_ind, Nimg, z_mu_all[epoch_ind], z_logvar_all[epoch_ind]
+                    )
+                z_mu, z_logvar = z_mu_all.cpu().numpy(), z_logvar_all.cpu().numpy()
+            if is_main:
+                save_checkpoint(
+                    model, optim, epoch, z_mu, z_logvar, out_weights, out_z, writer
                 )
-                save_checkpoint(model, optim, epoch, z_mu, z_logvar, out_weights, out_z)
             if args.do_pose_sgd and epoch >= args.pretrain:
                 out_pose = "{}/pose.{}.pkl".format(args.outdir, epoch)
                 posetracker.save(out_pose)
@@ -903,12 +1040,15 @@ def main(args):
             data,
             args.batch_size,
             device,
-            posetracker.trans,
+            trans,
             tilt is not None,
-            ctf_params,
+            ctf_cache,
             args.use_real,
         )
-        save_checkpoint(model, optim, epoch, z_mu, z_logvar, out_weights, out_z)
+    if is_main:
+        save_checkpoint(model, optim, epoch, z_mu, z_logvar, out_weights, out_z, writer)
+    writer.wait()
+    distributed.cleanup()
 
     if args.do_pose_sgd and epoch >= args.pretrain:
         out_pose = "{}/pose.pkl".format(args.outdir)
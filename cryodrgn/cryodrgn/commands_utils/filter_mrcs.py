@@ -2,8 +2,7 @@
 
 import argparse
 import logging
-import numpy as np
-from cryodrgn import dataset, mrc, utils
+from cryodrgn import dataset, stack_transform, utils
 
 logger = logging.getLogger(__name__)
 
@@ -11,6 +10,12 @@ logger = logging.getLogger(__name__)
 def add_args(parser):
     parser.add_argument("input", help="Input particles (.mrcs, .txt, .star, .cs)")
     parser.add_argument("--ind", required=True, help="Selected indices array (.pkl)")
+    parser.add_argument(
+        "-b",
+        type=int,
+        default=1000,
+        help="Number of images to read and write at a time (default: %(default)s)",
+    )
     parser.add_argument("-o", help="Output .mrcs file")
     return parser
 
@@ -19,9 +24,9 @@ def main(args):
     x = dataset.load_particles(args.input, lazy=True)
     logger.info(f"Loaded {len(x)} particles")
     ind = utils.load_pkl(args.ind)
-    x = np.array([x[i].get() for i in ind])
-    logger.info(f"New dimensions: {x.shape}")
-    mrc.write(args.o, x)
+    x = x[ind]
+    logger.info(f"New dimensions: {(len(x), *x.shape)}")
+    stack_transform.transform_stack(x, args.o, batch_size=args.b, dtype=x.dtype)
 
 
 if __name__ == "__main__":
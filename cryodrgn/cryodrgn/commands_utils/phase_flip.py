@@ -4,7 +4,7 @@ import argparse
 import os
 import logging
 import numpy as np
-from cryodrgn import ctf, dataset, fft, mrc
+from cryodrgn import ctf, dataset, fft, stack_transform
 
 logger = logging.getLogger(__name__)
 
@@ -16,13 +16,19 @@ def add_args(parser):
         "--datadir",
         help="Optionally overwrite path to starfile .mrcs if loading from a starfile",
     )
+    parser.add_argument(
+        "-b",
+        type=int,
+        default=100,
+        help="Number of images to process at a time (default: %(default)s)",
+    )
     parser.add_argument("-o", type=os.path.abspath, help="Output .mrcs")
     return parser
 
 
 def main(args):
     imgs = dataset.load_particles(args.mrcs, lazy=True, datadir=args.datadir)
-    D = imgs[0].get().shape[0]
+    D = imgs.shape[0]
     ctf_params = ctf.load_ctf_for_training(D, args.ctf_params)
     assert len(imgs) == len(ctf_params), f"{len(imgs)} != {len(ctf_params)}"
 
@@ -32,19 +38,18 @@ def main(args):
     )
     freqs = np.stack([fx.ravel(), fy.ravel()], 1)
 
-    imgs_flip = np.empty((len(imgs), D, D), dtype=np.float32)
-    for i in range(len(imgs)):
-        if i % 1000 == 0:
-            logger.info(f"Processing image {i}")
-        c = ctf.compute_ctf_np(freqs / ctf_params[i, 0], *ctf_params[i, 1:])
-        c = c.reshape((D, D))
-        ff = fft.fft2_center(imgs[i].get())
-        ff *= np.sign(c)
-        img = fft.ifftn_center(ff)
-        imgs_flip[i] = img.astype(np.float32)
+    def phase_flip(batch, ind):
+        params = ctf_params[ind]
+        # per-image CTF parameters as Bx1 columns, broadcast against the frequencies
+        c = ctf.compute_ctf_np(
+            freqs / params[:, 0, None, None], *params[:, 1:].T[..., None]
+        )
+        ff = fft.fft2_center(batch)
+        ff *= np.sign(c).reshape(-1, D, D)
+        return fft.ifft2_center(ff).real
 
     logger.info(f"Writing {args.o}")
-    mrc.write(args.o, imgs_flip)
+    stack_transform.transform_stack(imgs, args.o, phase_flip, batch_size=args.b)
 
 
 if __name__ == "__main__":
@@ -5,7 +5,7 @@ import os
 import logging
 import matplotlib.pyplot as plt
 import numpy as np
-from cryodrgn import dataset, fft, mrc, utils
+from cryodrgn import dataset, fft, mrc, stack_transform, utils
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +23,12 @@ def add_args(parser):
         "--datadir",
         help="Optionally overwrite path to starfile .mrcs if loading from a starfile",
     )
+    parser.add_argument(
+        "-b",
+        type=int,
+        default=100,
+        help="Number of images to process at a time (default: %(default)s)",
+    )
     parser.add_argument(
         "-o", type=os.path.abspath, required=True, help="Output particle stack (.mrcs)"
     )
@@ -40,10 +46,10 @@ def plot_projections(out_png, imgs):
 
 def main(args):
     # load particles
-    particles = dataset.load_particles(args.mrcs, datadir=args.datadir)
-    assert isinstance(particles, np.ndarray)
-    logger.info(particles.shape)
-    Nimg, D, D = particles.shape
+    particles = dataset.load_particles(args.mrcs, lazy=True, datadir=args.datadir)
+    Nimg = len(particles)
+    D = particles.shape[0]
+    logger.info((Nimg, D, D))
 
     trans = utils.load_pkl(args.trans)
     if type(trans) is tuple:
@@ -58,21 +64,19 @@ def main(args):
     xx, yy = np.meshgrid(np.arange(-D / 2, D / 2), np.arange(-D / 2, D / 2))
     TCOORD = np.stack([xx, yy], axis=2) / D  # DxDx2
 
-    imgs = np.empty((Nimg, D, D), dtype=np.float32)
-    for ii in range(Nimg):
-        if ii % 1000 == 0:
-            logger.info(f"Processing image {ii}")
-        ff = fft.fft2_center(particles[ii])
-        tfilt = np.dot(TCOORD, trans[ii]) * -2 * np.pi
+    def translate(batch, ind):
+        ff = fft.fft2_center(batch)
+        tfilt = np.einsum("ijk,bk->bij", TCOORD, trans[ind]) * -2 * np.pi
         tfilt = np.cos(tfilt) + np.sin(tfilt) * 1j
         ff *= tfilt
-        imgs[ii] = fft.ifftn_center(ff).astype(np.float32)
+        return fft.ifft2_center(ff).real
 
     logger.info(f"Writing {args.o}")
-    mrc.write(args.o, imgs)
+    stack_transform.transform_stack(particles, args.o, translate, batch_size=args.b)
 
     if args.out_png:
-        plot_projections(args.out_png, imgs[:9])
+        imgs = mrc.parse_mrc(args.o, lazy=True)[0]
+        plot_projections(args.out_png, imgs.images(slice(0, 9)))
 
 
 if __name__ == "__main__":
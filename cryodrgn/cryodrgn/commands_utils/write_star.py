@@ -116,7 +116,7 @@ def main(args):
     if args.ind:
         ind = utils.load_pkl(args.ind)
         logger.info(f"Filtering to {len(ind)} particles")
-        particles = [particles[ii] for ii in ind]
+        particles = particles[ind]
         if ctf is not None:
             ctf = ctf[ind]
         if poses is not None:
@@ -137,7 +137,7 @@ def main(args):
 
         # convert poses
         if poses is not None:
-            eulers = utils.R_to_relion_scipy(poses[0])
+            eulers = utils.R_to_relion(poses[0])
             D = particles[0].get().shape[0]
             trans = poses[1] * D  # convert from fraction to pixels
 
@@ -1,12 +1,16 @@
 from typing import Union, Optional
+import tempfile
 import numpy as np
-import seaborn as sns
 import torch
 import logging
 from cryodrgn import utils
 
 logger = logging.getLogger(__name__)
 
+# default size in bytes above which a CTFCache table is kept in a memory-mapped
+# temporary file instead of on the device
+CTF_CACHE_MAX_BYTES = 2**29
+
 
 def compute_ctf(
     freqs: torch.Tensor,
@@ -57,6 +61,89 @@ def compute_ctf(
     return ctf
 
 
+class CTFCache:
+    """
+    CTFs of a set of particles on fixed frequencies, computed the first time they are
+    needed and afterwards looked up by particle index
+
+    Particles with identical CTF parameters (e.g. from the same micrograph) share
+    one entry. The table is kept on the device of `freqs`, or in a memory-mapped
+    temporary file if it would take more than max_bytes.
+
+    Inputs:
+        freqs (Nx2 tensor): unscaled 2D spatial frequencies, e.g. lattice.freqs2d
+        ctf_params (Nimg x 8 array or tensor): CTF parameters for training,
+            starting with the pixel size
+        dtype (torch.dtype): storage type of the table, e.g. torch.float16 to halve
+            its size at the cost of precision
+        max_bytes (int): largest table kept on the device (default:
+            CTF_CACHE_MAX_BYTES)
+    """
+
+    def __init__(
+        self,
+        freqs: torch.Tensor,
+        ctf_params: Union[np.ndarray, torch.Tensor],
+        dtype: torch.dtype = torch.float32,
+        max_bytes: Optional[int] = None,
+    ):
+        if isinstance(ctf_params, torch.Tensor):
+            ctf_params = ctf_params.cpu().numpy()
+        self.freqs = freqs
+        self.device = freqs.device
+        self.params, self.groups = np.unique(ctf_params, axis=0, return_inverse=True)
+        self.groups = self.groups.reshape(-1)
+        self.params = torch.tensor(self.params, device=self.device)
+        self.filled = np.zeros(len(self.params), dtype=bool)
+
+        shape = (len(self.params), len(freqs))
+        nbytes = shape[0] * shape[1] * torch.finfo(dtype).bits // 8
+        if max_bytes is None:
+            max_bytes = CTF_CACHE_MAX_BYTES
+        if nbytes <= max_bytes:
+            self.table = torch.empty(shape, dtype=dtype, device=self.device)
+        else:
+            logger.warning(
+                f"{shape[0]} unique CTFs for {len(ctf_params)} images take "
+                f"{nbytes / 2**30:.2f} GB, more than {max_bytes / 2**30:.2f} GB; "
+                "caching them in a temporary file instead"
+            )
+            np_dtype = torch.empty(0, dtype=dtype).numpy().dtype
+            self.table = np.memmap(
+                tempfile.TemporaryFile(), dtype=np_dtype, mode="w+", shape=shape
+            )
+        logger.debug(f"{shape[0]} unique CTFs for {len(ctf_params)} images")
+
+    def __len__(self) -> int:
+        return len(self.groups)
+
+    def __getitem__(self, ind: Union[np.ndarray, torch.Tensor]) -> torch.Tensor:
+        """CTFs of the particles with indices ind (B x N float32 tensor)"""
+        if isinstance(ind, torch.Tensor):
+            ind = ind.cpu().numpy()
+        groups = self.groups[ind]
+        missing = np.unique(groups[~self.filled[groups]])
+        if len(missing):
+            self._fill(missing)
+        if isinstance(self.table, torch.Tensor):
+            c = self.table[torch.from_numpy(groups).to(self.device)]
+        else:
+            c = torch.from_numpy(self.table[groups]).to(self.device)
+        return c.float()
+
+    def _fill(self, groups: np.ndarray) -> None:
+        params = self.params[torch.from_numpy(groups).to(self.device)]
+        freqs = self.freqs.unsqueeze(0) / params[:, 0].view(-1, 1, 1)
+        c = compute_ctf(freqs, *torch.split(params[:, 1:], 1, 1))
+        if isinstance(self.table, torch.Tensor):
+            self.table[torch.from_numpy(groups).to(self.device)] = c.to(
+                self.table.dtype
+            )
+        else:
+            self.table[groups] = c.cpu().numpy()
+        self.filled[groups] = True
+
+
 def compute_ctf_np(
     freqs: np.ndarray,
     dfu: float,
@@ -72,15 +159,15 @@ def compute_ctf_np(
     Compute the 2D CTF
 
     Input:
-        freqs (np.ndarray) Nx2 array of 2D spatial frequencies
-        dfu (float): DefocusU (Angstrom)
-        dfv (float): DefocusV (Angstrom)
-        dfang (float): DefocusAngle (degrees)
-        volt (float): accelerating voltage (kV)
-        cs (float): spherical aberration (mm)
-        w (float): amplitude contrast ratio
-        phase_shift (float): degrees
-        bfactor (float): envelope fcn B-factor (Angstrom^2)
+        freqs (np.ndarray) Nx2 or BxNx2 array of 2D spatial frequencies
+        dfu (float or Bx1 array): DefocusU (Angstrom)
+        dfv (float or Bx1 array): DefocusV (Angstrom)
+        dfang (float or Bx1 array): DefocusAngle (degrees)
+        volt (float or Bx1 array): accelerating voltage (kV)
+        cs (float or Bx1 array): spherical aberration (mm)
+        w (float or Bx1 array): amplitude contrast ratio
+        phase_shift (float or Bx1 array): degrees
+        bfactor (float or Bx1 array): envelope fcn B-factor (Angstrom^2)
     """
     # convert units
     volt = volt * 1000
@@ -90,8 +177,8 @@ def compute_ctf_np(
 
     # lam = sqrt(h^2/(2*m*e*Vr)); Vr = V + (e/(2*m*c^2))*V^2
     lam = 12.2639 / np.sqrt(volt + 0.97845e-6 * volt**2)
-    x = freqs[:, 0]
-    y = freqs[:, 1]
+    x = freqs[..., 0]
+    y = freqs[..., 1]
     ang = np.arctan2(y, x)
     s2 = x**2 + y**2
     df = 0.5 * (dfu + dfv + (dfu - dfv) * np.cos(2 * (ang - dfang)))
@@ -119,6 +206,8 @@ def print_ctf_params(params: np.ndarray) -> None:
 
 
 def plot_ctf(D: int, Apix: float, ctf_params: np.ndarray) -> None:
+    import seaborn as sns
+
     assert len(ctf_params) == 7
 
     freqs = (
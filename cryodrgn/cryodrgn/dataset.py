@@ -11,7 +11,15 @@ import multiprocessing as mp
 import os
 from multiprocessing import Pool
 import logging
+import torch
 from torch.utils import data
+from torch.utils.data import (
+    BatchSampler,
+    DataLoader,
+    DistributedSampler,
+    RandomSampler,
+    SequentialSampler,
+)
 
 from cryodrgn import fft, mrc, starfile, utils
 
@@ -24,7 +32,7 @@ def load_particles(mrcs_txt_star, lazy=False, datadir=None):
     Load particle stack from either a .mrcs file, a .star file, a .txt file containing paths to .mrcs files, or a
     cryosparc particles.cs file.
 
-    lazy (bool): Return numpy array if True, or return list of LazyImages
+    lazy (bool): Return numpy array if False, or a memory-mapped mrc.MMapImageStack if True
     datadir (str or None): Base directory overwrite for .star or .cs file parsing
     """
     if mrcs_txt_star.endswith(".txt"):
@@ -53,6 +61,51 @@ def load_particles(mrcs_txt_star, lazy=False, datadir=None):
     return particles
 
 
+class RunningStats:
+    """
+    Single-pass mean/standard deviation over batches of images
+
+    Batches are merged with the parallel form of Welford's algorithm, accumulating in
+    float64, so statistics can be computed while streaming over a dataset without
+    holding it (or temporaries of its size) in memory.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, x):
+        x = x.astype("float64")
+        n = x.size
+        if n == 0:
+            return
+        mean = float(x.mean())
+        m2 = float(((x - mean) ** 2).sum())
+        delta = mean - self.mean
+        total = self.n + n
+        self.mean += delta * n / total
+        self.m2 += m2 + delta**2 * self.n * n / total
+        self.n = total
+
+    @property
+    def std(self):
+        return (self.m2 / self.n) ** 0.5
+
+
+def batch_stats(particles, batch_size=1000):
+    """Mean and standard deviation of an in-memory image stack, in batches"""
+    stats = RunningStats()
+    for i in range(0, len(particles), batch_size):
+        stats.update(particles[i : i + batch_size])
+    return stats.mean, stats.std
+
+
+def preprocessed_meta_path(mrcs_txt):
+    """Path to the index sidecar written by `cryodrgn preprocess` next to its .ft.txt"""
+    return f"{os.path.splitext(mrcs_txt)[0]}.meta.pkl"
+
+
 class LazyMRCData(data.Dataset):
     """
     Class representing an .mrcs stack file -- images loaded on the fly
@@ -73,7 +126,7 @@ class LazyMRCData(data.Dataset):
         assert not keepreal, "Not implemented error"
         particles = load_particles(mrcfile, True, datadir=datadir)
         if ind is not None:
-            particles = [particles[x] for x in ind]
+            particles = particles[ind]
         N = len(particles)
         ny, nx = particles[0].get().shape
         assert ny == nx, "Images must be square"
@@ -96,10 +149,7 @@ class LazyMRCData(data.Dataset):
 
         n = min(n, self.N)
         imgs = pp.asarray(
-            [
-                fft.ht2_center(self.particles[i].get())
-                for i in range(0, self.N, self.N // n)
-            ]
+            fft.ht2_center(self.particles.images(np.arange(0, self.N, self.N // n)))
         )
         if self.invert_data:
             imgs *= -1
@@ -110,9 +160,13 @@ class LazyMRCData(data.Dataset):
         return norm
 
     def get(self, i):
+        """Load the image at index i, or a (B, D, D) batch if i is a sequence of indices"""
         pp = cp if (self.use_cupy and cp is not None) else np
 
-        img = self.particles[i].get()
+        if is_batch_index(i):
+            img = pp.asarray(self.particles.images(i))
+        else:
+            img = pp.asarray(self.particles[i].get())
         if self.window is not None:
             img *= self.window
         img = fft.ht2_center(img).astype(pp.float32)
@@ -120,15 +174,66 @@ class LazyMRCData(data.Dataset):
             img *= -1
         img = fft.symmetrize_ht(img)
         img = (img - self.norm[0]) / self.norm[1]
+        if is_batch_index(i):
+            img = img.reshape(-1, self.D, self.D)
         return img
 
     def __len__(self):
         return self.N
 
     def __getitem__(self, index):
+        if is_batch_index(index):
+            index = np.asarray(index)
         return self.get(index), index
 
 
+def is_batch_index(index):
+    return not isinstance(index, (int, np.integer))
+
+
+def make_dataloader(
+    data,
+    batch_size,
+    shuffle=False,
+    num_workers=0,
+    prefetch_factor=2,
+    seed=None,
+    distributed=False,
+):
+    """
+    DataLoader over minibatches of a cryoDRGN dataset
+
+    Each batch of indices is passed to the dataset's `__getitem__` at once, so datasets
+    load and transform a whole minibatch with batched reads and FFTs instead of one image
+    at a time. With num_workers > 0, batches are prepared by background worker processes
+    (prefetching `prefetch_factor` batches each) while the model computes.
+
+    With distributed=True, each process of a torch.distributed run gets an equal share
+    of the images; call `set_epoch` on the loader's `sampler.sampler` every epoch to
+    reshuffle them.
+    """
+    if distributed:
+        sampler = DistributedSampler(data, shuffle=shuffle, seed=seed or 0)
+    elif shuffle:
+        generator = None
+        if seed is not None:
+            generator = torch.Generator()
+            generator.manual_seed(seed)
+        sampler = RandomSampler(data, generator=generator)
+    else:
+        sampler = SequentialSampler(data)
+    kwargs = {}
+    if num_workers > 0:
+        kwargs = dict(prefetch_factor=prefetch_factor, persistent_workers=True)
+    return DataLoader(
+        data,
+        sampler=BatchSampler(sampler, batch_size=batch_size, drop_last=False),
+        batch_size=None,
+        num_workers=num_workers,
+        **kwargs,
+    )
+
+
 def window_mask(D, in_rad, out_rad, use_cupy=False):
     pp = cp if (use_cupy and cp is not None) else np
 
@@ -159,6 +264,7 @@ class MRCData(data.Dataset):
         max_threads=16,
         window_r=0.85,
         use_cupy=False,
+        batch_size=1000,
     ):
         pp = cp if (use_cupy and cp is not None) else np
 
@@ -166,7 +272,7 @@ class MRCData(data.Dataset):
             raise NotImplementedError
         if ind is not None:
             particles = load_particles(mrcfile, True, datadir=datadir)
-            particles = pp.array([particles[i].get() for i in ind])
+            particles = pp.asarray(particles.images(ind))
         else:
             particles = load_particles(mrcfile, False, datadir=datadir)
         N, ny, nx = particles.shape
@@ -176,38 +282,41 @@ class MRCData(data.Dataset):
         ), "Image size must be even. Is this a preprocessed dataset? Use the --preprocessed flag if so."
         logger.info("Loaded {} {}x{} images".format(N, ny, nx))
 
-        # Real space window
+        # window, compute the symmetrized HT and accumulate the normalization
+        # statistics in one pass over batches of images
         if window:
             logger.info(f"Windowing images with radius {window_r}")
-            particles *= window_mask(ny, window_r, 0.99)
-
-        # compute HT
+            mask = window_mask(ny, window_r, 0.99, use_cupy=pp is not np)
         logger.info("Computing FFT")
         max_threads = min(max_threads, mp.cpu_count())
         if max_threads > 1:
             logger.info(f"Spawning {max_threads} processes")
-            with Pool(max_threads) as p:
-                particles = pp.asarray(
-                    p.map(fft.ht2_center, particles), dtype=pp.float32
-                )
-        else:
-            particles = pp.asarray(
-                [fft.ht2_center(img) for img in particles], dtype=pp.float32
-            )
-            logger.info("Converted to FFT")
-
-        if invert_data:
-            particles *= -1
-
-        # symmetrize HT
-        logger.info("Symmetrizing image data")
-        particles = fft.symmetrize_ht(particles)
+        pool = Pool(max_threads) if max_threads > 1 else None
+        ht_map = pool.map if pool is not None else map
+        ht = pp.empty((N, ny + 1, nx + 1), dtype=pp.float32)
+        stats = RunningStats()
+        for i in range(0, N, batch_size):
+            imgs = particles[i : i + batch_size]
+            if window:
+                imgs = imgs * mask
+            batch = ht[i : i + batch_size]
+            batch[:, :-1, :-1] = pp.asarray(list(ht_map(fft.ht2_center, imgs)))
+            if invert_data:
+                batch *= -1
+            fft.symmetrize_ht(batch, preallocated=True)
+            if norm is None:
+                stats.update(batch)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        particles = ht
+        logger.info("Converted to FFT")
 
         # normalize
         if norm is None:
-            norm = [pp.mean(particles), pp.std(particles)]
-            norm[0] = 0
-        particles = (particles - norm[0]) / norm[1]
+            norm = [0, stats.std]
+        particles -= norm[0]
+        particles /= norm[1]
         logger.info("Normalized HT by {} +/- {}".format(*norm))
 
         self.particles = particles
@@ -227,6 +336,8 @@ class MRCData(data.Dataset):
         return self.N
 
     def __getitem__(self, index):
+        if is_batch_index(index):
+            index = np.asarray(index)
         return self.particles[index], index
 
     def get(self, index):
@@ -242,15 +353,23 @@ class PreprocessedMRCData(data.Dataset):
         self.lazy = lazy
         if ind is not None:
             particles = particles[ind]
+        if not lazy:
+            # preprocessed images may be stored in half precision
+            particles = particles.astype(np.float32, copy=False)
 
         self.particles = particles
         self.N = len(particles)
         if self.lazy:
-            self.D = particles[0].get().shape[0]  # ny + 1 after symmetrizing HT
+            self.D = particles.shape[0]  # ny + 1 after symmetrizing HT
         else:
             self.D = particles.shape[1]  # ny + 1 after symmetrizing HT
 
         logger.info(f"Loaded {len(particles)} {self.D}x{self.D} images")
+        meta_file = preprocessed_meta_path(mrcfile)
+        if norm is None and ind is None and os.path.exists(meta_file):
+            norm = utils.load_pkl(meta_file).get("norm")
+            if norm is not None:
+                logger.info(f"Using normalization cached in {meta_file}")
         if norm is None:
             norm = list(self.calc_statistic())
             norm[0] = 0
@@ -265,37 +384,38 @@ class PreprocessedMRCData(data.Dataset):
         pp = cp if (self.use_cupy and cp is not None) else np
 
         if self.lazy:
-            max_size = min(10000, self.N)
-            sample_index = pp.sort(
-                pp.random.choice(
-                    pp.arange(self.N), max(int(0.1 * self.N), max_size), replace=False
-                )
+            # a random 10% of the images, up to 10000 images
+            n = max(1, min(int(0.1 * self.N), 10000))
+            sample_index = np.sort(np.random.choice(self.N, n, replace=False))
+            logger.info(
+                f"--lazy mode, sampling {n} images to calculate normalization..."
             )
-            print("--lazy mode, sample 10% of samples to calculate standard error...")
-            data = []
-            for d in sample_index:
-                data.append(self.particles[d].get())
-            data = pp.stack(data, 0)
-            mean, std = pp.mean(data), pp.std(data)
+            stats = RunningStats()
+            for i in range(0, n, 1000):
+                stats.update(
+                    pp.asarray(self.particles.images(sample_index[i : i + 1000]))
+                )
+            mean, std = stats.mean, stats.std
         else:
-            mean, std = pp.mean(self.particles), pp.std(self.particles)
-        # print(f"std={std}, mean={mean}")
+            mean, std = batch_stats(self.particles)
         return mean, std
 
     def __len__(self):
         return self.N
 
     def __getitem__(self, index):
-        if self.lazy:
-            return (self.particles[index].get() - self.norm[0]) / self.norm[1], index
-        else:
-            return self.particles[index], index
+        if is_batch_index(index):
+            index = np.asarray(index)
+        return self.get(index), index
 
     def get(self, index):
-        if self.lazy:
-            return (self.particles[index].get() - self.norm[0]) / self.norm[1]
-        else:
+        if not self.lazy:
             return self.particles[index]
+        if is_batch_index(index):
+            imgs = self.particles.images(index)
+        else:
+            imgs = self.particles[index].get()
+        return (imgs.astype(np.float32) - self.norm[0]) / self.norm[1]
 
 
 class TiltMRCData(data.Dataset):
@@ -321,11 +441,9 @@ class TiltMRCData(data.Dataset):
         if ind is not None:
             particles_real = load_particles(mrcfile, True, datadir)
             particles_tilt_real = load_particles(mrcfile_tilt, True, datadir)
-            particles_real = pp.array(
-                [particles_real[i].get() for i in ind], dtype=pp.float32
-            )
-            particles_tilt_real = pp.array(
-                [particles_tilt_real[i].get() for i in ind], dtype=pp.float32
+            particles_real = pp.asarray(particles_real.images(ind), dtype=pp.float32)
+            particles_tilt_real = pp.asarray(
+                particles_tilt_real.images(ind), dtype=pp.float32
             )
         else:
             particles_real = load_particles(mrcfile, False, datadir)
@@ -388,6 +506,8 @@ class TiltMRCData(data.Dataset):
         return self.N
 
     def __getitem__(self, index):
+        if is_batch_index(index):
+            index = np.asarray(index)
         return self.particles[index], self.particles_tilt[index], index
 
     def get(self, index):
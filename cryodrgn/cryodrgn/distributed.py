@@ -0,0 +1,151 @@
+"""
+Data-parallel training across processes with torch.distributed
+
+Each process trains on its own shard of the particles (see dataset.make_dataloader)
+and gradients are averaged across processes before every optimizer step. Processes
+are either launched with torchrun, e.g. on each of several nodes:
+
+    torchrun --nnodes 2 --nproc-per-node 16 --rdzv-endpoint HOST:PORT \\
+        -m cryodrgn train_vae ...
+
+or spawned on a single node with --num-processes. CPU training uses the gloo backend,
+GPU training nccl with one GPU per process.
+"""
+
+import logging
+import os
+import socket
+from typing import Callable, List
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+logger = logging.getLogger(__name__)
+
+
+def is_launched() -> bool:
+    """Whether this process is one of several started by torchrun or `spawn`"""
+    return int(os.environ.get("WORLD_SIZE", 1)) > 1
+
+
+def is_initialized() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_initialized() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_initialized() else 1
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _run(rank: int, main: Callable, args, world_size: int) -> None:
+    os.environ.update(
+        RANK=str(rank),
+        LOCAL_RANK=str(rank),
+        WORLD_SIZE=str(world_size),
+        LOCAL_WORLD_SIZE=str(world_size),
+    )
+    main(args)
+
+
+def spawn(main: Callable, args, num_processes: int) -> None:
+    """Run main(args) in num_processes processes on this node"""
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", str(_free_port()))
+    mp.spawn(_run, args=(main, args, num_processes), nprocs=num_processes)
+
+
+def init(device: torch.device) -> torch.device:
+    """
+    Join the process group of the processes launched by torchrun or `spawn`, and
+    return the device this process should use
+    """
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if device.type == "cuda":
+        device = torch.device("cuda", local_rank)
+        torch.cuda.set_device(device)
+        backend = "nccl"
+    else:
+        # share the cores of the node between its processes
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+        backend = "gloo"
+    dist.init_process_group(backend)
+    if not is_main_process():
+        # only log from the first process
+        logging.getLogger().setLevel(logging.WARNING)
+    logger.info(f"Training with {get_world_size()} processes ({backend} backend)")
+    return device
+
+
+def cleanup() -> None:
+    if is_initialized():
+        dist.destroy_process_group()
+
+
+def broadcast_parameters(model: torch.nn.Module) -> None:
+    """Copy the parameters and buffers of the first process's model to all others"""
+    for x in list(model.parameters()) + list(model.buffers()):
+        dist.broadcast(x.data, 0)
+
+
+def all_reduce_grads(model: torch.nn.Module) -> None:
+    """Average gradients across processes, in a single all-reduce"""
+    grads = [p.grad for p in model.parameters() if p.grad is not None]
+    if not grads:
+        return
+    flat = _flatten_dense_tensors(grads)
+    dist.all_reduce(flat)
+    flat /= get_world_size()
+    for g, x in zip(grads, _unflatten_dense_tensors(flat, grads)):
+        g.copy_(x)
+
+
+def _comm_device() -> torch.device:
+    """Device of the tensors that the process group's backend communicates"""
+    return torch.device("cuda" if dist.get_backend() == "nccl" else "cpu")
+
+
+def all_reduce_sum(x: List[float]) -> List[float]:
+    """Sum a list of numbers (e.g. accumulated losses) across processes"""
+    t = torch.tensor(x, dtype=torch.float64, device=_comm_device())
+    dist.all_reduce(t)
+    return t.tolist()
+
+
+def gather_rows(ind: torch.Tensor, n: int, *rows: torch.Tensor) -> List[torch.Tensor]:
+    """
+    Assemble arrays of n rows from the rows (indexed by `ind`) held by each process
+
+    Every process must hold the same number of rows, as is the case for the particles
+    of a DistributedSampler. Rows not held by any process are zero.
+    """
+    world_size = get_world_size()
+    device = _comm_device()
+    ind = ind.to(device)
+    all_ind = [torch.empty_like(ind) for _ in range(world_size)]
+    dist.all_gather(all_ind, ind)
+    all_ind = torch.cat(all_ind)
+    out = []
+    for x in rows:
+        y = x.to(device).contiguous()
+        all_y = [torch.empty_like(y) for _ in range(world_size)]
+        dist.all_gather(all_y, y)
+        full = y.new_zeros((n,) + y.shape[1:])
+        full[all_ind] = torch.cat(all_y)
+        out.append(full.to(x.device))
+    return out
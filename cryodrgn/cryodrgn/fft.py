@@ -14,6 +14,14 @@ def fft2_center(img):
     )
 
 
+def ifft2_center(V):
+    pp = np if isinstance(V, np.ndarray) else cp
+
+    return pp.fft.ifftshift(
+        pp.fft.ifft2(pp.fft.ifftshift(V, axes=(-1, -2))), axes=(-1, -2)
+    )
+
+
 def fftn_center(img):
     pp = np if isinstance(img, np.ndarray) else cp
 
@@ -0,0 +1,118 @@
+"""
+Fourier shell correlation (FSC) and map-map correlation between volumes
+"""
+
+import functools
+import logging
+import multiprocessing
+from typing import List, Tuple
+
+import numpy as np
+
+from cryodrgn import mrc
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=4)
+def get_shell_labels(D: int) -> np.ndarray:
+    """
+    Fourier shell of each voxel of the half-spectrum of a DxDxD volume, as laid out by
+    np.fft.rfftn (without fftshift). Shell k in 1..D//2 holds the frequencies with
+    radius in [k-1, k), and the last shell also includes all frequencies beyond it.
+    """
+    x = np.fft.fftfreq(D, 1 / D)
+    xz = np.fft.rfftfreq(D, 1 / D)
+    r = np.sqrt(x[:, None, None] ** 2 + x[None, :, None] ** 2 + xz[None, None, :] ** 2)
+    labels = np.searchsorted(np.arange(D // 2), r, side="right")
+    labels.flags.writeable = False
+    return labels
+
+
+def fsc_freqs(D: int) -> np.ndarray:
+    """Spatial frequency (1/px) at the start of each FSC shell"""
+    return np.arange(D // 2) / D
+
+
+def _shell_sum(x: np.ndarray, labels: np.ndarray, D: int) -> np.ndarray:
+    """
+    Sum a real quantity over Fourier shells of the full spectrum given its values on
+    the rfftn half-spectrum: every frequency stands in for itself and its Friedel mate,
+    except in the self-conjugate planes kz=0 and kz=D/2
+    """
+    n = D // 2 + 1
+    total = 2 * np.bincount(labels.ravel(), x.ravel(), minlength=n)
+    total -= np.bincount(labels[..., 0].ravel(), x[..., 0].ravel(), minlength=n)
+    if D % 2 == 0:
+        total -= np.bincount(labels[..., -1].ravel(), x[..., -1].ravel(), minlength=n)
+    return total[1:]
+
+
+def calc_cc(vol1: np.ndarray, vol2: np.ndarray) -> float:
+    """
+    Zero-mean correlation coefficient between two volumes, as defined in eq 2 of
+    https://journals.iucr.org/d/issues/2018/09/00/kw5139/index.html
+    """
+    zmean1 = vol1 - np.mean(vol1)
+    zmean2 = vol2 - np.mean(vol2)
+    return (
+        (np.sum(zmean1**2) ** -0.5)
+        * (np.sum(zmean2**2) ** -0.5)
+        * np.sum(zmean1 * zmean2)
+    )
+
+
+def calc_fsc(vol1: np.ndarray, vol2: np.ndarray) -> np.ndarray:
+    """FSC between two DxDxD volumes, in D//2 shells (see fsc_freqs)"""
+    D = vol1.shape[0]
+    labels = get_shell_labels(D)
+    ft1, ft2 = np.fft.rfftn(vol1), np.fft.rfftn(vol2)
+    num = _shell_sum(np.real(ft1 * np.conjugate(ft2)), labels, D)
+    den1 = _shell_sum(np.abs(ft1) ** 2, labels, D)
+    den2 = _shell_sum(np.abs(ft2) ** 2, labels, D)
+    return num / np.sqrt(den1 * den2)
+
+
+def sequential_fscs(vol_paths: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    CC and FSC between each pair of consecutive volumes in a list of .mrc files,
+    loading and Fourier transforming every volume only once
+
+    Returns:
+        cc (np.array of length N-1)
+        fsc (N-1 x D//2 np.array)
+    """
+    cc, fsc = [], []
+    prev = None
+    for path in vol_paths:
+        vol = mrc.parse_mrc(path)[0]
+        assert isinstance(vol, np.ndarray)
+        D = vol.shape[0]
+        labels = get_shell_labels(D)
+        ft = np.fft.rfftn(vol)
+        power = _shell_sum(np.abs(ft) ** 2, labels, D)
+        if prev is not None:
+            prev_vol, prev_ft, prev_power = prev
+            cc.append(calc_cc(prev_vol, vol))
+            num = _shell_sum(np.real(prev_ft * np.conjugate(ft)), labels, D)
+            fsc.append(num / np.sqrt(prev_power * power))
+        prev = vol, ft, power
+    return np.array(cc), np.array(fsc)
+
+
+def sequential_fscs_parallel(
+    vol_path_lists: List[List[str]], max_threads: int = 1
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    sequential_fscs for several lists of volumes at once, one list per process
+
+    Returns:
+        cc (M x N-1 np.array)
+        fsc (M x N-1 x D//2 np.array)
+    """
+    if max_threads > 1 and len(vol_path_lists) > 1:
+        with multiprocessing.Pool(min(max_threads, len(vol_path_lists))) as p:
+            results = p.map(sequential_fscs, vol_path_lists)
+    else:
+        results = [sequential_fscs(paths) for paths in vol_path_lists]
+    return np.array([cc for cc, _ in results]), np.array([fsc for _, fsc in results])
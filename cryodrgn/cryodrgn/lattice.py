@@ -139,14 +139,33 @@ class Lattice:
             [img[..., 0] * c - img[..., 1] * s, img[..., 0] * s + img[..., 1] * c], -1
         )
 
-    def translate_ht(self, img, t, mask=None):
+    def get_translation_table(self, t, mask=None):
+        """
+        Phase shifts of the Hartley transform for a set of translations, to reuse when
+        applying the same translations to many images (see translate_ht)
+
+        Inputs:
+            t: shift in pixels (B x T x 2, or T x 2 for shifts shared by all images)
+            mask: Mask for lattice coords (img_dims x 1)
+
+        Returns:
+            cos and sin of the phase shifts (B x T x img_dims or T x img_dims)
+        """
+        coords = self.freqs2d if mask is None else self.freqs2d[mask]
+        t = t.unsqueeze(-1)  # BxTx2x1 to be able to do bmm
+        tfilt = coords @ t * 2 * np.pi  # BxTxNx1
+        tfilt = tfilt.squeeze(-1)  # BxTxN
+        return torch.cos(tfilt), torch.sin(tfilt)
+
+    def translate_ht(self, img, t, mask=None, table=None):
         """
         Translate an image by phase shifting its Hartley transform
 
         Inputs:
             img: HT of image (B x img_dims)
-            t: shift in pixels (B x T x 2)
+            t: shift in pixels (B x T x 2, or T x 2 for shifts shared by all images)
             mask: Mask for lattice coords (img_dims x 1)
+            table: get_translation_table(t, mask), if precomputed
 
         Returns:
             Shifted images (B x T x img_dims)
@@ -154,14 +173,9 @@ class Lattice:
         img must be 1D unraveled image, symmetric around DC component
         """
         # H'(k) = cos(2*pi*k*t0)H(k) + sin(2*pi*k*t0)H(-k)
-        coords = self.freqs2d if mask is None else self.freqs2d[mask]
+        c, s = self.get_translation_table(t, mask) if table is None else table
         img = img.unsqueeze(1)  # Bx1xN
-        t = t.unsqueeze(-1)  # BxTx2x1 to be able to do bmm
-        tfilt = coords @ t * 2 * np.pi  # BxTxNx1
-        tfilt = tfilt.squeeze(-1)  # BxTxN
-        c = torch.cos(tfilt)  # BxTxN
-        s = torch.sin(tfilt)  # BxTxN
-        return c * img + s * img[:, :, torch.arange(len(coords) - 1, -1, -1)]
+        return c * img + s * img.flip(-1)
 
 
 class EvenLattice(Lattice):
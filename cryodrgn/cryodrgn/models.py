@@ -1,6 +1,6 @@
 """Pytorch models"""
 
-from typing import Optional, Tuple, Type, Union, Sequence, Any
+from typing import Callable, Iterator, Optional, Tuple, Type, Union, Sequence, Any
 import numpy as np
 import torch
 from torch import Tensor
@@ -14,6 +14,10 @@ from cryodrgn.lattice import Lattice
 
 Norm = Sequence[Any]  # mean, std
 
+# max number of lattice points (summed over latents) decoded per forward pass when
+# evaluating volumes in batches with Decoder.eval_volumes
+EVAL_VOLUMES_MAX_POINTS = 2**18
+
 
 def unparallelize(model: nn.Module) -> nn.Module:
     if isinstance(model, DataParallelDecoder):
@@ -218,6 +222,30 @@ class Decoder(nn.Module):
         """
         raise NotImplementedError
 
+    def eval_volumes(
+        self,
+        coords: Tensor,
+        D: int,
+        extent: float,
+        norm: Norm,
+        zvals: np.ndarray,
+    ) -> Iterator[np.ndarray]:
+        """
+        Evaluate the model on a DxDxD volume for each of several values of the latent
+
+        Inputs:
+            coords: lattice coords on the x-y plane (D^2 x 3)
+            D: size of lattice
+            extent: extent of lattice [-extent, extent]
+            norm: data normalization
+            zvals: values of latent (N x zdim)
+
+        Yields:
+            the volume for each value of the latent, in order
+        """
+        for zval in zvals:
+            yield self.eval_volume(coords, D, extent, norm, zval)
+
     def get_voxel_decoder(self) -> Optional["Decoder"]:
         return None
 
@@ -232,6 +260,11 @@ class DataParallelDecoder(Decoder):
         assert isinstance(module, Decoder)
         return module.eval_volume(*args, **kwargs)
 
+    def eval_volumes(self, *args, **kwargs):
+        module = self.dp.module
+        assert isinstance(module, Decoder)
+        return module.eval_volumes(*args, **kwargs)
+
 
 class PositionalDecoder(Decoder):
     def __init__(
@@ -368,31 +401,49 @@ class PositionalDecoder(Decoder):
         """
         # Note: extent should be 0.5 by default, except when a downsampled
         # volume is generated
-        assert extent <= 0.5
-        zdim = 0
-        z = torch.tensor([])
-        if zval is not None:
-            zdim = len(zval)
-            z = torch.tensor(zval, dtype=torch.float32, device=coords.device)
+        zvals = np.zeros((1, 0), dtype=np.float32) if zval is None else [zval]
+        return next(self.eval_volumes(coords, D, extent, norm, zvals))
 
-        vol_f = np.zeros((D, D, D), dtype=np.float32)
+    def eval_volumes(
+        self,
+        coords: Tensor,
+        D: int,
+        extent: float,
+        norm: Norm,
+        zvals: np.ndarray,
+    ) -> Iterator[np.ndarray]:
+        """
+        Batched version of eval_volume, decoding z-slices of several latents together
+        with the positional encoding of the lattice computed once
+        """
+        assert extent <= 0.5
         assert not self.training
-        # evaluate the volume by zslice to avoid memory overflows
-        for i, dz in enumerate(
-            np.linspace(-extent, extent, D, endpoint=True, dtype=np.float32)
-        ):
-            x = coords + torch.tensor([0, 0, dz], device=coords.device)
-            if zval is not None:
-                x = torch.cat((x, z.expand(x.shape[0], zdim)), dim=-1)
-            with torch.no_grad():
-                y = self.forward(x)
-                y = y.view(D, D).cpu().numpy()
-            vol_f[i] = y
-        vol_f = vol_f * norm[1] + norm[0]
-        vol = fft.ihtn_center(
-            vol_f[0:-1, 0:-1, 0:-1]
-        )  # remove last +k freq for inverse FFT
-        return vol
+        zvals = torch.tensor(
+            np.asarray(zvals, dtype=np.float32).reshape(len(zvals), -1),
+            device=coords.device,
+        )
+        dz = _slice_offsets(D, extent, coords.device)
+        encode = _lattice_encoder(self, coords, dz)
+        pix = torch.arange(D**2, device=coords.device)
+        nz, nslices = _eval_volumes_chunks(len(zvals), D**2)
+        for z in zvals.split(nz):
+            vol_f = np.zeros((len(z), D, D, D), dtype=np.float32)
+            for i in range(0, D, nslices):
+                iz = torch.arange(i, min(i + nslices, D), device=coords.device)
+                x = encode(pix, iz[:, None])  # nslices x D^2 x in_dim-zdim
+                x = torch.cat(
+                    (
+                        x.expand(len(z), *x.shape),
+                        z[:, None, None].expand(len(z), *x.shape[:2], z.shape[1]),
+                    ),
+                    dim=-1,
+                )
+                with torch.no_grad():
+                    y = self.decoder(x)
+                vol_f[:, i : i + nslices] = y.view(len(z), -1, D, D).cpu().numpy()
+            for v in vol_f:
+                v = v * norm[1] + norm[0]
+                yield fft.ihtn_center(v[0:-1, 0:-1, 0:-1])
 
 
 class FTPositionalDecoder(Decoder):
@@ -548,6 +599,7 @@ class FTPositionalDecoder(Decoder):
         extent: float,
         norm: Norm,
         zval: Optional[np.ndarray] = None,
+        radius: Optional[float] = None,
     ) -> np.ndarray:
         """
         Evaluate the model on a DxDxD volume
@@ -558,40 +610,32 @@ class FTPositionalDecoder(Decoder):
             extent: extent of lattice [-extent, extent]
             norm: data normalization
             zval: value of latent (zdim x 1)
+            radius: only evaluate frequencies within this radius (in the same units as
+                extent) of the origin, for faster low-resolution previews
         """
-        assert extent <= 0.5
-        zdim = 0
-        z = torch.tensor([])
-        if zval is not None:
-            zdim = len(zval)
-            z = torch.tensor(zval, dtype=torch.float32, device=coords.device)
+        zvals = np.zeros((1, 0), dtype=np.float32) if zval is None else [zval]
+        return next(self.eval_volumes(coords, D, extent, norm, zvals, radius=radius))
 
-        vol_f = np.zeros((D, D, D), dtype=np.float32)
+    def eval_volumes(
+        self,
+        coords: Tensor,
+        D: int,
+        extent: float,
+        norm: Norm,
+        zvals: np.ndarray,
+        radius: Optional[float] = None,
+    ) -> Iterator[np.ndarray]:
+        """
+        Batched version of eval_volume, decoding only the -z half of the lattice for
+        several latents together and filling in the +z half by Hermitian symmetry
+        """
+        assert extent <= 0.5
         assert not self.training
-        # evaluate the volume by zslice to avoid memory overflows
-        for i, dz in enumerate(
-            np.linspace(-extent, extent, D, endpoint=True, dtype=np.float32)
+        for vol_f in _eval_volumes_hermitian(
+            self, self.forward, coords, D, extent, zvals, radius
         ):
-            x = coords + torch.tensor([0, 0, dz], device=coords.device)
-            keep = x.pow(2).sum(dim=1) <= extent**2
-            x = x[keep]
-            if zval is not None:
-                x = torch.cat((x, z.expand(x.shape[0], zdim)), dim=-1)
-            with torch.no_grad():
-                if dz == 0.0:
-                    y = self.forward(x)
-                else:
-                    y = self.decode(x)
-                    y = y[..., 0] - y[..., 1]
-                slice_ = torch.zeros(D**2, device="cpu")
-                slice_[keep] = y.cpu()
-                slice_ = slice_.view(D, D).numpy()
-            vol_f[i] = slice_
-        vol_f = vol_f * norm[1] + norm[0]
-        vol = fft.ihtn_center(
-            vol_f[:-1, :-1, :-1]
-        )  # remove last +k freq for inverse FFT
-        return vol
+            vol_f = vol_f * norm[1] + norm[0]
+            yield fft.ihtn_center(vol_f[:-1, :-1, :-1])
 
 
 class FTSliceDecoder(Decoder):
@@ -687,6 +731,7 @@ class FTSliceDecoder(Decoder):
         extent: float,
         norm: Norm,
         zval: Optional[np.ndarray] = None,
+        radius: Optional[float] = None,
     ) -> np.ndarray:
         """
         Evaluate the model on a DxDxD volume
@@ -697,35 +742,175 @@ class FTSliceDecoder(Decoder):
             extent: extent of lattice [-extent, extent]
             norm: data normalization
             zval: value of latent (zdim x 1)
+            radius: only evaluate frequencies within this radius (in the same units as
+                extent) of the origin, for faster low-resolution previews
         """
-        if zval is not None:
-            zdim = len(zval)
-            z = torch.zeros(D**2, zdim, dtype=torch.float32)
-            z += torch.tensor(zval, dtype=torch.float32, device=coords.device)
-        else:
-            z = None
+        zvals = np.zeros((1, 0), dtype=np.float32) if zval is None else [zval]
+        return next(self.eval_volumes(coords, D, extent, norm, zvals, radius=radius))
 
-        vol_f = np.zeros((D, D, D), dtype=np.float32)
+    def eval_volumes(
+        self,
+        coords: Tensor,
+        D: int,
+        extent: float,
+        norm: Norm,
+        zvals: np.ndarray,
+        radius: Optional[float] = None,
+    ) -> Iterator[np.ndarray]:
+        """
+        Batched version of eval_volume, decoding only the -z half of the lattice for
+        several latents together and filling in the +z half by Hermitian symmetry
+        """
         assert not self.training
-        # evaluate the volume by zslice to avoid memory overflows
-        for i, dz in enumerate(
-            np.linspace(-extent, extent, D, endpoint=True, dtype=np.float32)
+
+        def central_slice(x):
+            y = self.decode(x)
+            return y[..., 0] - y[..., 1]
+
+        for vol_f in _eval_volumes_hermitian(
+            self, central_slice, coords, D, extent, zvals, radius
         ):
-            x = coords + torch.tensor([0, 0, dz], device=coords.device)
-            if zval is not None:
-                assert z is not None
-                x = torch.cat((x, z), dim=-1)
-            with torch.no_grad():
-                y = self.decode(x)
-                y = y[..., 0] - y[..., 1]
-                y = y.view(D, D).cpu().numpy()
-            vol_f[i] = y
-        vol_f = vol_f * norm[1] + norm[0]
-        vol_f = utils.zero_sphere(vol_f)
-        vol = fft.ihtn_center(
-            vol_f[:-1, :-1, :-1]
-        )  # remove last +k freq for inverse FFT
-        return vol
+            vol_f = vol_f * norm[1] + norm[0]
+            vol_f = utils.zero_sphere(vol_f)
+            yield fft.ihtn_center(vol_f[:-1, :-1, :-1])
+
+
+def _slice_offsets(D: int, extent: float, device) -> Tensor:
+    """(0, 0, dz) offsets of the D z-slices of a volume, as used by eval_volume"""
+    dz = torch.zeros((D, 3), device=device)
+    dz[:, 2] = torch.tensor(
+        np.linspace(-extent, extent, D, endpoint=True, dtype=np.float32)
+    )
+    return dz
+
+
+def _eval_volumes_chunks(nz: int, npoints: int) -> Tuple[int, int]:
+    """
+    Number of latents, and then of z-slices of npoints each, to decode together in
+    Decoder.eval_volumes within EVAL_VOLUMES_MAX_POINTS
+    """
+    zchunk = min(nz, max(1, EVAL_VOLUMES_MAX_POINTS // npoints))
+    return zchunk, max(1, EVAL_VOLUMES_MAX_POINTS // (zchunk * npoints))
+
+
+def _eval_volumes_hermitian(
+    decoder: Union[FTPositionalDecoder, FTSliceDecoder],
+    central_slice: Callable[[Tensor], Tensor],
+    coords: Tensor,
+    D: int,
+    extent: float,
+    zvals: np.ndarray,
+    radius: Optional[float] = None,
+) -> Iterator[np.ndarray]:
+    """
+    Evaluate the Hartley transform of the DxDxD volume for each latent in zvals, zero
+    outside the sphere of the given radius (default: extent)
+
+    The decoders only model the -z half of Fourier space, so each point of that half
+    is decoded once and also gives the value at its Friedel mate, which on a lattice
+    symmetric about the origin is at flat index D^3 - 1 - i. The middle z-slice of an
+    odd lattice is evaluated with central_slice if it passes through the origin, and
+    is decoded point by point at its offset otherwise.
+
+    Yields:
+        (D x D x D) np.ndarray for each value of the latent, in order
+    """
+    device = coords.device
+    zvals = torch.tensor(
+        np.asarray(zvals, dtype=np.float32).reshape(len(zvals), -1), device=device
+    )
+    radius = extent if radius is None else min(radius, extent)
+    dz = _slice_offsets(D, extent, device)
+    r2 = coords.pow(2).sum(dim=-1)
+
+    # points of the slices below the origin inside the sphere, as flat volume indices
+    keep = (r2 + dz[: D // 2, 2, None] ** 2) <= radius**2
+    ind = keep.view(-1).nonzero()[:, 0]
+    pix, iz = ind % D**2, ind // D**2
+    mirror = D**3 - 1 - ind
+    ind, mirror = ind.cpu(), mirror.cpu()
+    # the middle slice, which is only the central slice through the origin if its
+    # float32 offset is exactly zero; otherwise it is decoded at its actual offset
+    x0 = None
+    if D % 2 == 1:
+        keep0 = (r2 + dz[D // 2, 2] ** 2 <= radius**2).cpu()
+        x0 = coords[keep0.to(device)] + dz[D // 2]
+    eval_slice = central_slice if D % 2 == 1 and dz[D // 2, 2] == 0.0 else None
+
+    def cat_z(x, z):
+        return torch.cat(
+            (x.expand(len(z), *x.shape), z[:, None].expand(len(z), len(x), -1)),
+            dim=-1,
+        )
+
+    # none of these points has z > 0, so decode() reduces to the MLP on their encoding
+    encode = _lattice_encoder(decoder, coords, dz)
+    nz, _ = _eval_volumes_chunks(len(zvals), D**2)
+    npoints = max(1, EVAL_VOLUMES_MAX_POINTS // nz)
+    for z in zvals.split(nz):
+        vol_f = torch.zeros((len(z), D**3))
+        with torch.no_grad():
+            for i in range(0, len(ind), npoints):
+                x = encode(pix[i : i + npoints], iz[i : i + npoints])
+                y = decoder.decoder(cat_z(x, z)).cpu()
+                vol_f[:, ind[i : i + npoints]] = y[..., 0] - y[..., 1]
+                vol_f[:, mirror[i : i + npoints]] = y[..., 0] + y[..., 1]
+            if x0 is not None:
+                if eval_slice is not None:
+                    y = eval_slice(cat_z(x0, z))
+                else:
+                    y = decoder.decode(cat_z(x0, z))
+                    y = y[..., 0] - y[..., 1]
+                vol_f.view(len(z), D, D**2)[:, D // 2, keep0] = y.cpu()
+        yield from vol_f.view(len(z), D, D, D).numpy()
+
+
+def _lattice_encoder(
+    decoder: Decoder, coords: Tensor, dz: Tensor
+) -> Callable[[Tensor, Tensor], Tensor]:
+    """
+    Input features (without the latent) of decoder for the points coords[pix] + dz[iz]
+    of a DxDxD lattice, as a function of (pix, iz)
+
+    The positional encoding is assembled from tables for the x-y plane and the z-axis
+    that are computed once, instead of evaluating sin/cos for every lattice point:
+    the geometric/linear encodings are separable per axis, and the random Fourier
+    features are combined with the angle addition formulas.
+    """
+    if not isinstance(decoder, (PositionalDecoder, FTPositionalDecoder)):
+        return lambda pix, iz: coords[pix] + dz[iz]
+
+    assert (coords[:, 2] == 0).all() and (dz[:, 0:2] == 0).all()
+
+    def encoding(x):
+        x = torch.cat((x, x.new_zeros(len(x), decoder.zdim)), dim=-1)
+        return decoder.positional_encoding_geom(x)[:, : decoder.in_dim - decoder.zdim]
+
+    with torch.no_grad():
+        xy, zz = encoding(coords), encoding(dz)
+    if decoder.enc_type == "gaussian":
+        sin_xy, cos_xy = xy.chunk(2, dim=-1)
+        sin_z, cos_z = zz.chunk(2, dim=-1)
+
+        def encode(pix, iz):
+            return torch.cat(
+                (
+                    sin_xy[pix] * cos_z[iz] + cos_xy[pix] * sin_z[iz],
+                    cos_xy[pix] * cos_z[iz] - sin_xy[pix] * sin_z[iz],
+                ),
+                dim=-1,
+            )
+
+    else:
+        # features are ordered by axis
+        nxy = xy.shape[-1] * 2 // 3
+        xy, zz = xy[:, :nxy], zz[:, nxy:]
+
+        def encode(pix, iz):
+            pix, iz = torch.broadcast_tensors(pix, iz)
+            return torch.cat((xy[pix], zz[iz]), dim=-1)
+
+    return encode
 
 
 def get_decoder(
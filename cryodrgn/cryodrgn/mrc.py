@@ -1,7 +1,7 @@
 import os
 import struct
 from collections import OrderedDict
-from typing import Any, Optional, Tuple
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 import numpy as np
 import cryodrgn.types as types
 
@@ -199,12 +199,195 @@ class LazyImage:
     def get(self) -> np.ndarray:
         with open(self.fname) as f:
             f.seek(self.offset)
-            image = np.fromfile(
-                f, dtype=self.dtype, count=np.product(self.shape)
-            ).reshape(self.shape)
+            image = np.fromfile(f, dtype=self.dtype, count=np.prod(self.shape)).reshape(
+                self.shape
+            )
         return image
 
 
+class MMapImage:
+    """Handle to a single image of an MMapImageStack, loaded on `get()`"""
+
+    __slots__ = ("stack", "i")
+
+    def __init__(self, stack: "MMapImageStack", i: int):
+        self.stack = stack
+        self.i = i
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.stack.shape
+
+    @property
+    def fname(self) -> str:
+        return self.stack.fnames[self.stack.index[self.i, 0]]
+
+    def get(self) -> np.ndarray:
+        return self.stack.images([self.i])[0]
+
+
+class MMapImageStack:
+    """
+    Lazily-loaded particle stack backed by read-only memory maps of .mrcs files
+
+    Each unique .mrcs file is mapped once with `np.memmap` and the mapping is shared by
+    all particles (and all subsets of the stack); particles are stored as a compact
+    (N, 2) array of (file_id, image index) pairs instead of per-particle objects.
+
+    Indexing with an int returns an `MMapImage` (with a `.get()` method, like `LazyImage`),
+    while indexing with a slice, index array or boolean mask returns a new stack over the
+    same files. Use `images()` to read many images at once.
+    """
+
+    # Maximum number of files kept mapped at the same time (each mapping holds an fd)
+    max_open = 256
+
+    def __init__(
+        self,
+        fnames: List[str],
+        offsets: List[int],
+        nimages: List[int],
+        index: np.ndarray,
+        shape: Tuple[int, int],
+        dtype: Any,
+        _mmaps: Optional["OrderedDict[int, np.memmap]"] = None,
+    ):
+        self.fnames = fnames
+        self.offsets = offsets
+        self.nimages = nimages
+        self.index = index
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        self._mmaps = OrderedDict() if _mmaps is None else _mmaps
+
+    @classmethod
+    def from_paths(
+        cls, paths: Sequence[str], indices: Sequence[int]
+    ) -> "MMapImageStack":
+        """Build a stack from per-particle .mrcs paths and 0-based indices into them"""
+        file_ids: Dict[str, int] = {}
+        fids = np.fromiter(
+            (file_ids.setdefault(p, len(file_ids)) for p in paths),
+            dtype=np.int64,
+            count=len(paths),
+        )
+        fnames = list(file_ids)
+        headers = [MRCHeader.parse(f) for f in fnames]
+        shape = (headers[0].fields["ny"], headers[0].fields["nx"])
+        dtype = np.dtype(headers[0].dtype)
+        for f, h in zip(fnames, headers):
+            assert (h.fields["ny"], h.fields["nx"]) == shape and np.dtype(
+                h.dtype
+            ) == dtype, f"{f} has a different image size or dtype than {fnames[0]}"
+        index = np.stack([fids, np.asarray(indices, dtype=np.int64)], axis=1)
+        return cls(
+            fnames,
+            [1024 + h.fields["next"] for h in headers],
+            [h.fields["nz"] for h in headers],
+            index,
+            shape,
+            dtype,
+        )
+
+    @classmethod
+    def concatenate(cls, stacks: Sequence["MMapImageStack"]) -> "MMapImageStack":
+        fnames, offsets, nimages, index = [], [], [], []
+        for s in stacks:
+            assert s.shape == stacks[0].shape and s.dtype == stacks[0].dtype
+            index.append(s.index + np.array([len(fnames), 0]))
+            fnames.extend(s.fnames)
+            offsets.extend(s.offsets)
+            nimages.extend(s.nimages)
+        return cls(
+            fnames,
+            offsets,
+            nimages,
+            np.concatenate(index),
+            stacks[0].shape,
+            stacks[0].dtype,
+        )
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __iter__(self):
+        return (MMapImage(self, i) for i in range(len(self)))
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            if not 0 <= key < len(self):
+                raise IndexError(f"index {key} out of range for stack of {len(self)}")
+            return MMapImage(self, int(key))
+        if not isinstance(key, slice):
+            key = np.asarray(key)
+        return MMapImageStack(
+            self.fnames,
+            self.offsets,
+            self.nimages,
+            self.index[key],
+            self.shape,
+            self.dtype,
+            _mmaps=self._mmaps,
+        )
+
+    def __getstate__(self):
+        # memory maps are re-opened on demand instead of being pickled by value
+        state = self.__dict__.copy()
+        state["_mmaps"] = OrderedDict()
+        return state
+
+    def _mmap(self, file_id: int) -> np.memmap:
+        mm = self._mmaps.get(file_id)
+        if mm is None:
+            mm = np.memmap(
+                self.fnames[file_id],
+                dtype=self.dtype,
+                mode="r",
+                offset=self.offsets[file_id],
+                shape=(self.nimages[file_id], *self.shape),
+            )
+            self._mmaps[file_id] = mm
+            if len(self._mmaps) > self.max_open:
+                self._mmaps.popitem(last=False)
+        else:
+            self._mmaps.move_to_end(file_id)
+        return mm
+
+    def images(self, ind=None, copy: bool = True) -> np.ndarray:
+        """
+        Read the images at `ind` (all images if None) into an (n, ny, nx) array
+
+        Reads are grouped by file and sorted by position within each file. If copy=False and
+        the selected images are a contiguous run of a single file, a read-only view of the
+        mapping is returned instead of a copy.
+        """
+        index = self.index if ind is None else self.index[ind]
+        if index.ndim == 1:
+            index = index[None]
+        n = len(index)
+        if n == 0:
+            return np.empty((0, *self.shape), dtype=self.dtype)
+        fids, iis = index[:, 0], index[:, 1]
+        if (fids == fids[0]).all():
+            mm = self._mmap(int(fids[0]))
+            if iis[-1] - iis[0] == n - 1 and (n == 1 or (np.diff(iis) == 1).all()):
+                view = np.asarray(mm[iis[0] : iis[0] + n])
+                return view.copy() if copy else view
+            order = np.argsort(iis, kind="stable")
+            out = np.empty((n, *self.shape), dtype=self.dtype)
+            out[order] = mm[iis[order]]
+            return out
+
+        out = np.empty((n, *self.shape), dtype=self.dtype)
+        order = np.lexsort((iis, fids))
+        bounds = np.flatnonzero(np.diff(fids[order])) + 1
+        for group in np.split(order, bounds):
+            out[group] = self._mmap(int(fids[group[0]]))[iis[group]]
+        return out
+
+
 def parse_mrc_list(txtfile: str, lazy: bool = False) -> types.ImageArray:
     lines = open(txtfile, "r").readlines()
 
@@ -222,7 +405,9 @@ def parse_mrc_list(txtfile: str, lazy: bool = False) -> types.ImageArray:
             arrays.append(array)
         particles = np.vstack(arrays)
     else:
-        particles = [img for x in lines for img in parse_mrc(x.strip(), lazy=True)[0]]
+        particles = MMapImageStack.concatenate(
+            [parse_mrc(x.strip(), lazy=True)[0] for x in lines]
+        )
     return particles
 
 
@@ -243,12 +428,16 @@ def parse_mrc(fname: str, lazy: bool = False) -> Tuple[types.ImageArray, MRCHead
             fh.read(start)  # skip the header + extended header
             array = np.fromfile(fh, dtype=dtype).reshape((nz, ny, nx))
 
-    # or list of LazyImages
+    # or a memory-mapped stack of images
     else:
-        stride = dtype().itemsize * ny * nx
-        array = [
-            LazyImage(fname, (ny, nx), dtype, start + i * stride) for i in range(nz)
-        ]
+        array = MMapImageStack(
+            [fname],
+            [start],
+            [nz],
+            np.stack([np.zeros(nz, dtype=np.int64), np.arange(nz)], axis=1),
+            (ny, nx),
+            dtype,
+        )
     return array, header  # type: ignore
 
 
@@ -273,3 +462,83 @@ def write(
     f = open(fname, "wb")
     header.write(f)
     f.write(array.tobytes())
+
+
+def _stack_header(
+    shape: Tuple[int, int, int], dtype: np.dtype, Apix: float
+) -> MRCHeader:
+    header = MRCHeader.make_default_header(
+        np.broadcast_to(np.zeros((), dtype=dtype), shape), is_vol=False, Apix=Apix
+    )
+    header.fields["mode"] = MODE_FOR_DTYPE[dtype.type]
+    header.dtype = dtype.type
+    return header
+
+
+def allocate_stack(
+    fname: str,
+    shape: Tuple[int, int, int],
+    dtype: Any = np.float32,
+    Apix: float = 1.0,
+) -> np.memmap:
+    """
+    Preallocate an (N, ny, nx) image stack on disk and return a writable memory map of its
+    image data, so that large stacks can be filled in place batch by batch
+    """
+    dtype = np.dtype(dtype)
+    header = _stack_header(shape, dtype, Apix)
+    with open(fname, "wb") as f:
+        header.write(f)
+        f.truncate(1024 + int(np.prod(shape)) * dtype.itemsize)
+    return np.memmap(fname, dtype=dtype, mode="r+", offset=1024, shape=shape)
+
+
+class MRCStackWriter:
+    """
+    Write an image stack to an .mrcs file by appending batches of (n, ny, nx) images,
+    for stacks whose size is not known in advance or that do not fit in memory
+
+    The header is written when the file is opened and updated with the final number of
+    images on `close()`. Use as a context manager:
+
+        with MRCStackWriter(fname, (ny, nx)) as writer:
+            for batch in batches:
+                writer.write(batch)
+    """
+
+    def __init__(
+        self,
+        fname: str,
+        shape: Tuple[int, int],
+        dtype: Any = np.float32,
+        Apix: float = 1.0,
+    ):
+        self.fname = fname
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.Apix = Apix
+        self.n = 0
+        self.header = _stack_header((0, *self.shape), self.dtype, Apix)
+        self.f = open(fname, "wb")
+        self.header.write(self.f)
+
+    def write(self, imgs: np.ndarray) -> None:
+        assert imgs.shape[1:] == self.shape, f"{imgs.shape[1:]} != {self.shape}"
+        self.f.write(np.ascontiguousarray(imgs, dtype=self.dtype).tobytes())
+        self.n += len(imgs)
+
+    def close(self) -> None:
+        if self.f.closed:
+            return
+        self.header.fields["nz"] = self.n
+        self.header.fields["mz"] = self.n
+        self.header.fields["zlen"] = self.Apix * self.n
+        self.f.seek(0)
+        self.header.write(self.f)
+        self.f.close()
+
+    def __enter__(self) -> "MRCStackWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
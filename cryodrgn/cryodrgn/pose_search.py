@@ -1,4 +1,5 @@
 import logging
+import time
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -46,6 +47,8 @@ def interpolate(img: torch.Tensor, coords: torch.Tensor) -> torch.Tensor:
 
 
 FAST_INPLANE = True
+# max number of pixels interpolated by a single grid_sample call in rotate_images
+ROTATE_MAX_NUMEL = 2**25
 
 
 class PoseSearch:
@@ -67,11 +70,13 @@ class PoseSearch:
         t_xshift: int = 0,
         t_yshift: int = 0,
         device: Optional[torch.device] = None,
+        adaptive_margin: Optional[float] = None,
     ):
 
         self.model = model
         self.lattice = lattice
         self.base_healpy = base_healpy
+        so3_grid.load_tables(base_healpy, niter)
         self.so3_base_quat = so3_grid.grid_SO3(base_healpy)
         self.base_quat = (
             so3_grid.s2_grid_SO3(base_healpy) if FAST_INPLANE else self.so3_base_quat
@@ -99,11 +104,38 @@ class PoseSearch:
         self.niter = niter
         self.tilt = tilt
         self.nkeptposes = nkeptposes
+        # if set, only keep up to nkeptposes poses per image whose loss is within
+        # adaptive_margin standard deviations of the image's best loss at each level
+        self.adaptive_margin = adaptive_margin
         self.loss_fn = loss_fn
-        self._so3_neighbor_cache = {}  # for memoization
         self._shift_neighbor_cache = {}  # for memoization
+        self._base_shift_tables = {}  # phase shifts of base_shifts for each L
 
         self.device = device
+        self.reset_stats()
+
+    def reset_stats(self) -> None:
+        """Reset the per-stage timings and pose counts accumulated by opt_theta_trans"""
+        self.stats = {
+            "images": 0,
+            "time": np.zeros(self.niter + 1),
+            "poses": np.zeros(self.niter + 1, dtype=np.int64),
+        }
+
+    def _record_stats(self, stage: int, t0: float, loss: torch.Tensor) -> float:
+        t = time.perf_counter()
+        self.stats["time"][stage] += t - t0
+        self.stats["poses"][stage] += loss.numel()
+        return t
+
+    def summarize_stats(self) -> str:
+        """Summary of the time spent and poses evaluated at each stage of the search"""
+        n = max(self.stats["images"], 1)
+        stages = ", ".join(
+            f"{'base' if i == 0 else f'iter {i}'}: {t:.1f}s, {p / n:.0f} poses/img"
+            for i, (t, p) in enumerate(zip(self.stats["time"], self.stats["poses"]))
+        )
+        return f"Pose search on {self.stats['images']} images -- {stages}"
 
     def eval_grid(
         self,
@@ -207,7 +239,17 @@ class PoseSearch:
 
         B = images.size(0)
         mask = self.lattice.get_circular_mask(L)
-        res = self.lattice.translate_ht(images.view(B, -1)[:, mask], shifts, mask)
+        table = None
+        if shifts is self.base_shifts:
+            # the phase shifts of the base shift grid are the same for every batch
+            if L not in self._base_shift_tables:
+                self._base_shift_tables[L] = self.lattice.get_translation_table(
+                    shifts, mask
+                )
+            table = self._base_shift_tables[L]
+        res = self.lattice.translate_ht(
+            images.view(B, -1)[:, mask], shifts, mask, table=table
+        )
 
         return res
 
@@ -218,37 +260,32 @@ class PoseSearch:
         BNQ = B * NQ
         squeezed_images = images.view(BNQ, YX)
         D = self.lattice.D
-        res = torch.zeros((B * NQ, len(angles), YX), device=images.device)
         # B x NQ x YX
         mask = self.lattice.get_circular_mask(L)
 
         rot_matrices = torch.stack([rot_2d(a, 2, images.device) for a in angles], dim=0)
         lattice_coords = self.lattice.coords[mask][:, :2]
-        rot_coords = lattice_coords @ rot_matrices
+        rot_coords = lattice_coords @ rot_matrices  # NA x YX x 2
 
         full_images = torch.zeros((BNQ, D, D), device=images.device)
         full_images.view(BNQ, D * D)[:, mask] = squeezed_images
 
-        for angle_idx, interp_coords in enumerate(rot_coords):
-            interpolated = interpolate(full_images, interp_coords)
-            assert squeezed_images.shape == interpolated.shape
-            # IMPORTANT TRICK HERE!
-            interpolated *= squeezed_images.std(-1, keepdim=True) / interpolated.std(
-                -1, keepdim=True
-            )  # FIXME
-
-            res[:, angle_idx] = interpolated
+        # sample all angles in one call, or in chunks of angles if that is too large
+        chunk = max(1, ROTATE_MAX_NUMEL // (BNQ * YX))
+        res = torch.cat(
+            [
+                interpolate(full_images, c.reshape(-1, 2)).view(BNQ, -1, YX)
+                for c in rot_coords.split(chunk)
+            ],
+            dim=1,
+        )  # BNQ x NA x YX
+        # IMPORTANT TRICK HERE!
+        res *= squeezed_images.std(-1, keepdim=True)[:, None] / res.std(
+            -1, keepdim=True
+        )  # FIXME
 
         return res.view(B, 1, NQ * len(angles), YX)
 
-    def get_neighbor_so3(self, quat: np.ndarray, s2i: int, s1i: int, res: int):
-        """Memoization of so3_grid.get_neighbor."""
-        key = (int(s2i), int(s1i), int(res))
-        if key not in self._so3_neighbor_cache:
-            self._so3_neighbor_cache[key] = so3_grid.get_neighbor(quat, s2i, s1i, res)
-        # FIXME: will this cache get too big? maybe don't do it when res is too
-        return self._so3_neighbor_cache[key]
-
     def get_neighbor_shift(self, x, y, res):
         """Memoization of shift_grid.get_neighbor."""
         key = (int(x), int(y), int(res))
@@ -280,13 +317,10 @@ class PoseSearch:
         assert len(quat.shape) == 2 and quat.shape == (N, 4), quat.shape
         assert len(q_ind.shape) == 2 and q_ind.shape == (N, 2), q_ind.shape
 
-        # get neighboring SO3 elements at next resolution level -- todo: make this an array operation
-        neighbors = [
-            self.get_neighbor_so3(quat[i], q_ind[i][0], q_ind[i][1], cur_res)
-            for i in range(len(quat))
-        ]
-        quat = np.array([x[0] for x in neighbors])  # Bx8x4
-        q_ind = np.array([x[1] for x in neighbors])  # Bx8x2
+        # get neighboring SO3 elements at next resolution level
+        quat, q_ind = so3_grid.get_neighbors(
+            quat, q_ind[:, 0], q_ind[:, 1], cur_res
+        )  # Bx8x4, Bx8x2
         rot = lie_tools.quaternions_to_SO3(torch.from_numpy(quat).view(-1, 4)).to(
             self.device
         )
@@ -324,6 +358,54 @@ class PoseSearch:
         keep_idx[1] = best_trans_idx[keep_idx[0], keep_idx[2]]
         return keep_idx
 
+    def keep_matrix_adaptive(
+        self, loss: torch.Tensor, keepB: torch.Tensor, B: int, max_poses: int
+    ) -> torch.Tensor:
+        """
+        Inputs:
+            loss (N, T, Q): tensor of losses for each translation and rotation of N
+                groups of candidate poses
+            keepB (N): index of the image each group belongs to, in ascending order
+
+        Returns:
+            keep (3, M): index of the group, best translation and rotation of the poses
+                to keep, ordered by image. At least one and at most max_poses poses are
+                kept per image, dropping those with loss over adaptive_margin standard
+                deviations above the image's best loss.
+        """
+        N, T, Q = loss.shape
+        best_loss, best_trans_idx = loss.min(1)  # N x Q
+        keepB = keepB.to(loss.device)
+
+        # scatter the candidates of each image into a padded B x (max groups * Q) array
+        counts = torch.bincount(keepB, minlength=B)
+        start = torch.cumsum(counts, 0) - counts
+        slot = torch.arange(N, device=loss.device) - start[keepB]
+        padded = loss.new_full((B, int(counts.max()), Q), float("inf"))
+        padded[keepB, slot] = best_loss
+        padded = padded.view(B, -1)
+        valid = torch.isfinite(padded)
+
+        top_loss, top_idx = padded.topk(
+            min(max_poses, padded.shape[1]), dim=-1, largest=False, sorted=True
+        )
+        n = valid.sum(-1, keepdim=True)
+        mean = torch.where(valid, padded, 0).sum(-1, keepdim=True) / n
+        std = (
+            torch.where(valid, padded - mean, 0).pow(2).sum(-1, keepdim=True) / n
+        ).sqrt()
+        keep = top_loss <= top_loss[:, :1] + self.adaptive_margin * std
+        keep &= torch.isfinite(top_loss)
+        keep[:, 0] = True
+
+        b, rank = keep.nonzero(as_tuple=True)
+        group, q = (
+            torch.div(top_idx[b, rank], Q, rounding_mode="floor"),
+            top_idx[b, rank] % Q,
+        )
+        group += start[b]
+        return torch.stack((group, best_trans_idx[group, q], q))
+
     def getL(self, iter_: int) -> int:
         L = self.Lmin + int(iter_ / self.niter * (self.Lmax - self.Lmin))
         return min(L, self.lattice.D // 2)
@@ -346,6 +428,9 @@ class PoseSearch:
 
         B = images.size(0)
         assert not self.model.training
+        adaptive = self.adaptive_margin is not None
+        self.stats["images"] += B
+        t0 = time.perf_counter()
 
         loss = rot = None
         if init_poses is None:
@@ -374,6 +459,7 @@ class PoseSearch:
             keepB, keepT, keepQ = self.keep_matrix(
                 loss, B, self.nkeptposes
             ).cpu()  # B x -1
+            t0 = self._record_stats(0, t0, loss)
         else:
             # careful, overwrite the old batch index which is now invalid
             keepB = (
@@ -389,6 +475,11 @@ class PoseSearch:
             .view(2, B, self.nkeptposes)
             .permute(1, 2, 0)
         )
+        if adaptive and init_poses is None:
+            keepB, keepT, keepQ = self.keep_matrix_adaptive(
+                loss, torch.arange(B), B, self.nkeptposes
+            ).cpu()
+        loss_keepB = torch.arange(B)  # image index of each group of poses in loss
 
         quat = self.so3_base_quat[keepQ]
         q_ind = so3_grid.get_base_ind(keepQ, self.base_healpy)  # Np x 2
@@ -423,19 +514,32 @@ class PoseSearch:
             # nkeptposes = max(1, math.ceil(self.nkeptposes / 2 ** (iter_-1)))
             nkeptposes = self.nkeptposes if iter_ < self.niter else 1
 
-            keepBN, keepT, keepQ = self.keep_matrix(
-                loss, B, nkeptposes
-            ).cpu()  # B x (self.Nkeptposes*32)
-            keepB = keepBN * B // loss.shape[0]  # FIXME: expain
-            assert (
-                len(keepB) == B * nkeptposes
-            ), f"{len(keepB)} != {B} x {nkeptposes} at iter {iter_}"
+            loss_keepB = keepB
+            if adaptive:
+                keepBN, keepT, keepQ = self.keep_matrix_adaptive(
+                    loss, keepB, B, nkeptposes
+                ).cpu()
+                keepB = keepB[keepBN]
+            else:
+                keepBN, keepT, keepQ = self.keep_matrix(
+                    loss, B, nkeptposes
+                ).cpu()  # B x (self.Nkeptposes*32)
+                keepB = keepBN * B // loss.shape[0]  # FIXME: expain
+                assert (
+                    len(keepB) == B * nkeptposes
+                ), f"{len(keepB)} != {B} x {nkeptposes} at iter {iter_}"
+            t0 = self._record_stats(iter_, t0, loss)
             quat = quat[keepBN, keepQ]
             q_ind = q_ind[keepBN, keepQ]
             trans = trans[keepBN, keepT]
 
         assert loss is not None
-        bestBN, bestT, bestQ = self.keep_matrix(loss, B, 1).cpu()
+        if adaptive:
+            bestBN, bestT, bestQ = self.keep_matrix_adaptive(
+                loss, loss_keepB, B, 1
+            ).cpu()
+        else:
+            bestBN, bestT, bestQ = self.keep_matrix(loss, B, 1).cpu()
         assert len(bestBN) == B
         if self.niter == 0:
             best_rot = self.so3_base_rot[bestQ].to(device)
@@ -446,3 +550,37 @@ class PoseSearch:
             best_trans = trans.to(device)
 
         return best_rot, best_trans, new_init_poses
+
+
+class PoseStore:
+    """
+    Preallocated per-particle store of the poses found by pose search, kept on the
+    compute device and addressed by particle index so that poses can be written and
+    reused batch by batch without gathering and sorting them every epoch
+    """
+
+    def __init__(self, N: int, device: Optional[torch.device] = None):
+        self.rot = torch.zeros((N, 3, 3), device=device)
+        self.trans = torch.zeros((N, 2), device=device)
+
+    def __len__(self) -> int:
+        return len(self.rot)
+
+    def update(self, ind: torch.Tensor, rot: torch.Tensor, trans: torch.Tensor) -> None:
+        ind = torch.as_tensor(ind, device=self.rot.device)
+        self.rot[ind] = rot.detach().to(self.rot)
+        self.trans[ind] = trans.detach().view(-1, 2).to(self.trans)
+
+    def get(self, ind: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        ind = torch.as_tensor(ind, device=self.rot.device)
+        return self.rot[ind], self.trans[ind]
+
+    def load(self, rot: np.ndarray, trans: np.ndarray) -> None:
+        """Fill the store from pose arrays for all particles, e.g. from a checkpoint"""
+        assert len(rot) == len(trans) == len(self), (len(rot), len(trans), len(self))
+        self.rot[:] = torch.as_tensor(rot).to(self.rot)
+        self.trans[:] = torch.as_tensor(trans).to(self.trans)
+
+    def numpy(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Rotations and translations of all particles, for saving"""
+        return self.rot.cpu().numpy(), self.trans.cpu().numpy()
@@ -3,11 +3,54 @@ Implementation of Yershova et al. "Generating uniform incremental
 grids on SO(3) using the Hopf fribration"
 """
 
-import json
+import functools
+import logging
 import os
 
 import numpy as np
 
+logger = logging.getLogger(__name__)
+
+# Grid and neighbor tables are computed once per resolution level, then kept in memory
+# and saved here so that later runs can load them instead
+CACHE_DIR = os.environ.get(
+    "CRYODRGN_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "cryodrgn")
+)
+# bump when the contents of the cached tables change
+_CACHE_VERSION = 1
+
+
+def cached_table(name):
+    """
+    Memoize a function of the resolution level returning a tuple of arrays, both in
+    memory and as an .npz file in CACHE_DIR. The returned arrays are read-only.
+    """
+
+    def decorator(func):
+        @functools.lru_cache(maxsize=None)
+        @functools.wraps(func)
+        def wrapper(resol):
+            path = os.path.join(CACHE_DIR, f"so3_{name}.v{_CACHE_VERSION}.{resol}.npz")
+            try:
+                with np.load(path) as f:
+                    ret = tuple(f[f"arr_{i}"] for i in range(len(f.files)))
+            except (OSError, ValueError, KeyError):
+                ret = func(resol)
+                try:
+                    os.makedirs(CACHE_DIR, exist_ok=True)
+                    tmp = f"{path}.{os.getpid()}.npz"
+                    np.savez(tmp, *ret)
+                    os.replace(tmp, path)
+                except OSError as e:
+                    logger.debug(f"Could not cache SO3 grid table to {path}: {e}")
+            for x in ret:
+                x.flags.writeable = False
+            return ret
+
+        return wrapper
+
+    return decorator
+
 
 def grid_s1(resol):
     Npix = 6 * 2**resol
@@ -17,10 +60,15 @@ def grid_s1(resol):
 
 
 def grid_s2(resol):
+    return s2_table(resol)
+
+
+@cached_table("s2")
+def s2_table(resol):
+    """theta, phi of every point of the HEALPix grid with Nside=2**resol, nest ordering"""
     Nside = 2**resol
     Npix = 12 * Nside * Nside
-    theta, phi = pix2ang(Nside, np.arange(Npix), nest=True)
-    return theta, phi
+    return pix2ang(Nside, np.arange(Npix), nest=True)
 
 
 def hopf_to_quat(theta, phi, psi):
@@ -84,9 +132,9 @@ def get_s2_neighbor(mini, cur_res):
     """
     Return the 4 nearest neighbors on S2 at the next resolution level
     """
-    Nside = 2 ** (cur_res + 1)
+    theta, phi = s2_table(cur_res + 1)
     ind = np.arange(4) + 4 * mini
-    return pix2ang(Nside, ind, nest=True), ind
+    return (theta[ind], phi[ind]), ind
 
 
 def get_base_ind(ind, base):
@@ -119,24 +167,141 @@ def get_neighbor(quat, s2i, s1i, cur_res):
     return quat_n[ii], ind[ii]
 
 
-try:
-    with open(f"{os.path.dirname(__file__)}/healpy_grid.json") as hf:
-        _GRIDS = {int(k): np.array(v).T for k, v in json.load(hf).items()}
-except IOError:
-    print(
-        "WARNING: Couldn't load cached healpy grid; will fall back to importing healpy"
+def get_neighbors(quat, s2i, s1i, cur_res):
+    """
+    Batched version of get_neighbor: return the 8 nearest neighbors on SO3 at the next
+    resolution level for N grid points at once
+
+    Inputs:
+        quat (N x 4 np.array): quaternions of the grid points at cur_res
+        s2i, s1i (N np.array): S2 and S1 grid indices of the grid points
+        cur_res (int): current resolution level
+
+    Returns:
+        quat (N x 8 x 4) np.array, ind (N x 8 x 2) np.array
+    """
+    s2i = np.asarray(s2i, dtype=np.int64)
+    s1i = np.asarray(s1i, dtype=np.int64)
+    N = len(s2i)
+    if N and NEIGHBOR_TABLE_MAXSIZE and grid_size(cur_res) <= NEIGHBOR_TABLE_MAXSIZE:
+        table_quat, table_ind = _neighbor_table(cur_res)
+        ii = s2i * (6 * 2**cur_res) + s1i % (6 * 2**cur_res)
+        return table_quat[ii], table_ind[ii]
+    return _get_neighbors(np.asarray(quat), s2i, s1i, cur_res)
+
+
+def _get_neighbors(quat, s2i, s1i, cur_res):
+    N = len(s2i)
+    # 4 children on S2 x 4 candidates on S1 for each grid point
+    s2_nexti = 4 * s2i[:, None] + np.arange(4)  # N x 4
+    theta, phi = s2_table(cur_res + 1)
+    theta, phi = theta[s2_nexti.ravel()], phi[s2_nexti.ravel()]
+    Npix = 6 * 2 ** (cur_res + 1)
+    dt = 2 * np.pi / Npix
+    s1_nexti = 2 * s1i[:, None] + np.arange(-1, 3)  # N x 4
+    s1_nexti[:, 0] = np.where(s1_nexti[:, 0] < 0, s1_nexti[:, 0] + Npix, s1_nexti[:, 0])
+    psi = s1_nexti * dt + dt / 2
+
+    quat_n = hopf_to_quat(
+        np.repeat(theta, 4),
+        np.repeat(phi, 4),
+        np.repeat(psi[:, None, :], 4, axis=1).ravel(),
+    ).reshape(N, 16, 4)
+    ind = np.stack(
+        (np.repeat(s2_nexti, 4, axis=1), np.tile(s1_nexti, (1, 4))), axis=-1
+    )  # N x 16 x 2
+
+    # find the 8 nearest neighbors of 16 possible points
+    # need to check distance from both +q and -q
+    quat = quat[:, None, :]
+    dists = np.minimum(
+        np.sum((quat_n - quat) ** 2, axis=-1), np.sum((quat_n + quat) ** 2, axis=-1)
+    )
+    ii = np.argsort(dists, axis=1)[:, :8]
+    return (
+        np.take_along_axis(quat_n, ii[..., None], axis=1),
+        np.take_along_axis(ind, ii[..., None], axis=1),
     )
-    _GRIDS = None
+
+
+def grid_size(resol):
+    """Number of points on the SO3 grid at this resolution level"""
+    return 12 * 4**resol * 6 * 2**resol
+
+
+# Neighbors of every grid point are tabulated for resolution levels with at most this
+# many grid points (~10 MB of tables per level), and computed on the fly above that
+NEIGHBOR_TABLE_MAXSIZE = 2**16
+
+
+@cached_table("neighbors")
+def _neighbor_table(cur_res):
+    Ns1 = 6 * 2**cur_res
+    s2i, s1i = np.divmod(np.arange(grid_size(cur_res)), Ns1)
+    return _get_neighbors(grid_SO3(cur_res), s2i, s1i, cur_res)
+
+
+def load_tables(base, niter):
+    """
+    Load (or compute and cache) the grid tables used by `niter` rounds of incremental
+    neighbor search starting from resolution level `base`
+    """
+    s2_table(base + niter)
+    for resol in range(base, base + niter):
+        s2_table(resol)
+        if NEIGHBOR_TABLE_MAXSIZE and grid_size(resol) <= NEIGHBOR_TABLE_MAXSIZE:
+            _neighbor_table(resol)
+
+
+# HEALPix base faces, in units of Nside: ring index of the southernmost corner of each
+# face, and longitude of its center in units of pi/4
+_JRLL = np.array([2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4])
+_JPLL = np.array([1, 3, 5, 7, 0, 2, 4, 6, 1, 3, 5, 7])
 
 
 def pix2ang(Nside, ipix, nest=False, lonlat=False):
-    if _GRIDS is not None and Nside in _GRIDS and nest and not lonlat:
-        return _GRIDS[Nside][ipix].T
-    else:
-        try:
-            import healpy
-        except ImportError:
-            raise RuntimeError(
-                "You need to `pip install healpy` to run with non-standard grid sizes."
-            )
-        return healpy.pix2ang(Nside, ipix, nest=nest, lonlat=lonlat)
+    if nest and not lonlat:
+        return _pix2ang_nest(Nside, ipix)
+    try:
+        import healpy
+    except ImportError:
+        raise RuntimeError(
+            "You need to `pip install healpy` to run with non-standard grid sizes."
+        )
+    return healpy.pix2ang(Nside, ipix, nest=nest, lonlat=lonlat)
+
+
+def _pix2ang_nest(Nside, ipix):
+    """
+    Vectorized HEALPix pix2ang for the nested scheme, following Gorski et al. 2005
+
+    Returns:
+        theta, phi (np.array): colatitude in [0, pi] and longitude in [0, 2pi)
+    """
+    ipix = np.asarray(ipix, dtype=np.int64)
+    npface = Nside * Nside
+    face, ipf = np.divmod(ipix, npface)
+
+    # deinterleave the bits of the index within its face into (x, y) coordinates
+    ix = np.zeros_like(ipf)
+    iy = np.zeros_like(ipf)
+    for b in range(int(Nside).bit_length() - 1):
+        ix |= ((ipf >> (2 * b)) & 1) << b
+        iy |= ((ipf >> (2 * b + 1)) & 1) << b
+
+    jr = _JRLL[face] * Nside - ix - iy - 1  # ring index counted from the north pole
+    north = jr < Nside
+    south = jr > 3 * Nside
+    nr = np.where(north, jr, np.where(south, 4 * Nside - jr, Nside))
+    z = np.where(
+        north,
+        1 - nr * nr / (3.0 * npface),
+        np.where(south, nr * nr / (3.0 * npface) - 1, (2 * Nside - jr) * 2 / 3 / Nside),
+    )
+    kshift = np.where(north | south, 0, (jr - Nside) & 1)
+
+    jp = (_JPLL[face] * nr + ix - iy + 1 + kshift) // 2
+    jp = np.where(jp > 4 * Nside, jp - 4 * Nside, jp)
+    jp = np.where(jp < 1, jp + 4 * Nside, jp)
+    phi = (jp - (kshift + 1) * 0.5) * (np.pi / 2 / nr)
+    return np.arccos(z), phi
@@ -0,0 +1,62 @@
+"""
+Streaming transforms of particle stacks
+
+Images are read from a lazily-loaded stack, transformed and appended to the output
+.mrcs file one batch at a time, so that only a couple of batches are ever held in
+memory whatever the size of the stack. Reads of each batch are grouped by file and
+sorted by offset (see MMapImageStack.images), and the next batch is read in a
+background thread while the current one is being transformed and written.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, Optional, Tuple
+
+import numpy as np
+
+from cryodrgn import mrc
+
+logger = logging.getLogger(__name__)
+
+# transform(imgs, ind) -> transformed imgs, given a batch of images and their positions
+# in the stack
+Transform = Callable[[np.ndarray, np.ndarray], np.ndarray]
+
+
+def iter_batches(
+    particles: mrc.MMapImageStack, batch_size: int
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Yield (ind, imgs) for consecutive batches of images, reading one batch ahead"""
+    N = len(particles)
+
+    def read(start: int) -> np.ndarray:
+        return particles.images(slice(start, start + batch_size))
+
+    with ThreadPoolExecutor(1) as executor:
+        future = executor.submit(read, 0)
+        for start in range(0, N, batch_size):
+            imgs = future.result()
+            if start + batch_size < N:
+                future = executor.submit(read, start + batch_size)
+            yield np.arange(start, start + len(imgs)), imgs
+
+
+def transform_stack(
+    particles: mrc.MMapImageStack,
+    out_mrcs: str,
+    transform: Optional[Transform] = None,
+    batch_size: int = 1000,
+    dtype=np.float32,
+    Apix: float = 1.0,
+) -> None:
+    """
+    Write transform(imgs, ind) for all batches of images in `particles` to out_mrcs, or
+    the images themselves if no transform is given
+    """
+    N = len(particles)
+    nbatches = -(-N // batch_size)
+    with mrc.MRCStackWriter(out_mrcs, particles.shape, dtype, Apix) as writer:
+        for i, (ind, imgs) in enumerate(iter_batches(particles, batch_size)):
+            logger.info(f"Processing batch {i + 1} of {nbatches}")
+            writer.write(imgs if transform is None else transform(imgs, ind))
+    logger.info(f"Wrote {N} images to {out_mrcs}")
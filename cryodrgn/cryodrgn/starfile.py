@@ -1,14 +1,16 @@
 """
 Lightweight parser for starfiles
 """
+import io
+import mmap
 import os
+import re
 from datetime import datetime as dt
 import numpy as np
 import pandas as pd
-from typing import Optional, List
+from typing import Dict, Optional, List
 import cryodrgn.types as types
-from cryodrgn import mrc
-from cryodrgn.mrc import LazyImage
+from cryodrgn.mrc import MMapImageStack
 
 
 class Starfile:
@@ -31,101 +33,44 @@ class Starfile:
 
     @classmethod
     def load(cls, starfile: str):
-        # detect star file type
-        f = open(starfile, "r")
-        BLOCK = "data_"
-        line = ""
-        while 1:
-            for line in f:
-                if line.startswith(BLOCK):
-                    break
-            break
-        if line.startswith("data_optics"):
-            return cls._parse_relion31(starfile)
-        else:
-            return cls._parse_block(starfile, block_header="data_")
-
-    @classmethod
-    def _parse_relion31(cls, starfile: str):
-        data_optics = cls._parse_block(starfile, block_header="data_optics")
-        s = cls._parse_block(starfile, block_header="data_particles")
-        s.data_optics = data_optics
-        s.relion31 = True
-        return s
-
-    @classmethod
-    def _parse_block(cls, starfile: str, block_header: str = "data_"):
-        headers = []
-        line = ""
-        f = open(starfile, "r")
-        # get to data block
-        while True:
-            for line in f:
-                if line.startswith(block_header):
-                    break
-            break
-        # get to header loop
-        while True:
-            for line in f:
-                if line.startswith("loop_"):
-                    break
-            break
-        # get list of column headers
-        while True:
-            headers = []
-            for line in f:
-                if line.startswith("_"):
-                    headers.append(line)
-                else:
-                    break
-            break
-        # assume all subsequent lines until empty line is the body
-        headers = [h.strip().split()[0] for h in headers]
-        body = [line]
-        for line in f:
-            if line.strip() == "":
-                break
-            body.append(line)
-        # put data into an array and instantiate as dataframe
-        words = [line.strip().split() for line in body]
-        words = np.array(words)
-        assert (
-            words.ndim == 2
-        ), f"Error in parsing. Uneven # columns detected in parsing {set([len(x) for x in words])}."
-        assert words.shape[1] == len(
-            headers
-        ), f"Error in parsing. Number of columns {words.shape[1]} != number of headers {len(headers)}"
-        data = {h: words[:, i] for i, h in enumerate(headers)}
-        df = pd.DataFrame(data=data)
-        return cls(headers, df)
+        blocks = read_blocks(starfile)
+        if "optics" in blocks:
+            s = cls(None, blocks["particles"])
+            s.data_optics = cls(None, blocks["optics"])
+            s.relion31 = True
+            return s
+        if "particles" in blocks:
+            return cls(None, blocks["particles"])
+        assert blocks, f"No data blocks found in {starfile}"
+        return cls(None, next(iter(blocks.values())))
 
     def _write_block(self, f, headers, df, block_header="data_"):
         f.write(f"{block_header}\n\n")
         f.write("loop_\n")
         f.write("\n".join(headers))
         f.write("\n")
-        for i in df.index:
-            # TODO: Assumes header and df ordering is consistent
-            f.write(" ".join([str(v) for v in df.loc[i]]))
-            f.write("\n")
+        # TODO: Assumes header and df ordering is consistent
+        df.to_csv(f, sep=" ", header=False, index=False)
 
     def write(self, outstar: str):
-        f = open(outstar, "w")
-        f.write("# Created {}\n".format(dt.now()))
-        f.write("\n")
+        with open(outstar, "w") as f:
+            f.write("# Created {}\n".format(dt.now()))
+            f.write("\n")
 
-        if self.relion31:
-            assert self.data_optics is not None
-            self._write_block(
-                f,
-                self.data_optics.headers,
-                self.data_optics.df,
-                block_header="data_optics",
-            )
-            f.write("\n\n")
-            self._write_block(f, self.headers, self.df, block_header="data_particles")
-        else:
-            self._write_block(f, self.headers, self.df, block_header="data_")
+            if self.relion31:
+                assert self.data_optics is not None
+                self._write_block(
+                    f,
+                    self.data_optics.headers,
+                    self.data_optics.df,
+                    block_header="data_optics",
+                )
+                f.write("\n\n")
+                self._write_block(
+                    f, self.headers, self.df, block_header="data_particles"
+                )
+            else:
+                self._write_block(f, self.headers, self.df, block_header="data_")
 
     def get_particles(self, datadir: Optional[str] = None, lazy: bool = True):
         """
@@ -134,7 +79,7 @@ class Starfile:
         Input:
             datadir (str): Overwrite base directories of particle .mrcs
                 Tries both substituting the base path and prepending to the path
-            If lazy=True, returns list of LazyImage instances, else np.array
+            If lazy=True, returns a memory-mapped MMapImageStack, else np.array
         """
         particles = self.df["_rlnImageName"]
 
@@ -146,18 +91,101 @@ class Starfile:
             mrcs = prefix_paths(mrcs, datadir)
         for path in set(mrcs):
             assert os.path.exists(path), f"{path} not found"
-        header = mrc.parse_header(mrcs[0])
-        D = header.D  # image size along one dimension in pixels
-        dtype = header.dtype
-        stride = dtype().itemsize * D * D
-        dataset = [
-            LazyImage(f, (D, D), dtype, 1024 + ii * stride) for ii, f in zip(ind, mrcs)
-        ]
+        dataset = MMapImageStack.from_paths(mrcs, ind)
         if not lazy:
-            dataset = np.array([x.get() for x in dataset])
+            dataset = dataset.images()
         return dataset
 
 
+# patterns start with a newline rather than ^ with re.M, which is much slower to search
+_BLOCK_RE = re.compile(rb"\ndata_(\S*)")
+_LOOP_RE = re.compile(rb"\nloop_")
+_BLANK_RE = re.compile(rb"\n[ \t\r]*\n")
+
+
+def _is_string_label(label: str) -> bool:
+    """
+    Whether a column holds strings (names and paths) that must not be parsed as
+    numbers, even when they look like them, e.g. "_rlnGroupName 001"
+    """
+    return label.endswith(("Name", "Image"))
+
+
+def read_blocks(starfile: str) -> Dict[str, pd.DataFrame]:
+    """
+    Read all data blocks of a .star file in one pass
+
+    Returns:
+        dict mapping each block name (without the data_ prefix) to a DataFrame with
+        one column per label; numeric columns are parsed as int or float, except for
+        the string columns of _is_string_label, which are kept verbatim. Blocks
+        without a loop_ are returned as a single row.
+    """
+    with open(starfile, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return {}
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            starts = list(_BLOCK_RE.finditer(buf))
+            if buf[:5] == b"data_":
+                starts.insert(0, re.match(rb"data_(\S*)", buf))
+            blocks = {}
+            for m, next_m in zip(starts, starts[1:] + [None]):
+                end = next_m.start() if next_m is not None else len(buf)
+                df = _read_block(buf, m.end(), end)
+                if df is not None:
+                    blocks[m.group(1).decode()] = df
+    return blocks
+
+
+def _read_block(buf, start: int, end: int) -> Optional[pd.DataFrame]:
+    loop = _LOOP_RE.search(buf, start, end)
+    if loop is None:
+        # a block of "_label value" pairs
+        pairs = [
+            line.split(None, 1)
+            for line in buf[start:end].decode().splitlines()
+            if line.startswith("_")
+        ]
+        if not pairs:
+            return None
+        return pd.DataFrame({k: [v.strip()] for k, v in pairs})
+
+    # the column labels are the lines starting with "_" following loop_
+    headers = []
+    pos = buf.find(b"\n", loop.end(), end) + 1
+    while 0 < pos < end:
+        line_end = buf.find(b"\n", pos, end)
+        line_end = end if line_end == -1 else line_end
+        line = buf[pos:line_end].strip()
+        if line.startswith(b"_"):
+            headers.append(line.split()[0].decode())
+        elif line:
+            break
+        pos = line_end + 1
+    assert headers, "Error in parsing. No column headers found after loop_"
+
+    # the body is everything up to the next empty line
+    blank = _BLANK_RE.search(buf, pos, end) if pos < end else None
+    body_end = blank.start() + 1 if blank is not None else end
+    if pos >= body_end:
+        return pd.DataFrame({h: [] for h in headers})
+    df = pd.read_csv(
+        io.BytesIO(buf[pos:body_end]),
+        sep=r"\s+",
+        header=None,
+        dtype={i: str for i, h in enumerate(headers) if _is_string_label(h)},
+        low_memory=False,
+        keep_default_na=False,
+        na_values=[""],
+    )
+    assert df.shape[1] == len(headers) and not df.isna().to_numpy().any(), (
+        "Error in parsing. Uneven # columns detected, "
+        f"expected {len(headers)} to match the number of headers."
+    )
+    df.columns = headers
+    return df
+
+
 def prefix_paths(mrcs: List, datadir: str):
     mrcs1 = ["{}/{}".format(datadir, os.path.basename(x)) for x in mrcs]
     mrcs2 = ["{}/{}".format(datadir, x) for x in mrcs]
@@ -184,12 +212,7 @@ def csparc_get_particles(
         mrcs = prefix_paths(mrcs, datadir)
     for path in set(mrcs):
         assert os.path.exists(path), f"{path} not found"
-    D = metadata[0]["blob/shape"][0]
-    dtype = np.float32
-    stride = np.float32().itemsize * D * D
-    dataset = [
-        LazyImage(f, (D, D), dtype, 1024 + ii * stride) for ii, f in zip(ind, mrcs)
-    ]
+    dataset = MMapImageStack.from_paths(mrcs, ind)
     if not lazy:
-        dataset = np.array([x.get() for x in dataset])
+        dataset = dataset.images()
     return dataset
@@ -10,9 +10,9 @@ import numpy as np
 
 if TYPE_CHECKING:  # Set if type-checking
     # Avoid importing any cryodrgn-specific submodules outside this block.
-    from cryodrgn.mrc import LazyImage
+    from cryodrgn.mrc import LazyImage, MMapImageStack
 
-    ImageArray = Union[np.ndarray, List[LazyImage]]
+    ImageArray = Union[np.ndarray, List[LazyImage], MMapImageStack]
 
 else:
     """
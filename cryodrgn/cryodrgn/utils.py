@@ -1,4 +1,5 @@
 from collections.abc import Hashable
+from concurrent.futures import ThreadPoolExecutor
 import functools
 import os
 import pickle
@@ -53,41 +54,152 @@ def save_pkl(data, out_pkl: str, mode: str = "wb") -> None:
         pickle.dump(data, f)
 
 
-def R_from_eman(a: np.ndarray, b: np.ndarray, y: np.ndarray) -> np.ndarray:
-    a *= np.pi / 180.0
-    b *= np.pi / 180.0
-    y *= np.pi / 180.0
-    ca, sa = np.cos(a), np.sin(a)
-    cb, sb = np.cos(b), np.sin(b)
-    cy, sy = np.cos(y), np.sin(y)
-    Ra = np.array([[ca, -sa, 0], [sa, ca, 0], [0, 0, 1]])
-    Rb = np.array([[1, 0, 0], [0, cb, -sb], [0, sb, cb]])
-    Ry = np.array(([cy, -sy, 0], [sy, cy, 0], [0, 0, 1]))
-    R = np.dot(np.dot(Ry, Rb), Ra)
-    # handling EMAN convention mismatch for where the origin of an image is (bottom right vs top right)
-    R[0, 1] *= -1
-    R[1, 0] *= -1
-    R[1, 2] *= -1
-    R[2, 1] *= -1
+def _snapshot(data):
+    """Copy (nested dicts/lists/tuples of) tensors and arrays into fresh CPU memory"""
+    import torch
+
+    if isinstance(data, torch.Tensor):
+        return data.detach().to("cpu", copy=True)
+    if isinstance(data, np.ndarray):
+        return data.copy()
+    if isinstance(data, dict):
+        return type(data)((k, _snapshot(v)) for k, v in data.items())
+    if isinstance(data, (list, tuple)):
+        return type(data)(_snapshot(x) for x in data)
+    return data
+
+
+def _atomic_write(path: str, write_fn, data) -> None:
+    tmp_path = f"{path}.tmp"
+    write_fn(data, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoint files in a background thread so that training can continue
+    while they are serialized to disk.
+
+    The data passed to `write` is copied to CPU memory before returning, so the caller
+    is free to keep updating its tensors. Each file is first written to a temporary
+    path and then renamed, so an interrupted run never leaves a truncated checkpoint.
+    """
+
+    def __init__(self, background: bool = True):
+        self.executor = ThreadPoolExecutor(max_workers=1) if background else None
+        self.pending = []
+
+    def write(self, path: str, write_fn, data) -> None:
+        """Write `data` to `path` with `write_fn(data, path)`, e.g. torch.save"""
+        data = _snapshot(data)
+        if self.executor is None:
+            _atomic_write(path, write_fn, data)
+        else:
+            self.pending.append(
+                self.executor.submit(_atomic_write, path, write_fn, data)
+            )
+
+    def wait(self) -> None:
+        """Block until all pending writes are done, re-raising any of their errors"""
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+
+# EMAN and RELION put the image origin at a different corner than we do, which flips
+# the sign of the rotation matrix entries that mix y with x or z
+_IMAGE_ORIGIN_FLIP = np.array([[1.0, -1.0, 1.0], [-1.0, 1.0, -1.0], [1.0, -1.0, 1.0]])
+
+
+def _plane_rotation(theta: np.ndarray, i: int, j: int) -> np.ndarray:
+    """...x3x3 rotation matrices by angles theta (radians) in the plane of axes i, j"""
+    c, s = np.cos(theta), np.sin(theta)
+    R = np.zeros(theta.shape + (3, 3))
+    R[..., :, :] = np.eye(3)
+    R[..., i, i] = c
+    R[..., i, j] = -s
+    R[..., j, i] = s
+    R[..., j, j] = c
     return R
 
 
+def _R_from_euler(a, b, y, plane_b: Tuple[int, int]) -> np.ndarray:
+    a, b, y = np.broadcast_arrays(
+        *(np.deg2rad(np.asarray(x, dtype=np.float64)) for x in (a, b, y))
+    )
+    R = (
+        _plane_rotation(y, 0, 1)
+        @ _plane_rotation(b, *plane_b)
+        @ _plane_rotation(a, 0, 1)
+    )
+    return R * _IMAGE_ORIGIN_FLIP
+
+
+def R_from_eman(a: np.ndarray, b: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    Rotation matrices from EMAN euler angles (az, alt, phi) in degrees, given as
+    scalars (returns a 3x3 matrix) or arrays of length N (returns Nx3x3 matrices)
+    """
+    return _R_from_euler(a, b, y, (1, 2))
+
+
 def R_from_relion(a: np.ndarray, b: np.ndarray, y: np.ndarray) -> np.ndarray:
-    a *= np.pi / 180.0
-    b *= np.pi / 180.0
-    y *= np.pi / 180.0
-    ca, sa = np.cos(a), np.sin(a)
-    cb, sb = np.cos(b), np.sin(b)
-    cy, sy = np.cos(y), np.sin(y)
-    Ra = np.array([[ca, -sa, 0], [sa, ca, 0], [0, 0, 1]])
-    Rb = np.array([[cb, 0, -sb], [0, 1, 0], [sb, 0, cb]])
-    Ry = np.array(([cy, -sy, 0], [sy, cy, 0], [0, 0, 1]))
-    R = np.dot(np.dot(Ry, Rb), Ra)
-    R[0, 1] *= -1
-    R[1, 0] *= -1
-    R[1, 2] *= -1
-    R[2, 1] *= -1
-    return R
+    """
+    Rotation matrices from RELION euler angles (rot, tilt, psi) in degrees, given as
+    scalars (returns a 3x3 matrix) or arrays of length N (returns Nx3x3 matrices)
+    """
+    return _R_from_euler(a, b, y, (0, 2))
+
+
+def _euler_degrees(a: np.ndarray, b: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """...x3 euler angles in degrees, with the first and third wrapped to [-180, 180)"""
+    euler = np.rad2deg(np.stack([a, b, y], axis=-1))
+    euler[..., [0, 2]] = (euler[..., [0, 2]] + 180) % 360 - 180
+    return euler
+
+
+def R_to_eman(rot: np.ndarray) -> np.ndarray:
+    """
+    EMAN euler angles (az, alt, phi) in degrees of 3x3 or Nx3x3 rotation matrices,
+    as an array of shape (3,) or (N, 3); the inverse of R_from_eman
+    """
+    M = np.asarray(rot, dtype=np.float64) * _IMAGE_ORIGIN_FLIP
+    sb = np.hypot(M[..., 2, 0], M[..., 2, 1])
+    b = np.arctan2(sb, M[..., 2, 2])
+    a = np.arctan2(M[..., 2, 0], M[..., 2, 1])
+    y = np.arctan2(M[..., 0, 2], -M[..., 1, 2])
+    # gimbal lock (alt = 0 or 180): only az -/+ phi is defined, so set phi = 0
+    lock = sb < 1e-9
+    a_lock = np.where(
+        M[..., 2, 2] > 0,
+        np.arctan2(M[..., 1, 0], M[..., 0, 0]),
+        np.arctan2(-M[..., 0, 1], M[..., 0, 0]),
+    )
+    a = np.where(lock, a_lock, a)
+    y = np.where(lock, 0.0, y)
+    return _euler_degrees(a, b, y)
+
+
+def R_to_relion(rot: np.ndarray) -> np.ndarray:
+    """
+    RELION euler angles (rot, tilt, psi) in degrees of 3x3 or Nx3x3 rotation matrices,
+    as an array of shape (3,) or (N, 3); the inverse of R_from_relion
+    """
+    M = np.asarray(rot, dtype=np.float64) * _IMAGE_ORIGIN_FLIP
+    sb = np.hypot(M[..., 2, 0], M[..., 2, 1])
+    b = np.arctan2(sb, M[..., 2, 2])
+    a = np.arctan2(-M[..., 2, 1], M[..., 2, 0])
+    y = np.arctan2(-M[..., 1, 2], -M[..., 0, 2])
+    # gimbal lock (tilt = 0 or 180): only rot -/+ psi is defined, so set psi = 0
+    lock = sb < 1e-9
+    a_lock = np.where(
+        M[..., 2, 2] > 0,
+        np.arctan2(M[..., 1, 0], M[..., 0, 0]),
+        np.arctan2(M[..., 0, 1], M[..., 1, 1]),
+    )
+    a = np.where(lock, a_lock, a)
+    y = np.where(lock, 0.0, y)
+    return _euler_degrees(a, b, y)
 
 
 def R_from_relion_scipy(euler_: np.ndarray, degrees: bool = True) -> np.ndarray:
@@ -1,9 +1,31 @@
 """CryoDRGN utilities"""
 
+# Each command's module is only imported when that command is run, since many of them
+# take seconds to import (torch, scipy, matplotlib, ...)
+COMMANDS = [
+    "add_psize",
+    "concat_pkls",
+    "filter_mrcs",
+    "filter_pkl",
+    "filter_star",
+    "flip_hand",
+    "invert_contrast",
+    "phase_flip",
+    "select_clusters",
+    "select_random",
+    "translate_mrcs",
+    "view_cs_header",
+    "view_header",
+    "view_mrcs",
+    "write_star",
+    "write_cs",
+]
+
 
 def main():
     import argparse
-    import os
+    import importlib
+    import sys
 
     parser = argparse.ArgumentParser(description=__doc__)
     import cryodrgn
@@ -12,54 +34,17 @@ def main():
         "--version", action="version", version="cryoDRGN " + cryodrgn.__version__
     )
 
-    import cryodrgn.commands_utils.add_psize
-    import cryodrgn.commands_utils.concat_pkls
-    import cryodrgn.commands_utils.filter_mrcs
-    import cryodrgn.commands_utils.filter_pkl
-    import cryodrgn.commands_utils.filter_star
-    import cryodrgn.commands_utils.flip_hand
-    import cryodrgn.commands_utils.invert_contrast
-    import cryodrgn.commands_utils.phase_flip
-    import cryodrgn.commands_utils.select_clusters
-    import cryodrgn.commands_utils.select_random
-    import cryodrgn.commands_utils.translate_mrcs
-    import cryodrgn.commands_utils.view_cs_header
-    import cryodrgn.commands_utils.view_header
-    import cryodrgn.commands_utils.view_mrcs
-    import cryodrgn.commands_utils.write_cs
-    import cryodrgn.commands_utils.write_star
-
-    modules = [
-        cryodrgn.commands_utils.add_psize,
-        cryodrgn.commands_utils.concat_pkls,
-        cryodrgn.commands_utils.filter_mrcs,
-        cryodrgn.commands_utils.filter_pkl,
-        cryodrgn.commands_utils.filter_star,
-        cryodrgn.commands_utils.flip_hand,
-        cryodrgn.commands_utils.invert_contrast,
-        cryodrgn.commands_utils.phase_flip,
-        cryodrgn.commands_utils.select_clusters,
-        cryodrgn.commands_utils.select_random,
-        cryodrgn.commands_utils.translate_mrcs,
-        cryodrgn.commands_utils.view_cs_header,
-        cryodrgn.commands_utils.view_header,
-        cryodrgn.commands_utils.view_mrcs,
-        cryodrgn.commands_utils.write_star,
-        cryodrgn.commands_utils.write_cs,
-    ]
-
     subparsers = parser.add_subparsers(title="Choose a command")
     subparsers.required = True
 
-    def get_str_name(module):
-        return os.path.splitext(os.path.basename(module.__file__))[0]
-
-    for module in modules:
-        this_parser = subparsers.add_parser(
-            get_str_name(module), description=module.__doc__
-        )
-        module.add_args(this_parser)
-        this_parser.set_defaults(func=module.main)
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    for name in COMMANDS:
+        this_parser = subparsers.add_parser(name)
+        if name == command:
+            module = importlib.import_module(f"cryodrgn.commands_utils.{name}")
+            this_parser.description = module.__doc__
+            module.add_args(this_parser)
+            this_parser.set_defaults(func=module.main)
 
     args = parser.parse_args()
     args.func(args)
@@ -0,0 +1,128 @@
+"""
+Time importing poses and CTF parameters from a RELION .star file and exporting them back
+
+Writes a synthetic .star file of N particles (default: 2 million) to a temporary
+directory and times parse_pose_star, parse_ctf_star and write_star on it, as well as
+the per-particle euler angle conversion that parse_pose_star used to run.
+
+Usage: python benchmark_star.py [-N PARTICLES] [--loop]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from cryodrgn import mrc, utils
+from cryodrgn.commands import parse_ctf_star, parse_pose_star
+from cryodrgn.commands_utils import write_star
+from cryodrgn.starfile import Starfile
+
+
+def make_star(path, N, D=128, Apix=1.5):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        {
+            "_rlnImageName": [
+                f"{i % 1000 + 1}@particles.{i // 1000}.mrcs" for i in range(N)
+            ],
+            "_rlnAngleRot": rng.uniform(-180, 180, N),
+            "_rlnAngleTilt": rng.uniform(0, 180, N),
+            "_rlnAnglePsi": rng.uniform(-180, 180, N),
+            "_rlnOriginX": rng.normal(0, 3, N),
+            "_rlnOriginY": rng.normal(0, 3, N),
+            "_rlnDefocusU": rng.uniform(10000, 30000, N),
+            "_rlnDefocusV": rng.uniform(10000, 30000, N),
+            "_rlnDefocusAngle": rng.uniform(-180, 180, N),
+            "_rlnVoltage": np.full(N, 300.0),
+            "_rlnSphericalAberration": np.full(N, 2.7),
+            "_rlnAmplitudeContrast": np.full(N, 0.1),
+            "_rlnPhaseShift": np.zeros(N),
+            "_rlnImageSize": np.full(N, D),
+            "_rlnDetectorPixelSize": np.full(N, Apix),
+            "_rlnMagnification": np.full(N, 10000.0),
+        }
+    )
+    Starfile(headers=None, df=df).write(path)
+
+
+def timed(name, f, *args):
+    t = time.perf_counter()
+    out = f(*args)
+    print(f"{name:<24} {time.perf_counter() - t:.2f}s")
+    return out
+
+
+def run(command, argv):
+    parser = argparse.ArgumentParser()
+    command.add_args(parser)
+    command.main(parser.parse_args(argv))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-N", type=int, default=2_000_000, help="Particles (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--loop",
+        action="store_true",
+        help="Also time converting euler angles one particle at a time",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        star = os.path.join(tmpdir, "particles.star")
+        poses = os.path.join(tmpdir, "pose.pkl")
+        ctf = os.path.join(tmpdir, "ctf.pkl")
+        mrcs = os.path.join(tmpdir, "particles.mrcs")
+        timed("write synthetic .star", make_star, star, args.N)
+
+        timed("parse_pose_star", run, parse_pose_star, [star, "-o", poses])
+        timed(
+            "parse_ctf_star",
+            run,
+            parse_ctf_star,
+            [star, "-D", "128", "--Apix", "1.5", "-o", ctf],
+        )
+
+        euler = (
+            Starfile.load(star)
+            .df[["_rlnAngleRot", "_rlnAngleTilt", "_rlnAnglePsi"]]
+            .to_numpy()
+        )
+        rot = timed(
+            "R_from_relion",
+            utils.R_from_relion,
+            euler[:, 0],
+            euler[:, 1],
+            euler[:, 2],
+        )
+        timed("R_to_relion", utils.R_to_relion, rot)
+        if args.loop:
+            timed(
+                "R_from_relion (loop)",
+                lambda: np.asarray([utils.R_from_relion(*x) for x in euler]),
+            )
+
+        # write_star needs a particle stack with as many images; its pixels are never
+        # read, so write a header and leave the data as a sparse file
+        header = mrc.MRCHeader.make_default_header(
+            np.broadcast_to(np.float32(0), (args.N, 8, 8)), is_vol=False
+        )
+        with open(mrcs, "wb") as f:
+            header.write(f)
+            f.truncate(1024 + args.N * 8 * 8 * 4)
+        timed(
+            "write_star",
+            run,
+            write_star,
+            [mrcs, "--ctf", ctf, "--poses", poses, "-o", star],
+        )
+
+
+if __name__ == "__main__":
+    main()
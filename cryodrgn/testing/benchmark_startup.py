@@ -0,0 +1,50 @@
+"""
+Time the startup of cryodrgn commands, i.e. how long `cryodrgn <command> -h` takes
+
+Usage: python benchmark_startup.py [-n REPEATS] [COMMAND ...]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+from cryodrgn.__main__ import COMMANDS
+from cryodrgn.utils_exec import COMMANDS as UTILS_COMMANDS
+
+
+def time_command(entry_point, command, repeats):
+    times = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-m", entry_point, command, "-h"],
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+        times.append(time.perf_counter() - t)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "commands", nargs="*", help="Commands to time (default: all commands)"
+    )
+    parser.add_argument(
+        "-n", type=int, default=3, help="Runs of each command (default: %(default)s)"
+    )
+    args = parser.parse_args()
+
+    to_time = [("cryodrgn", "cryodrgn", c) for c in COMMANDS]
+    to_time += [("cryodrgn_utils", "cryodrgn.utils_exec", c) for c in UTILS_COMMANDS]
+    if args.commands:
+        to_time = [x for x in to_time if x[2] in args.commands]
+    for name, entry_point, command in to_time:
+        t = time_command(entry_point, command, args.n)
+        print(f"{name:<16} {command:<24} {t:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import os
+import numpy as np
+import torch
+from scipy.spatial.distance import cdist
+
+from cryodrgn import analysis, mrc, utils
+from cryodrgn.models import HetOnlyVAE
+
+
+def test_get_nearest_point(monkeypatch):
+    data = np.random.randn(1000, 8)
+    query = np.random.randn(30, 8)
+    ind_ref = cdist(query, data).argmin(axis=1)
+    # search the data in chunks of 3 points
+    monkeypatch.setattr(analysis, "NEAREST_POINT_MAX_DISTS", 100)
+    points, ind = analysis.get_nearest_point(data, query)
+    assert (ind == ind_ref).all()
+    assert (points == data[ind_ref]).all()
+
+
+def test_load_or_compute(tmp_path):
+    z = np.random.randn(500, 4).astype(np.float32)
+    calls = []
+
+    def func(z, K):
+        calls.append(K)
+        return z.mean(axis=0) * K
+
+    out1 = analysis.load_or_compute(str(tmp_path), "test", func, z, K=2)
+    out2 = analysis.load_or_compute(str(tmp_path), "test", func, z, K=2)
+    assert calls == [2]
+    assert (out1 == out2).all()
+
+    analysis.load_or_compute(str(tmp_path), "test", func, z, K=3)
+    analysis.load_or_compute(str(tmp_path), "test", func, z + 1, K=2)
+    analysis.load_or_compute(None, "test", func, z, K=2)
+    assert calls == [2, 3, 2, 2]
+
+    # the same bytes with a different shape or dtype are a different input
+    analysis.load_or_compute(str(tmp_path), "test", func, z.reshape(1000, 2), K=2)
+    analysis.load_or_compute(str(tmp_path), "test", func, z.view(np.int32), K=2)
+    assert calls == [2, 3, 2, 2, 2, 2]
+
+
+def test_run_pca_minibatch(monkeypatch):
+    from sklearn.decomposition import IncrementalPCA
+
+    z = np.random.randn(1000, 4) * np.array([4, 3, 2, 1])
+    pc, pca = analysis.run_pca(z)
+
+    # fit in chunks of 100 points
+    monkeypatch.setattr(analysis, "CHUNK_SIZE", 100)
+    partial_fit = IncrementalPCA.partial_fit
+    nfits = []
+
+    def count_partial_fit(self, X, *args, **kwargs):
+        nfits.append(len(X))
+        return partial_fit(self, X, *args, **kwargs)
+
+    monkeypatch.setattr(IncrementalPCA, "partial_fit", count_partial_fit)
+    pc_mb, pca_mb = analysis.run_pca(z, minibatch=True)
+    assert nfits == [100] * 10
+    assert np.allclose(pca.explained_variance_ratio_, pca_mb.explained_variance_ratio_)
+    assert np.allclose(np.abs(pc), np.abs(pc_mb), atol=1e-6)
+
+
+def test_gen_volumes(tmp_path):
+    D, zdim = 9, 2
+    cfg = dict(
+        dataset_args=dict(norm=(0.0, 1.0)),
+        lattice_args=dict(D=D, extent=0.5, ignore_DC=True),
+        model_args=dict(
+            qlayers=1,
+            qdim=8,
+            players=2,
+            pdim=16,
+            zdim=zdim,
+            encode_mode="resid",
+            enc_mask=-1,
+            pe_type="geom_lowf",
+            feat_sigma=None,
+            pe_dim=None,
+            domain="fourier",
+            activation="relu",
+        ),
+    )
+    config = str(tmp_path / "config.pkl")
+    weights = str(tmp_path / "weights.pkl")
+    utils.save_pkl(cfg, config)
+    torch.manual_seed(0)
+    model, lattice = HetOnlyVAE.load(cfg)
+    torch.save({"model_state_dict": model.state_dict()}, weights)
+    model.eval()
+
+    z = np.random.randn(3, zdim).astype(np.float32)
+    zfile = str(tmp_path / "z.txt")
+    np.savetxt(zfile, z)
+    analysis._load_volume_model.cache_clear()
+    for i in range(2):
+        outdir = str(tmp_path / f"vols{i}")
+        analysis.gen_volumes(weights, config, zfile, outdir, vol_start_index=1)
+        assert sorted(os.listdir(outdir)) == [f"vol_{j:03d}.mrc" for j in (1, 2, 3)]
+        for j, zval in enumerate(z):
+            vol, _ = mrc.parse_mrc(f"{outdir}/vol_{j + 1:03d}.mrc")
+            ref = model.decoder.eval_volume(
+                lattice.coords, D, 0.5, cfg["dataset_args"]["norm"], zval
+            )
+            assert np.allclose(vol, ref, atol=1e-5)
+    # the model is loaded once and reused by the second call
+    cache_info = analysis._load_volume_model.cache_info()
+    assert cache_info.misses == 1 and cache_info.hits == 1
@@ -0,0 +1,34 @@
+import os
+import numpy as np
+from scipy.ndimage import binary_dilation
+
+from cryodrgn import mrc
+from cryodrgn.commands import analyze_landscape
+
+
+def test_make_mask(tmp_path, monkeypatch):
+    K, D = 5, 16
+    os.makedirs(tmp_path / f"kmeans{K}")
+    vols = np.random.randn(K, D, D, D).astype(np.float32)
+    for i in range(K):
+        mrc.write(str(tmp_path / f"kmeans{K}" / f"vol_{i:03d}.mrc"), vols[i])
+    analyze_landscape.make_mask(str(tmp_path), K, dilate=2, thresh=None)
+
+    thresh = np.mean([np.percentile(vol, 99.99) / 2 for vol in vols])
+    mask_ref = np.zeros((D, D, D), dtype=bool)
+    for vol in vols:
+        mask_ref |= binary_dilation(vol >= thresh, iterations=2)
+    mask = mrc.parse_mrc(str(tmp_path / "mask.mrc"))[0].astype(bool)
+    assert (mask == mask_ref).all()
+    volm = mrc.parse_mrc(str(tmp_path / f"kmeans{K}" / "vol_mean.mrc"))[0]
+    assert np.allclose(volm, vols.mean(axis=0))
+
+    # masked volume matrix, in memory and in a temporary file
+    vol_paths = analyze_landscape.get_vol_paths(str(tmp_path), K)
+    vols_masked = np.array([vol[mask] for vol in vols])
+    vols_masked[vols_masked < 0] = 0
+    x = analyze_landscape.load_masked_volumes(vol_paths, mask)
+    monkeypatch.setattr(analyze_landscape, "VOL_MATRIX_MAX_BYTES", 0)
+    x_mmap = analyze_landscape.load_masked_volumes(vol_paths, mask)
+    assert isinstance(x_mmap, np.memmap)
+    assert (x == vols_masked).all() and (x_mmap == vols_masked).all()
@@ -0,0 +1,76 @@
+import argparse
+import os
+import numpy as np
+import torch
+
+from cryodrgn import mrc, utils
+from cryodrgn.commands import backproject_voxel
+
+DATA_FOLDER = os.path.join(os.path.dirname(__file__), "..", "testing", "data")
+
+
+def add_slice_reference(V, counts, ff_coord, ff, D):
+    """Backproject one image at a time and one voxel corner at a time"""
+    d2 = int(D / 2)
+    for coord, f in zip(ff_coord, ff):
+        coord = coord.t()
+        xf, yf, zf = coord.floor().long()
+        xc, yc, zc = coord.ceil().long()
+        for xi in (xf, xc):
+            for yi in (yf, yc):
+                for zi in (zf, zc):
+                    dist = torch.stack([xi, yi, zi]).float() - coord
+                    w = (1 - dist.pow(2).sum(0).pow(0.5)).clamp(min=0)
+                    ind = (zi + d2, yi + d2, xi + d2)
+                    V.index_put_(ind, w * f, accumulate=True)
+                    counts.index_put_(ind, w, accumulate=True)
+    return V, counts
+
+
+def test_add_slice():
+    torch.manual_seed(0)
+    D, B, N = 9, 6, 50
+    ff_coord = torch.rand(B, N, 3) * (D - 2) - (D - 2) / 2
+    # repeated voxels within the batch: two images with the same coordinates, and
+    # points on the lattice whose 8 corners are all the same voxel
+    ff_coord[1] = ff_coord[0]
+    ff_coord[2, :10] = ff_coord[2, :10].round()
+    ff = torch.randn(B, N)
+
+    V, counts = torch.zeros(D, D, D), torch.zeros(D, D, D)
+    backproject_voxel.add_slice(V, counts, ff_coord, ff, D)
+    V_ref, counts_ref = torch.zeros(D, D, D), torch.zeros(D, D, D)
+    add_slice_reference(V_ref, counts_ref, ff_coord, ff, D)
+    assert torch.allclose(V, V_ref, atol=1e-5)
+    assert torch.allclose(counts, counts_ref, atol=1e-5)
+
+
+def test_half_maps(tmp_path):
+    def backproject(out, *args):
+        backproject_voxel.main(
+            backproject_voxel.add_args(argparse.ArgumentParser()).parse_args(
+                [
+                    f"{DATA_FOLDER}/toy_projections.mrcs",
+                    "--poses",
+                    f"{DATA_FOLDER}/toy_rot_trans.pkl",
+                    "-o",
+                    str(tmp_path / out),
+                    "-b",
+                    "4",
+                    *args,
+                ]
+            )
+        )
+        return mrc.parse_mrc(str(tmp_path / out))[0]
+
+    vol = backproject("vol.mrc", "--first", "30")
+    # the half-map accumulators sum to the same full map
+    vol_halves = backproject("halves.mrc", "--first", "30", "--half-maps")
+    assert np.allclose(vol, vol_halves, atol=1e-5)
+
+    # the first half-map is the backprojection of the even images alone
+    utils.save_pkl(np.arange(0, 30, 2), str(tmp_path / "even.pkl"))
+    vol_even = backproject("even.mrc", "--ind", str(tmp_path / "even.pkl"))
+    half1 = mrc.parse_mrc(str(tmp_path / "halves_half1.mrc"))[0]
+    assert np.allclose(half1, vol_even, atol=1e-5)
+    assert os.path.exists(tmp_path / "halves_half2.mrc")
@@ -0,0 +1,95 @@
+import argparse
+import logging
+import os
+import numpy as np
+import pytest
+import torch
+
+from cryodrgn import ctf, utils
+from cryodrgn.commands import train_nn, train_vae
+from cryodrgn.lattice import Lattice
+
+DATA_FOLDER = os.path.join(os.path.dirname(__file__), "..", "testing", "data")
+
+
+@pytest.fixture
+def ctf_params():
+    # 3 micrographs of 4 particles each, in shuffled order
+    params = ctf.load_ctf_for_training(16, f"{DATA_FOLDER}/ctf1.pkl")[:3]
+    return params[np.random.default_rng(0).permutation(np.arange(12) % 3)]
+
+
+def compute_ctfs(freqs, ctf_params):
+    params = torch.tensor(ctf_params)
+    freqs = freqs.unsqueeze(0) / params[:, 0].view(-1, 1, 1)
+    return ctf.compute_ctf(freqs, *torch.split(params[:, 1:], 1, 1))
+
+
+def test_ctf_cache(ctf_params):
+    freqs = Lattice(17).freqs2d
+    cache = ctf.CTFCache(freqs, ctf_params)
+    assert len(cache) == len(ctf_params)
+    # particles from the same micrograph share an entry
+    assert len(cache.params) == 3
+    assert isinstance(cache.table, torch.Tensor)
+    assert not cache.filled.any()
+
+    ref = compute_ctfs(freqs, ctf_params)
+    ind = np.array([5, 0, 5])
+    assert torch.allclose(cache[ind], ref[ind])
+    # only the entries of the looked up particles are computed
+    assert cache.filled.sum() == len(np.unique(cache.groups[ind]))
+    ind = torch.arange(len(ctf_params))
+    assert torch.allclose(cache[ind], ref)
+    assert cache.filled.all()
+
+
+def test_ctf_cache_memmap(ctf_params, caplog):
+    freqs = Lattice(17).freqs2d
+    with caplog.at_level(logging.WARNING):
+        cache = ctf.CTFCache(freqs, ctf_params, max_bytes=0)
+    assert isinstance(cache.table, np.memmap)
+    assert "temporary file" in caplog.text
+    ind = np.arange(len(ctf_params))[::-1]
+    c = cache[ind]
+    assert c.dtype == torch.float32
+    assert torch.allclose(c, compute_ctfs(freqs, ctf_params)[ind.copy()])
+
+
+@pytest.mark.parametrize("max_bytes", [None, 0])
+def test_ctf_cache_float16(ctf_params, max_bytes):
+    freqs = Lattice(17).freqs2d
+    cache = ctf.CTFCache(freqs, ctf_params, dtype=torch.float16, max_bytes=max_bytes)
+    assert cache.table.dtype in (torch.float16, np.float16)
+    c = cache[np.arange(len(ctf_params))]
+    assert c.dtype == torch.float32
+    assert torch.allclose(c, compute_ctfs(freqs, ctf_params), atol=1e-3)
+
+
+@pytest.mark.parametrize("train", [train_nn, train_vae])
+def test_train_ctf_cache_args(tmp_path, train):
+    ctf_pkl = str(tmp_path / "ctf.pkl")
+    params = utils.load_pkl(f"{DATA_FOLDER}/ctf1.pkl")
+    params[:, 0] = 64
+    utils.save_pkl(params[np.arange(100) % len(params)], ctf_pkl)
+    args = [
+        f"{DATA_FOLDER}/hand.mrcs",
+        "-o",
+        str(tmp_path / "out"),
+        "--poses",
+        f"{DATA_FOLDER}/hand_rot.pkl",
+        "--ctf",
+        ctf_pkl,
+        "--ctf-cache-gb",
+        "0",
+        "--ctf-cache-dtype",
+        "float16",
+        "-n",
+        "1",
+    ]
+    if train is train_nn:
+        args += ["--layers", "2", "--dim", "16", "--no-amp"]
+    else:
+        args += ["--zdim", "2", "--enc-dim", "16", "--dec-dim", "16"]
+    train.main(train.add_args(argparse.ArgumentParser()).parse_args(args))
+    assert os.path.exists(tmp_path / "out" / "weights.pkl")
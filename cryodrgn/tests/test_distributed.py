@@ -0,0 +1,35 @@
+import torch
+
+from cryodrgn import distributed
+
+
+def _check_helpers(n):
+    distributed.init(torch.device("cpu"))
+    rank = distributed.get_rank()
+    torch.manual_seed(rank)
+    model = torch.nn.Linear(4, 1)
+    distributed.broadcast_parameters(model)
+
+    # averaging the gradients of each process's half of a batch gives the full
+    # batch's gradient
+    x = torch.arange(8 * 4, dtype=torch.float32).view(8, 4) / 10
+    model(x[rank::2]).pow(2).mean().backward()
+    distributed.all_reduce_grads(model)
+    ref = torch.nn.Linear(4, 1)
+    ref.load_state_dict(model.state_dict())
+    ref(x).pow(2).mean().backward()
+    assert torch.allclose(model.weight.grad, ref.weight.grad)
+    assert torch.allclose(model.bias.grad, ref.bias.grad)
+
+    ind = torch.arange(rank, n, 2)
+    (rows,) = distributed.gather_rows(ind, n, ind.float()[:, None] * 10)
+    assert (rows[:, 0] == torch.arange(n) * 10).all()
+    assert distributed.all_reduce_sum([1.0, rank]) == [2.0, 1.0]
+    distributed.cleanup()
+
+
+def test_distributed_helpers(monkeypatch):
+    # spawn sets these for the processes it starts
+    monkeypatch.delenv("MASTER_ADDR", raising=False)
+    monkeypatch.delenv("MASTER_PORT", raising=False)
+    distributed.spawn(_check_helpers, 6, num_processes=2)
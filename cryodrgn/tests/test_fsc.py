@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from cryodrgn import fft, fsc, mrc
+
+
+@pytest.mark.parametrize("D", [16, 17])
+def test_calc_fsc(D):
+    vol1, vol2 = np.random.randn(2, D, D, D)
+    # reference FSC over the full, centered spectrum
+    ft1, ft2 = fft.fftn_center(vol1), fft.fftn_center(vol2)
+    x = np.arange(-(D // 2), D - D // 2)
+    r = np.sqrt(x[:, None, None] ** 2 + x[None, :, None] ** 2 + x[None, None, :] ** 2)
+    shell = np.minimum(r.astype(int), D // 2 - 1)
+    num = np.bincount(shell.ravel(), np.real(ft1 * ft2.conj()).ravel())
+    den1 = np.bincount(shell.ravel(), (np.abs(ft1) ** 2).ravel())
+    den2 = np.bincount(shell.ravel(), (np.abs(ft2) ** 2).ravel())
+    assert np.allclose(fsc.calc_fsc(vol1, vol2), num / np.sqrt(den1 * den2))
+    assert np.allclose(fsc.calc_fsc(vol1, vol1), 1)
+
+
+def test_sequential_fscs(tmp_path):
+    vols = np.random.randn(2, 4, 16, 16, 16).astype(np.float32)
+    paths = [[str(tmp_path / f"vol_{i}_{j}.mrc") for j in range(4)] for i in range(2)]
+    for i in range(2):
+        for j in range(4):
+            mrc.write(paths[i][j], vols[i, j])
+
+    cc, fscs = fsc.sequential_fscs_parallel(paths, max_threads=2)
+    assert cc.shape == (2, 3) and fscs.shape == (2, 3, 8)
+    for i in range(2):
+        for j in range(3):
+            assert np.isclose(cc[i, j], fsc.calc_cc(vols[i, j], vols[i, j + 1]))
+            assert np.allclose(fscs[i, j], fsc.calc_fsc(vols[i, j], vols[i, j + 1]))
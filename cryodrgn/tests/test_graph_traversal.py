@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+import torch
+
+from cryodrgn.commands.graph_traversal import Graph, get_nearest_neighbors
+
+
+def test_find_paths():
+    # a chain 0 -> 1 -> 2 -> 3 with a shortcut 0 -> 2, and an unreachable node 4
+    neighbors = np.array([[1, 2], [2, 1], [3, 2], [3, 3], [4, 4]])
+    ndist = np.array([[1.0, 3.0], [1.0, 0.0], [1.0, 0.0], [0.0, 0.0], [0.0, 0.0]])
+    graph = Graph(neighbors, ndist)
+    paths = graph.find_paths([(0, 3), (2, 3), (0, 4), (0, 2)])
+    assert paths[0] == ([0, 1, 2, 3], 3.0)
+    assert paths[1] == ([2, 3], 1.0)
+    assert paths[2] == (None, None)
+    assert graph.find_path(0, 2) == paths[3] == ([0, 1, 2], 2.0)
+
+    # dropping edges at least max_dist long removes the chain but not the shortcut
+    assert Graph(neighbors, ndist, max_dist=1.0).find_path(0, 3) == (None, None)
+
+
+@pytest.mark.parametrize("batch_size", [7, 1000])
+def test_get_nearest_neighbors(batch_size):
+    data = torch.randn(100, 4)
+    ndist, neighbors = get_nearest_neighbors(data, 5, batch_size)
+    dist = torch.cdist(data, data)
+    assert (neighbors[:, 0] == torch.arange(100)).all()
+    assert torch.allclose(ndist, dist.gather(1, neighbors), atol=1e-3)
+    assert torch.allclose(ndist, dist.topk(5, largest=False)[0], atol=1e-3)
@@ -0,0 +1,29 @@
+import subprocess
+import sys
+
+import pytest
+
+from cryodrgn.__main__ import COMMANDS
+from cryodrgn.utils_exec import COMMANDS as UTILS_COMMANDS
+
+
+@pytest.mark.parametrize(
+    "entry_point, package, commands",
+    [
+        ("cryodrgn.__main__", "cryodrgn.commands", COMMANDS),
+        ("cryodrgn.utils_exec", "cryodrgn.commands_utils", UTILS_COMMANDS),
+    ],
+)
+def test_lazy_commands(entry_point, package, commands):
+    assert len(set(commands)) == len(commands)
+    # only the module of the command being run is imported
+    code = (
+        f"import sys; from {entry_point} import main\n"
+        f"sys.argv = ['cryodrgn', '{commands[0]}', '-h']\n"
+        "try:\n    main()\nexcept SystemExit:\n    pass\n"
+        f"print(sorted(m for m in sys.modules if m.startswith('{package}.')))"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout
+    assert out.splitlines()[-1] == str([f"{package}.{commands[0]}"])
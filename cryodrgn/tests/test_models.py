@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+import torch
+
+from cryodrgn import fft, models, utils
+from cryodrgn.lattice import Lattice
+
+
+def eval_volume_by_slice(model, coords, D, extent, norm, zval=None):
+    """Reference per-z-slice evaluation of a decoder"""
+    vol_f = np.zeros((D, D, D), dtype=np.float32)
+    z = None if zval is None else torch.tensor(zval, dtype=torch.float32)
+    for i, dz in enumerate(
+        np.linspace(-extent, extent, D, endpoint=True, dtype=np.float32)
+    ):
+        x = coords + torch.tensor([0, 0, dz])
+        keep = torch.ones(len(x), dtype=torch.bool)
+        if isinstance(model, models.FTPositionalDecoder):
+            keep = x.pow(2).sum(dim=1) <= extent**2
+        x = x[keep]
+        if z is not None:
+            x = torch.cat((x, z.expand(len(x), len(z))), dim=-1)
+        with torch.no_grad():
+            if isinstance(model, models.PositionalDecoder):
+                y = model(x)[..., 0]
+            elif dz == 0.0 and isinstance(model, models.FTPositionalDecoder):
+                y = model(x)
+            else:
+                y = model.decode(x)
+                y = y[..., 0] - y[..., 1]
+        slice_ = torch.zeros(D**2)
+        slice_[keep] = y
+        vol_f[i] = slice_.view(D, D).numpy()
+    vol_f = vol_f * norm[1] + norm[0]
+    if isinstance(model, models.FTSliceDecoder):
+        vol_f = utils.zero_sphere(vol_f)
+    return fft.ihtn_center(vol_f[:-1, :-1, :-1])
+
+
+@pytest.mark.parametrize("enc_type", ["linear_lowf", "none"])
+@pytest.mark.parametrize("D,extent", [(9, 0.5), (15, 0.2265625)])
+def test_eval_volume_hermitian(enc_type, D, extent):
+    # for D=15, extent=0.2265625 the float32 offset of the middle slice is not 0
+    dz = np.linspace(-extent, extent, D, endpoint=True, dtype=np.float32)
+    assert (dz[D // 2] != 0.0) == (D == 15)
+
+    torch.manual_seed(0)
+    zdim = 2
+    model = models.get_decoder(3 + zdim, D, 2, 16, "fourier", enc_type)
+    model.eval()
+    coords = Lattice(D, extent=extent).coords
+    norm = (0.5, 2.0)
+    zval = np.array([0.3, -1.2], dtype=np.float32)
+    vol = model.eval_volume(coords, D, extent, norm, zval)
+    ref = eval_volume_by_slice(model, coords, D, extent, norm, zval)
+    assert np.abs(ref).max() > 0
+    assert np.allclose(vol, ref, atol=1e-5)
+
+
+@pytest.mark.parametrize(
+    "domain,enc_type",
+    [("hartley", "geom_lowf"), ("fourier", "geom_lowf"), ("fourier", "none")],
+)
+def test_eval_volumes(monkeypatch, domain, enc_type):
+    # decode a few latents per forward pass, a few slices or points at a time
+    monkeypatch.setattr(models, "EVAL_VOLUMES_MAX_POINTS", 3 * 9**2)
+    torch.manual_seed(0)
+    D, zdim = 9, 3
+    model = models.get_decoder(3 + zdim, D, 2, 16, domain, enc_type)
+    model.eval()
+    coords = Lattice(D).coords
+    norm = (0.5, 2.0)
+    zvals = np.random.randn(7, zdim).astype(np.float32)
+    vols = list(model.eval_volumes(coords, D, 0.5, norm, zvals))
+    assert len(vols) == len(zvals)
+    for zval, vol in zip(zvals, vols):
+        monkeypatch.setattr(models, "EVAL_VOLUMES_MAX_POINTS", 2**18)
+        ref = model.eval_volume(coords, D, 0.5, norm, zval)
+        assert np.allclose(vol, ref, atol=1e-5)
+        ref = eval_volume_by_slice(model, coords, D, 0.5, norm, zval)
+        assert np.allclose(vol, ref, atol=1e-5)
+
+
+@pytest.mark.parametrize("domain", ["hartley", "fourier"])
+@pytest.mark.parametrize(
+    "enc_type",
+    ["geom_ft", "geom_full", "geom_lowf", "geom_nohighf", "linear_lowf", "gaussian"],
+)
+def test_lattice_encoder(domain, enc_type):
+    torch.manual_seed(0)
+    D, zdim = 17, 2
+    model = models.get_decoder(3 + zdim, D, 1, 8, domain, enc_type, feat_sigma=0.5)
+    coords = Lattice(D).coords
+    dz = models._slice_offsets(D, 0.5, coords.device)
+    encode = models._lattice_encoder(model, coords, dz)
+    pix = torch.arange(D**2)
+    iz = torch.arange(D)[:, None]
+    x = encode(pix, iz).view(D**3, -1)
+
+    lattice = (coords[None] + dz[:, None]).view(D**3, 3)
+    lattice = torch.cat((lattice, torch.zeros(D**3, zdim)), dim=-1)
+    with torch.no_grad():
+        ref = model.positional_encoding_geom(lattice)[:, : model.in_dim - zdim]
+    assert x.shape == ref.shape
+    if enc_type == "gaussian":
+        # built from per-plane and per-axis tables with the angle addition formulas
+        assert torch.allclose(x, ref, atol=1e-5)
+    else:
+        assert torch.equal(x, ref)
@@ -1,9 +1,10 @@
 import os.path
+import pickle
 
 import numpy as np
 import pytest
 
-from cryodrgn import dataset, mrc
+from cryodrgn import dataset, fft, mrc
 
 DATA_FOLDER = os.path.join(os.path.dirname(__file__), "..", "testing", "data")
 
@@ -29,3 +30,67 @@ def test_txt(mrcs_data):
     data = dataset.load_particles(f"{DATA_FOLDER}/toy_projections.txt")
     assert isinstance(data, np.ndarray)
     assert np.allclose(data, mrcs_data)
+
+
+def test_mmap_stack(mrcs_data):
+    data = dataset.load_particles(f"{DATA_FOLDER}/toy_projections.star", lazy=True)
+    assert isinstance(data, mrc.MMapImageStack)
+    assert len(data) == len(mrcs_data)
+    assert np.allclose(data.images(), mrcs_data)
+    assert np.allclose(data[7].get(), mrcs_data[7])
+
+    ind = np.array([900, 3, 4, 5, 0, 999])
+    assert np.allclose(data.images(ind), mrcs_data[ind])
+    assert np.allclose(data[ind].images(), mrcs_data[ind])
+    assert np.allclose(data[10:20].images(copy=False), mrcs_data[10:20])
+
+    stacked = mrc.MMapImageStack.concatenate([data[ind], data[10:20]])
+    assert np.allclose(
+        stacked.images(), np.concatenate([mrcs_data[ind], mrcs_data[10:20]])
+    )
+
+    unpickled = pickle.loads(pickle.dumps(data[ind]))
+    assert np.allclose(unpickled.images(), mrcs_data[ind])
+
+
+def test_lazy_dataloader():
+    data = dataset.LazyMRCData(f"{DATA_FOLDER}/toy_projections.mrcs", window=False)
+    ref = dataset.MRCData(
+        f"{DATA_FOLDER}/toy_projections.mrcs", norm=data.norm, window=False
+    )
+    batches = dataset.make_dataloader(data, batch_size=64, shuffle=True)
+    for y, ind in batches:
+        assert y.shape == (len(ind), data.D, data.D)
+        assert np.allclose(y.numpy(), ref.particles[ind.numpy()], atol=1e-4)
+
+
+@pytest.mark.parametrize("window", [True, False])
+def test_mrc_data_norm(mrcs_data, window):
+    data = dataset.MRCData(
+        f"{DATA_FOLDER}/toy_projections.mrcs",
+        invert_data=True,
+        window=window,
+        max_threads=1,
+        batch_size=64,
+    )
+    # the HT of the whole stack, normalized by its standard deviation
+    imgs = mrcs_data * dataset.window_mask(30, 0.85, 0.99) if window else mrcs_data
+    ht = -fft.symmetrize_ht(np.asarray([fft.ht2_center(x) for x in imgs]))
+    assert np.isclose(data.norm[1], ht.std(), rtol=1e-5)
+    assert data.norm[0] == 0
+    assert np.allclose(data.particles, ht / ht.std(), atol=1e-5)
+
+
+def test_lazy_norm_sample(monkeypatch):
+    choice = np.random.choice
+    sizes = []
+
+    def record_choice(a, size, *args, **kwargs):
+        sizes.append(size)
+        return choice(a, size, *args, **kwargs)
+
+    monkeypatch.setattr(np.random, "choice", record_choice)
+    data = dataset.PreprocessedMRCData(f"{DATA_FOLDER}/toy_projections.mrcs", lazy=True)
+    # 10% of the 1000 images
+    assert sizes == [100]
+    assert data.norm[0] == 0 and data.norm[1] > 0
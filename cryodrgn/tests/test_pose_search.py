@@ -0,0 +1,138 @@
+import numpy as np
+import pytest
+import torch
+
+from cryodrgn import models, pose_search
+from cryodrgn.lattice import Lattice
+from cryodrgn.pose_search import PoseSearch, PoseStore
+
+
+def test_pose_store():
+    N = 10
+    store = PoseStore(N)
+    assert len(store) == N
+    rot = torch.randn(N, 3, 3)
+    trans = torch.randn(N, 2)
+    # batches of unsorted particle indices, translations as B x 1 x 2
+    for ind in (torch.tensor([7, 2, 9, 0]), torch.tensor([5, 1, 8, 3, 6, 4])):
+        store.update(ind, rot[ind], trans[ind].unsqueeze(1))
+    r, t = store.get(torch.tensor([3, 9, 0]))
+    assert torch.equal(r, rot[[3, 9, 0]]) and torch.equal(t, trans[[3, 9, 0]])
+    rot_np, trans_np = store.numpy()
+    assert np.array_equal(rot_np, rot.numpy())
+    assert np.array_equal(trans_np, trans.numpy())
+
+    store2 = PoseStore(N)
+    store2.load(rot_np, trans_np)
+    for x, y in zip(store2.numpy(), (rot_np, trans_np)):
+        assert np.array_equal(x, y)
+
+
+def make_pose_search(**kwargs):
+    torch.manual_seed(0)
+    D = 17
+    lattice = Lattice(D, extent=0.5)
+    model = models.get_decoder(3, D, 1, 16, "hartley", "geom_lowf")
+    model.eval()
+    kwargs = dict(dict(niter=2, nkeptposes=4, t_extent=2, t_ngrid=3), **kwargs)
+    return PoseSearch(model, lattice, 4, 8, **kwargs)
+
+
+def test_keep_matrix_adaptive():
+    ps = make_pose_search(adaptive_margin=0.5)
+    B, T, Q, max_poses = 5, 3, 8, 6
+    torch.manual_seed(1)
+    # a variable number of candidate groups per image
+    keepB = torch.tensor([0, 0, 0, 1, 2, 2, 3, 3, 3, 3, 4, 4])
+    loss = torch.randn(len(keepB), T, Q)
+    group, trans, q = ps.keep_matrix_adaptive(loss, keepB, B, max_poses)
+    assert (
+        loss[group, trans, q] == loss[group].min(1)[0][torch.arange(len(q)), q]
+    ).all()
+
+    best_loss = loss.min(1)[0]
+    for b in range(B):
+        kept = keepB[group] == b
+        assert 1 <= kept.sum() <= max_poses
+        cand = best_loss[keepB == b].view(-1)
+        thresh = cand.min() + ps.adaptive_margin * cand.std(unbiased=False)
+        n = min(max_poses, int((cand <= thresh).sum()))
+        assert kept.sum() == max(n, 1)
+        # the kept poses are the image's lowest losses, in ascending order
+        kept_loss = best_loss[group[kept], q[kept]]
+        assert torch.equal(kept_loss, cand.sort()[0][: len(kept_loss)])
+    # poses are ordered by image
+    assert (keepB[group].diff() >= 0).all()
+
+    # a zero margin keeps only the best pose, a large one keeps max_poses
+    ps.adaptive_margin = 0.0
+    group, _, _ = ps.keep_matrix_adaptive(loss, keepB, B, max_poses)
+    assert torch.equal(keepB[group], torch.arange(B))
+    ps.adaptive_margin = 1e6
+    group, _, _ = ps.keep_matrix_adaptive(loss, keepB, B, max_poses)
+    counts = torch.bincount(keepB, minlength=B) * Q
+    assert torch.equal(
+        torch.bincount(keepB[group], minlength=B), counts.clamp(max=max_poses)
+    )
+
+
+@pytest.mark.parametrize("margin", [0.5, 1e6])
+def test_opt_theta_trans_adaptive(margin):
+    B = 3
+    ps = make_pose_search(adaptive_margin=margin)
+    images = torch.randn(B, 17, 17)
+    np.random.seed(0)
+    rot, trans, init_poses = ps.opt_theta_trans(images)
+    assert rot.shape == (B, 3, 3) and trans.shape == (B, 2)
+    assert init_poses.shape == (B, ps.nkeptposes, 2)
+    assert ps.stats["poses"][1:].sum() > 0
+    if margin == 0.5:
+        assert ps.stats["poses"][2] < B * ps.nkeptposes * 8 * 9
+
+    # starting from the poses kept on the base grid
+    rot2, trans2, _ = ps.opt_theta_trans(images, init_poses=init_poses)
+    assert rot2.shape == (B, 3, 3) and trans2.shape == (B, 2)
+
+    if margin == 1e6:
+        # with a margin that never drops poses, the search is the same as without it
+        ps_ref = make_pose_search()
+        np.random.seed(0)
+        rot_ref, trans_ref, init_ref = ps_ref.opt_theta_trans(images)
+        assert torch.equal(init_poses, init_ref)
+        assert torch.allclose(rot, rot_ref) and torch.allclose(trans, trans_ref)
+        rot2_ref, trans2_ref, _ = ps_ref.opt_theta_trans(images, init_poses=init_ref)
+        assert torch.allclose(rot2, rot2_ref) and torch.allclose(trans2, trans2_ref)
+
+
+def rotate_images_by_angle(ps, images, angles, L):
+    """Reference in-plane rotation, one grid_sample call per angle"""
+    B, _, NQ, YX = images.shape
+    squeezed_images = images.view(B * NQ, YX)
+    D = ps.lattice.D
+    mask = ps.lattice.get_circular_mask(L)
+    full_images = torch.zeros((B * NQ, D, D))
+    full_images.view(B * NQ, D * D)[:, mask] = squeezed_images
+    res = torch.zeros((B * NQ, len(angles), YX))
+    for i, a in enumerate(angles):
+        coords = ps.lattice.coords[mask][:, :2] @ pose_search.rot_2d(a, 2, None)
+        interpolated = pose_search.interpolate(full_images, coords)
+        interpolated *= squeezed_images.std(-1, keepdim=True) / interpolated.std(
+            -1, keepdim=True
+        )
+        res[:, i] = interpolated
+    return res.view(B, 1, NQ * len(angles), YX)
+
+
+@pytest.mark.parametrize("max_numel", [2**25, 3000])
+def test_rotate_images(monkeypatch, max_numel):
+    # a small ROTATE_MAX_NUMEL rotates a few angles per grid_sample call
+    monkeypatch.setattr(pose_search, "ROTATE_MAX_NUMEL", max_numel)
+    ps = make_pose_search()
+    L = 6
+    YX = int(ps.lattice.get_circular_mask(L).sum())
+    images = torch.randn(2, 1, 3, YX)
+    angles = ps.base_inplane
+    res = ps.rotate_images(images, angles, L)
+    assert res.shape == (2, 1, 3 * len(angles), YX)
+    ref = rotate_images_by_angle(ps, images, angles, L)
+    assert torch.allclose(res, ref, atol=1e-5)
@@ -2,7 +2,7 @@ import argparse
 import os.path
 import pytest
 import numpy as np
-from cryodrgn import dataset
+from cryodrgn import dataset, utils
 from cryodrgn.commands import preprocess
 
 DATA_FOLDER = os.path.join(os.path.dirname(__file__), "..", "testing", "data")
@@ -36,3 +36,33 @@ def test_preprocess(mrcs_file):
     data = dataset.load_particles("output/preprocessed.ft.txt")
     assert isinstance(data, np.ndarray)
     assert data.shape == (100, 21, 21)
+
+    # normalization is computed during preprocessing and cached next to the output
+    meta = utils.load_pkl(dataset.preprocessed_meta_path("output/preprocessed.ft.txt"))
+    assert np.isclose(meta["norm"][1], data.std(), rtol=1e-4)
+
+
+def test_preprocess_float16(mrcs_file):
+    args = preprocess.add_args(argparse.ArgumentParser()).parse_args(
+        [
+            mrcs_file,
+            "-o",
+            "output/preprocessed16.mrcs",
+            "--window-r",
+            "0.5",
+            "-D",
+            "20",
+            "--float16",
+            "--chunk",
+            "30",
+        ]
+    )
+    preprocess.main(args)
+
+    data = dataset.load_particles("output/preprocessed16.ft.txt", lazy=True)
+    assert data.dtype == np.float16
+    assert len(data) == 100 and data.shape == (21, 21)
+
+    data = dataset.PreprocessedMRCData("output/preprocessed16.ft.txt", lazy=True)
+    y, ind = data[np.arange(10)]
+    assert y.dtype == np.float32 and y.shape == (10, 21, 21)
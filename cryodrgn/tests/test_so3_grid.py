@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from cryodrgn import so3_grid
+
+
+@pytest.mark.parametrize("res", [1, 2, 4])
+def test_get_neighbors(res):
+    quat = so3_grid.grid_SO3(res)
+    ind = np.random.choice(len(quat), 50)
+    s2i, s1i = np.divmod(ind, 6 * 2**res)
+
+    quat_n, ind_n = so3_grid.get_neighbors(quat[ind], s2i, s1i, res)
+    assert quat_n.shape == (50, 8, 4) and ind_n.shape == (50, 8, 2)
+    for i in range(50):
+        q, qi = so3_grid.get_neighbor(quat[ind[i]], s2i[i], s1i[i], res)
+        assert np.allclose(quat_n[i], q)
+        assert (ind_n[i] == qi).all()
+
+
+@pytest.mark.parametrize("res", [0, 1, 3, 6])
+def test_pix2ang_nest(res):
+    healpy = pytest.importorskip("healpy")
+    Nside = 2**res
+    ipix = np.arange(12 * Nside * Nside)
+    theta, phi = so3_grid.pix2ang(Nside, ipix, nest=True)
+    theta_hp, phi_hp = healpy.pix2ang(Nside, ipix, nest=True)
+    assert np.allclose(theta, theta_hp)
+    assert np.allclose(phi, phi_hp)
@@ -0,0 +1,82 @@
+import argparse
+import pickle
+
+import numpy as np
+import pytest
+
+from cryodrgn import ctf, fft, mrc, stack_transform
+from cryodrgn.commands_utils import filter_mrcs, phase_flip
+
+
+@pytest.fixture
+def particles(tmp_path):
+    imgs = np.random.randn(23, 16, 16).astype(np.float32)
+    mrc.write(str(tmp_path / "particles.mrcs"), imgs)
+    return imgs, str(tmp_path / "particles.mrcs")
+
+
+def test_stack_writer(tmp_path):
+    imgs = np.random.randn(10, 8, 6).astype(np.float32)
+    out = str(tmp_path / "out.mrcs")
+    with mrc.MRCStackWriter(out, (8, 6), Apix=2.0) as writer:
+        for batch in np.array_split(imgs, 3):
+            writer.write(batch)
+    x, header = mrc.parse_mrc(out)
+    assert (x == imgs).all()
+    assert header.fields["nz"] == 10 and header.get_apix() == 2.0
+
+
+@pytest.mark.parametrize("batch_size", [1, 5, 100])
+def test_transform_stack(particles, tmp_path, batch_size):
+    imgs, path = particles
+    stack = mrc.parse_mrc(path, lazy=True)[0][::2]
+    out = str(tmp_path / "out.mrcs")
+    stack_transform.transform_stack(
+        stack, out, lambda x, ind: x * ind[:, None, None], batch_size=batch_size
+    )
+    ind = np.arange(len(stack))
+    assert np.allclose(mrc.parse_mrc(out)[0], imgs[::2] * ind[:, None, None])
+
+
+def test_filter_mrcs(particles, tmp_path):
+    imgs, path = particles
+    ind = np.array([7, 2, 20, 3])
+    with open(tmp_path / "ind.pkl", "wb") as f:
+        pickle.dump(ind, f)
+    out = str(tmp_path / "filtered.mrcs")
+    args = filter_mrcs.add_args(argparse.ArgumentParser()).parse_args(
+        [path, "--ind", str(tmp_path / "ind.pkl"), "-b", "3", "-o", out]
+    )
+    filter_mrcs.main(args)
+    assert (mrc.parse_mrc(out)[0] == imgs[ind]).all()
+
+
+def test_phase_flip(particles, tmp_path):
+    imgs, path = particles
+    N, D = len(imgs), imgs.shape[-1]
+    ctf_params = np.zeros((N, 9), dtype=np.float32)
+    ctf_params[:, 0] = D
+    ctf_params[:, 1] = 3.0
+    ctf_params[:, 2:5] = np.random.uniform(
+        [10000, 10000, 0], [20000, 20000, 180], (N, 3)
+    )
+    ctf_params[:, 5:8] = 300, 2.7, 0.1
+    with open(tmp_path / "ctf.pkl", "wb") as f:
+        pickle.dump(ctf_params, f)
+    out = str(tmp_path / "flipped.mrcs")
+    args = phase_flip.add_args(argparse.ArgumentParser()).parse_args(
+        [path, str(tmp_path / "ctf.pkl"), "-b", "4", "-o", out]
+    )
+    phase_flip.main(args)
+
+    # one image at a time
+    fx, fy = np.meshgrid(
+        np.linspace(-0.5, 0.5, D, endpoint=False),
+        np.linspace(-0.5, 0.5, D, endpoint=False),
+    )
+    freqs = np.stack([fx.ravel(), fy.ravel()], 1)
+    for i in range(N):
+        c = ctf.compute_ctf_np(freqs / ctf_params[i, 1], *ctf_params[i, 2:])
+        ff = fft.fft2_center(imgs[i]) * np.sign(c).reshape(D, D)
+        img = fft.ifftn_center(ff).real
+        assert np.allclose(mrc.parse_mrc(out)[0][i], img, atol=1e-5)
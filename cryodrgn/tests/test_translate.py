@@ -27,3 +27,25 @@ def test_shifted_image():
 
     img_shifted = fft.ihtn_center(ht_np)
     assert np.allclose(np.load(f"{DATA_FOLDER}/im_shifted.npy"), img_shifted)
+
+
+def test_translation_table():
+    D = 17
+    lattice = Lattice(D)
+    mask = lattice.get_circular_mask(6)
+    imgs = torch.randn(3, D * D)[:, mask]
+    # shifts shared by all images, and a different set of shifts for each image
+    for shifts in (torch.randn(5, 2), torch.randn(3, 5, 2)):
+        table = lattice.get_translation_table(shifts, mask)
+        expected = lattice.translate_ht(imgs, shifts, mask)
+        assert expected.shape == (3, 5, int(mask.sum()))
+        assert torch.equal(lattice.translate_ht(imgs, shifts, mask, table), expected)
+        for i in range(3):
+            t = shifts if shifts.dim() == 2 else shifts[i]
+            for j in range(5):
+                assert torch.allclose(
+                    expected[i, j],
+                    lattice.translate_ht(imgs[i : i + 1], t[j].view(1, 1, 2), mask)[
+                        0, 0
+                    ],
+                )
@@ -1,4 +1,6 @@
+import os
 import numpy as np
+import torch
 from numpy.testing import assert_array_almost_equal
 
 from cryodrgn import utils
@@ -31,3 +33,56 @@ def test_convert_to_relion():
     r1 = utils.R_from_relion_scipy(x)
     euler = utils.R_to_relion_scipy(r1)
     assert_array_almost_equal(x, euler)
+
+
+def test_convert_relion_batched():
+    rng = np.random.default_rng(0)
+    x = rng.uniform(-180, 180, (100, 3))
+    x[:, 1] = rng.uniform(0, 180, 100)
+    r = utils.R_from_relion(x[:, 0], x[:, 1], x[:, 2])
+    assert r.shape == (100, 3, 3)
+    assert_array_almost_equal(r, utils.R_from_relion_scipy(x))
+    for i in range(3):
+        assert_array_almost_equal(r[i], utils.R_from_relion(*x[i]))
+    assert_array_almost_equal(utils.R_to_relion(r), x)
+    assert_array_almost_equal(utils.R_to_relion(r[0]), x[0])
+
+
+def test_convert_eman_batched():
+    rng = np.random.default_rng(0)
+    x = rng.uniform(-180, 180, (100, 3))
+    x[:, 1] = rng.uniform(0, 180, 100)
+    r = utils.R_from_eman(x[:, 0], x[:, 1], x[:, 2])
+    assert r.shape == (100, 3, 3)
+    for i in range(3):
+        assert_array_almost_equal(r[i], utils.R_from_eman(*x[i]))
+    assert_array_almost_equal(utils.R_to_eman(r), x)
+
+
+def test_convert_gimbal_lock():
+    # with a tilt of 0 or 180 only the sum or difference of the other angles is defined
+    x = np.array([[30.0, 0.0, 20.0], [30.0, 180.0, 20.0]])
+    for R_from, R_to in (
+        (utils.R_from_relion, utils.R_to_relion),
+        (utils.R_from_eman, utils.R_to_eman),
+    ):
+        r = R_from(x[:, 0], x[:, 1], x[:, 2])
+        euler = R_to(r)
+        assert_array_almost_equal(euler[:, 1:], [[0, 0], [180, 0]])
+        assert_array_almost_equal(R_from(euler[:, 0], euler[:, 1], euler[:, 2]), r)
+
+
+def test_checkpoint_writer(tmp_path):
+    writer = utils.CheckpointWriter()
+    x = torch.arange(5.0)
+    z = np.zeros(3)
+    out = str(tmp_path / "weights.pkl")
+    writer.write(out, torch.save, {"x": x, "z": z, "epoch": 1})
+    # the data is snapshotted when submitted, not when written
+    x += 1
+    z += 1
+    writer.wait()
+    assert os.listdir(tmp_path) == ["weights.pkl"]
+    checkpoint = torch.load(out, weights_only=False)
+    assert (checkpoint["x"] == torch.arange(5.0)).all()
+    assert (checkpoint["z"] == 0).all() and checkpoint["epoch"] == 1
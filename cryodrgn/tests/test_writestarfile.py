@@ -1,8 +1,11 @@
 import argparse
 import os
 import os.path
+import numpy as np
+import pandas as pd
 import pytest
 from cryodrgn.commands_utils import write_star
+from cryodrgn.starfile import Starfile
 
 DATA_FOLDER = os.path.join(os.path.dirname(__file__), "..", "testing", "data")
 
@@ -38,3 +41,43 @@ def test_writestarfile2(particles_starfile):
         ]
     )
     write_star.main(args)
+
+
+@pytest.mark.parametrize(
+    "starfile",
+    [
+        "relion31.star",
+        "relion31.v2.star",
+        "FinalRefinement-OriginalParticles-PfCRT.star",
+    ],
+)
+def test_starfile_roundtrip(starfile):
+    os.makedirs("output", exist_ok=True)
+    s = Starfile.load(f"{DATA_FOLDER}/{starfile}")
+    assert s.df["_rlnImageName"].str.contains("@").all()
+    assert s.df["_rlnAngleRot"].dtype == np.float64
+    s.write("output/roundtrip.star")
+
+    s2 = Starfile.load("output/roundtrip.star")
+    assert s2.relion31 == s.relion31
+    pd.testing.assert_frame_equal(s2.df, s.df)
+    if s.relion31:
+        pd.testing.assert_frame_equal(s2.data_optics.df, s.data_optics.df)
+
+
+def test_starfile_string_columns(tmp_path):
+    star = tmp_path / "groups.star"
+    star.write_text(
+        "data_optics\n\nloop_\n_rlnOpticsGroupName\n_rlnOpticsGroup\n"
+        "opticsGroup1 1\n\n"
+        "data_particles\n\nloop_\n_rlnImageName\n_rlnGroupName\n_rlnAngleRot\n"
+        "1@a.mrcs 001 10.5\n2@a.mrcs 002 -3.0\n"
+    )
+    s = Starfile.load(str(star))
+    assert s.df["_rlnGroupName"].tolist() == ["001", "002"]
+    assert s.df["_rlnAngleRot"].dtype == np.float64
+    assert s.data_optics.df["_rlnOpticsGroup"].dtype == np.int64
+    s.write(str(tmp_path / "out.star"))
+    assert "1@a.mrcs 001 10.5" in (tmp_path / "out.star").read_text()
+    s2 = Starfile.load(str(tmp_path / "out.star"))
+    pd.testing.assert_frame_equal(s2.df, s.df)
@@ -16,12 +16,12 @@ import logging
 import numpy as np
 import umap
 from matplotlib import pyplot as plt
-from scipy import ndimage, stats
+from scipy import stats
 from scipy.ndimage import gaussian_filter, maximum_filter
 from scipy.ndimage import binary_dilation, distance_transform_edt
 from scipy.spatial import distance_matrix
 
-from cryodrgn import analysis, fft, mrc, utils
+from cryodrgn import analysis, fsc, mrc, utils
 
 try:
     from cuml.manifold.umap import UMAP as cuUMAP  # type: ignore
@@ -160,7 +160,7 @@ def add_args(parser):
         "--max-threads",
         type=int,
         default=8,
-        help="Max number of threads used to parallelize mask generation",
+        help="Max number of processes used to parallelize mask generation and CC + FSC calcs",
     )
     group.add_argument(
         "--thresh",
@@ -841,50 +841,46 @@ def mask_volumes(
         p.starmap(mask_volume, args, 4)
 
 
-def calculate_CCs(outdir, epochs, labels, chimerax_colors):
+def calculate_CCs_FSCs(outdir, epochs, labels, max_threads):
     """
-    Returns the masked map-map correlation between temporally sequential volume pairs outdir/vols.{epochs}, for each
-    class in labels
+    Returns the masked map-map correlation and FSC between temporally sequential volume pairs outdir/vols.{epochs},
+    for each class in labels. Each volume is loaded and Fourier transformed once, and classes are processed in parallel
 
     Inputs:
         outdir: path to base directory to save outputs
         epochs: array of epochs for which to calculate UMAPs
         labels: unique identifier for each class of representative latent encodings
-        chimerax_colors: approximate colors matching ChimeraX palette to facilitate comparison to volume visualization
+        max_threads: maximum number of processes to use
 
-    Outputs:
-        plot.png of sequential volume pairs map-map CC for each class in labels across training epochs
+    Returns:
+        cc_masked: (classes x epochs-1) array of map-map CCs
+        fsc_masked: (classes x epochs-1 x D//2) array of map-map FSCs
+        x: spatial frequency (1/px) of each FSC shell
     """
+    vol_paths = [
+        [f"{outdir}/vols.{epoch}/vol_{cluster:03d}.masked.mrc" for epoch in epochs]
+        for cluster in range(len(labels))
+    ]
+    cc_masked, fsc_masked = fsc.sequential_fscs_parallel(vol_paths, max_threads)
+    x = fsc.fsc_freqs(2 * fsc_masked.shape[-1])
+    return cc_masked, fsc_masked, x
 
-    def calc_cc(vol1, vol2):
-        """
-        Helper function to calculate the zero-mean correlation coefficient as defined in eq 2 in
-        https://journals.iucr.org/d/issues/2018/09/00/kw5139/index.html
-        vol1 and vol2 should be maps of the same box size, structured as numpy arrays with ndim=3, i.e. by loading with
-        cryodrgn.mrc.parse_mrc
-        """
-        zmean1 = vol1 - np.mean(vol1)
-        zmean2 = vol2 - np.mean(vol2)
-        cc = (
-            (np.sum(zmean1**2) ** -0.5)
-            * (np.sum(zmean2**2) ** -0.5)
-            * np.sum(zmean1 * zmean2)
-        )
-        return cc
 
-    cc_masked = np.zeros((len(labels), len(epochs) - 1))
-
-    for i in range(len(epochs) - 1):
-        for cluster in np.arange(len(labels)):
-            vol1, _ = mrc.parse_mrc(
-                f"{outdir}/vols.{epochs[i]}/vol_{cluster:03d}.masked.mrc"
-            )
-            vol2, _ = mrc.parse_mrc(
-                f"{outdir}/vols.{epochs[i+1]}/vol_{cluster:03d}.masked.mrc"
-            )
+def plot_CCs(outdir, epochs, labels, cc_masked, chimerax_colors):
+    """
+    Plots the masked map-map correlation between temporally sequential volume pairs outdir/vols.{epochs}, for each
+    class in labels
 
-            cc_masked[cluster, i] = calc_cc(vol1, vol2)
+    Inputs:
+        outdir: path to base directory to save outputs
+        epochs: array of epochs for which to calculate UMAPs
+        labels: unique identifier for each class of representative latent encodings
+        cc_masked: (classes x epochs-1) array of map-map CCs from calculate_CCs_FSCs
+        chimerax_colors: approximate colors matching ChimeraX palette to facilitate comparison to volume visualization
 
+    Outputs:
+        plot.png of sequential volume pairs map-map CC for each class in labels across training epochs
+    """
     utils.save_pkl(cc_masked, f"{outdir}/cc_masked.pkl")
 
     fig, ax = plt.subplots(1, 1)
@@ -905,74 +901,22 @@ def calculate_CCs(outdir, epochs, labels, chimerax_colors):
     logger.info(f"Saved map-map correlation plot to {outdir}/plots/05_decoder_CC.png")
 
 
-def calculate_FSCs(outdir, epochs, labels, img_size, chimerax_colors):
+def plot_FSCs(outdir, epochs, labels, fsc_masked, x, chimerax_colors):
     """
-    Returns the masked FSC between temporally sequential volume pairs outdir/vols.{epochs}, for each class in labels
+    Plots the masked FSC between temporally sequential volume pairs outdir/vols.{epochs}, for each class in labels
 
     Inputs:
         outdir: path to base directory to save outputs
         epochs: array of epochs for which to calculate UMAPs
         labels: unique identifier for each class of representative latent encodings
-        img_size: box size of input images in pixels
+        fsc_masked: (classes x epochs-1 x D//2) array of map-map FSCs from calculate_CCs_FSCs
+        x: spatial frequency (1/px) of each FSC shell
         chimerax_colors: approximate colors matching ChimeraX palette to facilitate comparison to volume visualization
 
     Outputs:
         plot.png of sequential volume pairs map-map FSC for each class in labels across training epochs
         plot.png of sequential volume pairs map-map FSC at Nyquist for each class in labels across training epochs
-
-    TODO: accelerate via multiprocessing (create iterable list of calc_fsc calls?)
-
     """
-
-    def calc_fsc(vol1_path: str, vol2_path: str):
-        """
-        Helper function to calculate the FSC between two (assumed masked) volumes
-        vol1 and vol2 should be maps of the same box size, structured as numpy arrays with ndim=3, i.e. by loading with
-        cryodrgn.mrc.parse_mrc
-        """
-        # load masked volumes in fourier space
-        vol1, _ = mrc.parse_mrc(vol1_path)
-        vol2, _ = mrc.parse_mrc(vol2_path)
-        assert isinstance(vol1, np.ndarray)
-        assert isinstance(vol2, np.ndarray)
-
-        vol1_ft = fft.fftn_center(vol1)
-        vol2_ft = fft.fftn_center(vol2)
-
-        # define fourier grid and label into shells
-        D = vol1.shape[0]
-        x = np.arange(-D // 2, D // 2)
-        x0, x1, x2 = np.meshgrid(x, x, x, indexing="ij")
-        r = np.sqrt(x0**2 + x1**2 + x2**2)
-        r_max = D // 2  # sphere inscribed within volume box
-        r_step = 1  # int(np.min(r[r>0]))
-        bins = np.arange(0, r_max, r_step)
-        bin_labels = np.searchsorted(bins, r, side="right")
-
-        # calculate the FSC via labeled shells
-        num = ndimage.sum(
-            np.real(vol1_ft * np.conjugate(vol2_ft)), labels=bin_labels, index=bins + 1
-        )
-        den1 = ndimage.sum(np.abs(vol1_ft) ** 2, labels=bin_labels, index=bins + 1)
-        den2 = ndimage.sum(np.abs(vol2_ft) ** 2, labels=bin_labels, index=bins + 1)
-        fsc = num / np.sqrt(den1 * den2)
-
-        x = bins / D  # x axis should be spatial frequency in 1/px
-        return x, fsc
-
-    # calculate masked FSCs for all volumes
-    x = None
-    fsc_masked = np.zeros((len(labels), len(epochs) - 1, img_size // 2))
-
-    for cluster in range(len(labels)):
-        logger.info(f"Calculating all FSCs for cluster {cluster}")
-
-        for i in range(len(epochs) - 1):
-            vol1_path = f"{outdir}/vols.{epochs[i]}/vol_{cluster:03d}.masked.mrc"
-            vol2_path = f"{outdir}/vols.{epochs[i+1]}/vol_{cluster:03d}.masked.mrc"
-
-            x, fsc_masked[cluster, i, :] = calc_fsc(vol1_path, vol2_path)
-
     utils.save_pkl(fsc_masked, f"{outdir}/fsc_masked.pkl")
     utils.save_pkl(x, f"{outdir}/fsc_xaxis.pkl")
 
@@ -1087,10 +1031,8 @@ def main(args):
         sys.exit()
     logger.info(f"Saving all results to {outdir}")
 
-    # Get total number of particles, latent space dimensionality, input image size
+    # Get total number of particles, latent space dimensionality
     n_particles_total, n_dim = utils.load_pkl(f"{workdir}/z.{E}.pkl").shape
-    cfg = utils.load_pkl(config)
-    img_size = cfg["lattice_args"]["D"] - 1
 
     # Commonly used variables
     # plt.rcParams.update({'font.size': 16})
@@ -1182,6 +1124,7 @@ def main(args):
         workdir, outdir, epochs, n_dim, binned_ptcls_mask, labels
     )
 
+    max_threads = min(args.max_threads, multiprocessing.cpu_count())
     if args.skip_volgen:
         logger.info("Skipping volume generation ...")
     else:
@@ -1203,7 +1146,6 @@ def main(args):
         thresh = args.thresh
         dilate = args.dilate
         dist = args.dist
-        max_threads = min(args.max_threads, multiprocessing.cpu_count())
         logger.info(f"Using {max_threads} threads to parallelize masking")
         mask_volumes(
             outdir,
@@ -1217,16 +1159,11 @@ def main(args):
         )
 
     logger.info(
-        f"Calculating masked map-map CCs at representative latent encodings for epochs {epochs} ..."
-    )
-    calculate_CCs(outdir, epochs, labels, chimerax_colors)
-
-    logger.info(
-        f"Calculating masked map-map FSCs at representative latent encodings for epochs {epochs} ..."
+        f"Calculating masked map-map CCs and FSCs at representative latent encodings for epochs {epochs} ..."
     )
-    if args.downsample:
-        img_size = args.downsample
-    calculate_FSCs(outdir, epochs, labels, img_size, chimerax_colors)
+    cc_masked, fsc_masked, x = calculate_CCs_FSCs(outdir, epochs, labels, max_threads)
+    plot_CCs(outdir, epochs, labels, cc_masked, chimerax_colors)
+    plot_FSCs(outdir, epochs, labels, fsc_masked, x, chimerax_colors)
 
     logger.info(f"Finished in {dt.now() - t1}")
 